@@ -0,0 +1,98 @@
+# Per-trial timing of the oddball experiment loop
+# TrialTimer holds preallocated int64 arrays of clock_ns timestamps, one row per trial: the phases of the
+# trial and the duration of every register write. Nothing is allocated or printed during the run;
+# save() writes the arrays to an .npz file (at the pauses and at the end), timing_report() summarizes
+# such a file: onset jitter histogram, cumulative SOA drift and the slowest calls by register.
+import numpy
+from pathlib import Path
+
+# timestamps per trial: trial starts, writes done, play called, play returned (= onset), playback finished
+phases = ['start', 'written', 'play', 'onset', 'finished']
+
+
+class TrialTimer:
+
+    def __init__(self, n_trials, register_names, soa, codes=None):
+        self.register_names = list(register_names)
+        self.soa = soa
+        # planned stimulus codes, saved with the timing for checking the recorded markers (alignment.py)
+        self.codes = numpy.full(n_trials, -1, dtype=numpy.int8) if codes is None else numpy.int8(codes)
+        self.planned = numpy.zeros(n_trials, dtype=numpy.int64)
+        self.phases = numpy.zeros((n_trials, len(phases)), dtype=numpy.int64)
+        self.writes = numpy.full((n_trials, len(self.register_names)), -1, dtype=numpy.int64)  # -1: not written
+        self.block = numpy.zeros(n_trials, dtype=numpy.int16)  # schedule restarts after every pause
+        self.n_done = 0
+
+    def __repr__(self):
+        return f"<TrialTimer | {self.n_done} of {len(self.planned)} trials>"
+
+    def save(self, file):
+        file = Path(file)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        numpy.savez(file, codes=self.codes, planned=self.planned, phases=self.phases, writes=self.writes,
+                    block=self.block, n_done=self.n_done, soa=self.soa, register_names=numpy.array(self.register_names),
+                    phase_names=numpy.array(phases))
+        return file
+
+    @classmethod
+    def load(cls, file):
+        with numpy.load(file) as saved:
+            timer = cls(len(saved['planned']), saved['register_names'].tolist(), float(saved['soa']))
+            for name in ['codes', 'planned', 'phases', 'writes', 'block']:
+                getattr(timer, name)[:] = saved[name]
+            timer.n_done = int(saved['n_done'])
+        return timer
+
+    def phase(self, name):
+        return self.phases[:self.n_done, phases.index(name)]
+
+    def report(self, bins=20, n_slowest=5):
+        # dict with onset error / interval jitter / drift statistics (ms) and the slowest calls
+        onsets = self.phase('onset')
+        error = (onsets - self.planned[:self.n_done]) / 1e6
+        same_block = numpy.diff(self.block[:self.n_done]) == 0
+        jitter = (numpy.diff(onsets) / 1e6 - self.soa * 1000)[same_block]
+        drift = numpy.zeros(self.n_done)
+        drift[1:] = numpy.cumsum(numpy.where(same_block, numpy.diff(onsets) / 1e6 - self.soa * 1000, 0))
+        counts, edges = numpy.histogram(jitter, bins=bins) if len(jitter) else (numpy.zeros(0), numpy.zeros(0))
+
+        calls = {name: self.writes[:self.n_done, index] for index, name in enumerate(self.register_names)}
+        calls['play'] = self.phase('onset') - self.phase('play')
+        calls['wait_to_finish_playing'] = self.phase('finished') - self.phase('onset')
+        slowest = []
+        for name, durations in calls.items():
+            durations = durations[durations >= 0] / 1e6
+            if len(durations):
+                slowest.append({'call': name, 'n': len(durations), 'mean_ms': float(durations.mean()),
+                                'p99_ms': float(numpy.percentile(durations, 99)), 'max_ms': float(durations.max()),
+                                'trial': int(numpy.flatnonzero(calls[name] >= 0)[durations.argmax()])})
+        slowest.sort(key=lambda call: call['max_ms'], reverse=True)
+        return {'n_trials': self.n_done,
+                'onset_error_ms': {'mean': float(error.mean()), 'std': float(error.std()), 'max': float(error.max())}
+                if self.n_done else {},
+                'jitter_ms': {'std': float(jitter.std()), 'min': float(jitter.min()), 'max': float(jitter.max()),
+                              'counts': counts.tolist(), 'edges': edges.tolist()} if len(jitter) else {},
+                'drift_ms': drift.tolist(),
+                'slowest': slowest[:n_slowest]}
+
+
+def timing_report(timer, bins=20, n_slowest=5, show=True):
+    # timer: TrialTimer or a file written by TrialTimer.save
+    if not isinstance(timer, TrialTimer):
+        timer = TrialTimer.load(timer)
+    report = timer.report(bins, n_slowest)
+    if show and report['n_trials']:
+        error = report['onset_error_ms']
+        print(f"{report['n_trials']} trials, onset error {error['mean']:.3f} ± {error['std']:.3f} ms "
+              f"(max {error['max']:.3f} ms), drift at the end {report['drift_ms'][-1]:.3f} ms")
+        if report['jitter_ms']:
+            jitter = report['jitter_ms']
+            print(f"SOA jitter (ms), std {jitter['std']:.3f}:")
+            scale = 50 / max(max(jitter['counts']), 1)
+            for count, low, high in zip(jitter['counts'], jitter['edges'][:-1], jitter['edges'][1:]):
+                print(f"{low:8.3f} - {high:8.3f} {count:6d} {'#' * int(numpy.ceil(count * scale))}")
+        print("slowest calls:")
+        for call in report['slowest']:
+            print(f"{call['call']:>26} n={call['n']:<5d} mean {call['mean_ms']:.3f} ms, p99 {call['p99_ms']:.3f} ms, "
+                  f"max {call['max_ms']:.3f} ms (trial {call['trial']})")
+    return report
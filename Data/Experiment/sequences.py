@@ -0,0 +1,140 @@
+# MMN trial sequences
+# A sequence starts with leading standards (code 0), then deviants (codes 1 - 4) and standards alternate.
+# The deviants come in groups of five: every deviant type once plus one extra, no deviant directly
+# repeated (also across group borders). generate_deviant_groups finds such groups by reshuffling; here
+# all valid groups are listed once and a group is drawn from that table, so a sequence is built in one
+# pass and many sequences are built at once as an (N x n_trials) int8 array.
+import itertools
+import random
+import time
+import numpy
+
+deviant_types = (1, 2, 3, 4)
+group_size = 5
+
+
+def generate_deviant_groups(total_deviants, last_deviant=None):
+    # reference implementation (rejection sampling), see benchmark_sequences
+    deviant_types = [1, 2, 3, 4]
+    groups = []
+    while len(groups) * 5 < total_deviants:
+        group = deviant_types.copy()
+        # Choose a 5th deviant that's not same as previous group's last deviant
+        extra_choices = [d for d in deviant_types if d != last_deviant]
+        group.append(random.choice(extra_choices))
+        # Shuffle group until no adjacent duplicates with previous group's end
+        for _ in range(1000):
+            random.shuffle(group)
+            if last_deviant is None or group[0] != last_deviant:
+                if all(group[i] != group[i+1] for i in range(len(group)-1)):
+                    break
+        else:
+            raise RuntimeError("Failed to build a valid deviant group.")
+        groups.append(group)
+        last_deviant = group[-1]
+    # Flatten list of groups
+    return [d for group in groups for d in group]
+
+
+def generate_mmn_sequence(n_trials, leading_standards=15):
+    # reference implementation, see mmn_sequence
+    if n_trials <= leading_standards or (n_trials - leading_standards) % 2 != 0:
+        raise ValueError("Total length must allow alternation after leading standards.")
+    sequence = [0] * leading_standards
+    num_deviants = (n_trials - leading_standards) // 2
+    deviant_list = generate_deviant_groups(num_deviants)
+    # Interleave with standards
+    for deviant in deviant_list:
+        sequence.append(deviant)  # odd index
+        sequence.append(0)        # even index
+    return sequence[:n_trials]
+
+
+def _group_table():
+    # valid groups for every previous last deviant (0: no previous group), padded to the same length.
+    # With the extra deviant drawn uniformly (not the previous last one) and then a uniform valid
+    # order, every valid group is equally likely, as in generate_deviant_groups.
+    table = numpy.zeros((len(deviant_types) + 1, 4 * 36, group_size), dtype=numpy.int8)
+    counts = numpy.zeros(len(deviant_types) + 1, dtype=int)
+    for last in range(len(deviant_types) + 1):
+        groups = sorted({order for extra in deviant_types if extra != last
+                         for order in itertools.permutations(deviant_types + (extra,))
+                         if order[0] != last and all(a != b for a, b in zip(order, order[1:]))})
+        table[last, :len(groups)] = groups
+        counts[last] = len(groups)
+    return table, counts
+
+
+group_table, group_counts = _group_table()
+
+
+def generate_mmn_sequences(n_sequences, n_trials=1845, leading_standards=15, seed=None):
+    # (n_sequences x n_trials) int8 array; one vectorized draw per group position for all sequences
+    if n_trials <= leading_standards or (n_trials - leading_standards) % 2 != 0:
+        raise ValueError("Total length must allow alternation after leading standards.")
+    rng = numpy.random.default_rng(seed)
+    n_deviants = (n_trials - leading_standards) // 2
+    n_groups = -(-n_deviants // group_size)
+    deviants = numpy.empty((n_sequences, n_groups, group_size), dtype=numpy.int8)
+    last = numpy.zeros(n_sequences, dtype=int)
+    draws = rng.random((n_groups, n_sequences))
+    for group in range(n_groups):
+        index = (draws[group] * group_counts[last]).astype(int)
+        deviants[:, group] = group_table[last, index]
+        last = deviants[:, group, -1]
+    sequences = numpy.zeros((n_sequences, n_trials), dtype=numpy.int8)
+    sequences[:, leading_standards::2] = deviants.reshape(n_sequences, -1)[:, :n_deviants]
+    return sequences
+
+
+def mmn_sequence(n_trials=1845, leading_standards=15, seed=None):
+    # one sequence, drop-in for generate_mmn_sequence (as an int8 array, .tolist() for a list)
+    return generate_mmn_sequences(1, n_trials, leading_standards, seed)[0]
+
+
+def check_sequences(sequences, leading_standards=15):
+    # every constraint for every sequence at once: {constraint: bool array of length N}
+    sequences = numpy.atleast_2d(numpy.asarray(sequences))
+    n_trials = sequences.shape[1]
+    deviants = sequences[:, leading_standards::2]
+    n_groups = deviants.shape[1] // group_size
+    groups = deviants[:, :n_groups * group_size].reshape(len(sequences), n_groups, group_size)
+    present = (groups[..., None] == numpy.array(deviant_types)).any(axis=2)
+    return {
+        'length': numpy.full(len(sequences), n_trials > leading_standards and (n_trials - leading_standards) % 2 == 0),
+        'leading_standards': (sequences[:, :leading_standards] == 0).all(axis=1),
+        'alternation': (numpy.isin(deviants, deviant_types).all(axis=1)
+                        & (sequences[:, leading_standards + 1::2] == 0).all(axis=1)),
+        'no_repeat': (deviants[:, 1:] != deviants[:, :-1]).all(axis=1),
+        'balanced': present.all(axis=(1, 2)),
+    }
+
+
+def valid_sequences(sequences, leading_standards=15):
+    return numpy.logical_and.reduce(list(check_sequences(sequences, leading_standards).values()))
+
+
+def benchmark_sequences(n_sequences=1000, n_trials=1845, leading_standards=15, seed=0):
+    # time generate_mmn_sequence in a loop against one batched call and check both outputs
+    random.seed(seed)
+    start = time.perf_counter()
+    reference = numpy.array([generate_mmn_sequence(n_trials, leading_standards) for _ in range(n_sequences)])
+    loop_s = time.perf_counter() - start
+    start = time.perf_counter()
+    batch = generate_mmn_sequences(n_sequences, n_trials, leading_standards, seed)
+    batch_s = time.perf_counter() - start
+    start = time.perf_counter()
+    valid = valid_sequences(batch, leading_standards)
+    check_s = time.perf_counter() - start
+    result = {'n_sequences': n_sequences, 'n_trials': n_trials, 'loop_s': loop_s, 'batch_s': batch_s,
+              'check_s': check_s, 'speedup': loop_s / batch_s,
+              'reference_valid': bool(valid_sequences(reference, leading_standards).all()),
+              'batch_valid': bool(valid.all())}
+    print(f"{n_sequences} sequences x {n_trials} trials: loop {loop_s:.2f} s, batch {batch_s * 1000:.1f} ms "
+          f"({result['speedup']:.0f}x faster), check {check_s * 1000:.1f} ms, "
+          f"all valid: {result['reference_valid'] and result['batch_valid']}")
+    return result
+
+
+if __name__ == "__main__":
+    benchmark_sequences()
@@ -0,0 +1,148 @@
+# Stimulus bank for harmonic complexes
+# A stimulus is a parameter dict (f0, duration, level, n_harmonics, rolloff, ramp, pad). All stimuli that
+# are not rendered yet are synthesized together as one (stimuli x harmonics x samples) computation and
+# written as raw float32 to a cache directory under a hash of their parameters, so the same parameters
+# are never synthesized twice. Stimuli are read from the cache the first time they are used.
+import hashlib
+import itertools
+import json
+import numpy
+from pathlib import Path
+
+fs = 24414
+default_cache_dir = Path(__file__).resolve().parent.parent / 'cache' / 'stimuli'
+version = 1  # change when the synthesis changes, so old cache files are not used
+
+default_stimulus = {'f0': 500., 'duration': 0.075, 'level': 80., 'n_harmonics': 3, 'rolloff': 3.,
+                    'ramp': 0., 'pad': 0.}
+
+# the stimuli of oddball_eeg.py; level is the level of f0, every further harmonic is `rolloff` dB softer
+oddball_stimuli = {
+    'standard': {},                                # EEG trigger code 1
+    'deviant_1': {'f0': 550.},                     # frequency deviant - EEG trigger code 2
+    'deviant_2': {'level': 90.},                   # loudness deviant - EEG trigger code 3
+    'deviant_3': {'duration': 0.025, 'pad': 0.05},  # duration deviant - EEG trigger code 4
+}
+
+
+def n_samples(duration, samplerate=fs):
+    return int(numpy.rint(duration * samplerate))  # as slab.Signal.in_samples
+
+
+def stimulus_key(params, samplerate=fs):
+    content = json.dumps({'params': dict(default_stimulus, **params), 'samplerate': samplerate,
+                          'version': version}, sort_keys=True)
+    return hashlib.sha1(content.encode()).hexdigest()[:16]
+
+
+def synthesize(stimuli, samplerate=fs):
+    # list of parameter dicts -> list of float32 arrays, all stimuli in one vectorized computation.
+    # Every harmonic is scaled to its level by its rms, as slab.Sound.tone(..., level=...) does.
+    stimuli = [dict(default_stimulus, **params) for params in stimuli]
+    if not stimuli:
+        return []
+    lengths = numpy.array([n_samples(params['duration'], samplerate) for params in stimuli])
+    max_harmonics = max(params['n_harmonics'] for params in stimuli)
+    harmonics = numpy.arange(1, max_harmonics + 1)
+    frequencies = numpy.array([params['f0'] for params in stimuli])[:, None] * harmonics
+    levels = (numpy.array([params['level'] for params in stimuli])[:, None]
+              - numpy.array([params['rolloff'] for params in stimuli])[:, None] * (harmonics - 1))
+    present = harmonics <= numpy.array([params['n_harmonics'] for params in stimuli])[:, None]
+    inside = numpy.arange(lengths.max()) < lengths[:, None]
+    tones = numpy.sin(2 * numpy.pi * frequencies[:, :, None] * (numpy.arange(lengths.max()) / samplerate))
+    tones *= inside[:, None, :]
+    rms = numpy.sqrt((tones ** 2).sum(axis=2) / lengths[:, None])
+    gains = numpy.where(present, 2e-5 * 10 ** (levels / 20) / numpy.maximum(rms, 1e-20), 0.)
+    sounds = numpy.einsum('sh,sht->st', gains, tones)
+
+    rendered = []
+    for sound, length, params in zip(sounds, lengths, stimuli):
+        sound = sound[:length]
+        ramp = n_samples(params['ramp'], samplerate)
+        if ramp:  # raised-cosine on- and offset, as slab.Sound.ramp
+            envelope = numpy.sin(numpy.linspace(0, numpy.pi / 2, ramp)) ** 2
+            sound[:ramp] *= envelope
+            sound[-ramp:] *= envelope[::-1]
+        silence = numpy.zeros(n_samples(params['pad'], samplerate))
+        rendered.append(numpy.concatenate([sound, silence]).astype(numpy.float32))
+    return rendered
+
+
+def parameter_grid(prefix='stim', **axes):
+    # parameter_grid('timbre', f0=[500, 550], rolloff=[0, 3, 6]) -> {'timbre_f0-500_rolloff-0': {...}, ...}
+    names = list(axes)
+    grid = {}
+    for values in itertools.product(*[axes[name] for name in names]):
+        label = '_'.join(f'{name}-{value:g}' for name, value in zip(names, values))
+        grid[f'{prefix}_{label}'] = dict(zip(names, values))
+    return grid
+
+
+class StimulusBank:
+
+    def __init__(self, stimuli=None, samplerate=fs, cache_dir=None):
+        self.samplerate = samplerate
+        self.cache_dir = Path(cache_dir or default_cache_dir)
+        self.params = {}
+        self._loaded = {}
+        self.add(stimuli or {})
+
+    def __repr__(self):
+        return f"<StimulusBank | {len(self.params)} stimuli, {len(self._loaded)} loaded, {self.cache_dir}>"
+
+    def __len__(self):
+        return len(self.params)
+
+    def __contains__(self, name):
+        return name in self.params
+
+    @property
+    def names(self):
+        return list(self.params)
+
+    def add(self, stimuli=None, **params):
+        # add({'name': {...}, ...}) or add(name=..., f0=...) for a single one; nothing is synthesized yet
+        if 'name' in params:
+            stimuli = {params.pop('name'): params}
+        elif stimuli is None or params:
+            raise TypeError("add() needs a dict of stimuli or name=... with the parameters of one stimulus.")
+        for name, stimulus in stimuli.items():
+            self.params[name] = dict(default_stimulus, **stimulus)
+            self._loaded.pop(name, None)
+        return self
+
+    def path(self, name):
+        return self.cache_dir / f'{stimulus_key(self.params[name], self.samplerate)}.f32'
+
+    def render(self, names=None):
+        # synthesizes all stimuli (of names) that are not in the cache yet, in one go
+        names = self.names if names is None else list(names)
+        missing = list({self.path(name): name for name in names if not self.path(name).exists()}.items())
+        if missing:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            sounds = synthesize([self.params[name] for _, name in missing], self.samplerate)
+            for (path, _), sound in zip(missing, sounds):
+                sound.tofile(path)
+        return len(missing)
+
+    def __getitem__(self, name):
+        # float32 samples of one stimulus, synthesized (with all other missing stimuli) if necessary
+        if name not in self._loaded:
+            if not self.path(name).exists():
+                self.render()
+            self._loaded[name] = numpy.fromfile(self.path(name), dtype=numpy.float32)
+        return self._loaded[name]
+
+    def duration(self, name):
+        return len(self[name]) / self.samplerate
+
+    def sound(self, name):
+        # as slab.Sound, e.g. for .play() or .spectrum()
+        import slab
+        return slab.Sound(self[name].astype(float), samplerate=self.samplerate)
+
+
+if __name__ == "__main__":
+    bank = StimulusBank(oddball_stimuli)
+    bank.add(parameter_grid('timbre', f0=[500.], n_harmonics=[3, 6, 12], rolloff=[0., 3., 6., 12.]))
+    print(bank, f"{bank.render()} rendered")
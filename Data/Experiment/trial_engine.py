@@ -0,0 +1,228 @@
+# Pre-scheduled trials for the oddball experiment
+# run_experiment wrote every register for every trial and slept a fixed soa - duration after playing, so
+# the time spent in the writes and waits added up to drift. Here the register state of every trial is
+# computed before the run, only registers whose value changes are written, and each onset is scheduled
+# at start + n * soa on a monotonic clock. The backend is anything with freefield's write / play /
+# wait_to_finish_playing (the freefield module itself or FakeFreefield for testing without the RX8s).
+# Each trial is timed in a TrialTimer (instrumentation.py).
+import time
+import numpy
+from instrumentation import TrialTimer, timing_report, phases
+
+# (tag, processors) of the registers set per trial; trigcode goes to both processors in one write
+registers = [('trigcode', ('RX81', 'RX82')), ('std_chan', ('RX82',)), ('std_chan', ('RX81',)),
+             ('dev_chan_1', ('RX81',)), ('dev_chan_2', ('RX81',)), ('dev_chan_3', ('RX81',))]
+
+# register values per stimulus code (rows) as in run_experiment: codes 0 - 3 play from speaker 1 of RX81
+# (1 = on, 25 = off), code 4 (location deviant) plays the standard from speaker 14 of RX82
+register_table = numpy.array([
+    # trigcode, RX82 std_chan, RX81 std_chan, dev_chan_1, dev_chan_2, dev_chan_3
+    [0, 25, 1, 25, 25, 25],
+    [1, 25, 25, 1, 25, 25],
+    [2, 25, 25, 25, 1, 25],
+    [3, 25, 25, 25, 25, 1],
+    [4, 14, 25, 25, 25, 25],
+])
+
+
+def register_states(sequence):
+    # (n_trials x registers) values for a sequence of stimulus codes 0 - 4
+    return register_table[numpy.asarray(sequence, dtype=int)]
+
+
+def register_changes(states):
+    # (n_trials x registers) bool, True where a register has to be written before the trial;
+    # everything is written before the first trial
+    changes = numpy.ones(states.shape, dtype=bool)
+    changes[1:] = states[1:] != states[:-1]
+    return changes
+
+
+class FakeFreefield:
+    # in-process stand-in for the freefield write / play / wait_to_finish_playing API. Writes are kept in
+    # `registers`, every call can take a fixed latency (+ random jitter). With virtual=True the engine
+    # runs on the fake's own clock, so a full session takes no real time.
+
+    def __init__(self, samplerate=24414, write_latency=0., play_latency=0., jitter=0., virtual=False, seed=None):
+        self.samplerate = samplerate
+        self.write_latency = write_latency
+        self.play_latency = play_latency
+        self.jitter = jitter
+        self.virtual = virtual
+        self.rng = numpy.random.default_rng(seed)
+        self.registers = {}
+        self.n_writes = 0
+        self.plays = []
+        self._now = 0.
+        self._playing_until = 0.
+
+    def __repr__(self):
+        return f"<FakeFreefield | {self.n_writes} writes, {len(self.plays)} plays>"
+
+    def clock(self):
+        return self._now if self.virtual else time.perf_counter()
+
+    def clock_ns(self):
+        return round(self._now * 1e9) if self.virtual else time.perf_counter_ns()
+
+    def sleep(self, seconds):
+        if self.virtual:
+            self._now += max(0., seconds)
+        elif seconds > 0:
+            time.sleep(seconds)
+
+    def _spend(self, latency):
+        if latency or self.jitter:
+            self.sleep(latency + self.jitter * self.rng.random())
+
+    def write(self, tag, value, processors):
+        for processor in [processors] if isinstance(processors, str) else processors:
+            self.registers[(tag, processor)] = value
+        self.n_writes += 1
+        self._spend(self.write_latency)
+
+    def read(self, tag, proc='RX81'):
+        return self.registers.get((tag, proc))
+
+    def play(self, kind='zBusA', proc=None):
+        self._spend(self.play_latency)
+        onset = self.clock()
+        self.plays.append((onset, self.registers.get(('trigcode', 'RX81'))))
+        self._playing_until = onset + self.registers.get(('playbuflen', 'RX81'), 0) / self.samplerate
+
+    def wait_to_finish_playing(self, proc='all', tag='playback'):
+        self.sleep(self._playing_until - self.clock())
+
+
+class TrialEngine:
+
+    def __init__(self, backend, sequence, soa=0.5, pauses=(615, 1230), pause=None, clock_ns=None, sleep=None,
+                 spin=0.002, lead=0.1, timing_file=None):
+        # sequence: stimulus codes 0 - 4 (list, array or the slab.Trialsequence, which is iterated once);
+        # pauses: trial indices after which pause() is called (default: wait for enter), the schedule
+        # restarts after a pause; clock_ns / sleep default to the backend's (FakeFreefield) or
+        # perf_counter_ns. Every trial is timed in self.timer, which is saved to timing_file (if given)
+        # at every pause and at the end.
+        self.backend = backend
+        self.sequence = numpy.array(list(sequence), dtype=int)
+        self.soa = soa
+        self.pauses = set(pauses)
+        self.pause = pause or (lambda: input('Press enter to continue...'))
+        self.clock_ns = clock_ns or getattr(backend, 'clock_ns', time.perf_counter_ns)
+        self.sleep = sleep or getattr(backend, 'sleep', time.sleep)
+        self.spin = 0. if getattr(backend, 'virtual', False) else spin  # a virtual clock only moves in sleep
+        self.lead = lead
+        self.timing_file = timing_file
+        self.states = register_states(self.sequence)
+        self.changes = register_changes(self.states)
+        self.timer = TrialTimer(len(self.sequence), [f"{tag} {'/'.join(processors)}" for tag, processors in registers],
+                                soa, codes=self.sequence)
+
+    def __repr__(self):
+        return (f"<TrialEngine | {len(self.sequence)} trials, soa {self.soa} s, "
+                f"{self.changes.sum()} register writes>")
+
+    @property
+    def planned(self):
+        return self.timer.planned / 1e9
+
+    @property
+    def onsets(self):
+        return self.timer.phases[:, phases.index('onset')] / 1e9
+
+    def drift(self):
+        # onset - planned onset in s, nan for trials that did not run yet
+        drift = self.onsets - self.planned
+        drift[self.timer.n_done:] = numpy.nan
+        return drift
+
+    def wait_until(self, target_ns):
+        # coarse sleep, then spin on the clock for the last `spin` seconds
+        remaining = (target_ns - self.clock_ns()) / 1e9
+        if remaining > self.spin:
+            self.sleep(remaining - self.spin)
+        while self.clock_ns() < target_ns:
+            pass
+
+    def run_trial(self, trial):
+        clock_ns, stamps, writes = self.clock_ns, self.timer.phases[trial], self.timer.writes[trial]
+        stamps[0] = clock_ns()
+        for index in numpy.flatnonzero(self.changes[trial]):
+            tag, processors = registers[index]
+            started = clock_ns()
+            self.backend.write(tag, int(self.states[trial, index]), list(processors))
+            writes[index] = clock_ns() - started
+        stamps[1] = clock_ns()
+        self.wait_until(self.timer.planned[trial])
+        stamps[2] = clock_ns()
+        self.backend.play('zBusA')
+        stamps[3] = clock_ns()
+        self.backend.wait_to_finish_playing()
+        stamps[4] = clock_ns()
+        self.timer.n_done = trial + 1
+
+    def run(self, start_trial=0):
+        # returns (planned, actual) onsets in clock seconds
+        start, first, block = self.clock_ns() + int(self.lead * 1e9), start_trial, 0
+        for trial in range(start_trial, len(self.sequence)):
+            self.timer.planned[trial] = start + round((trial - first) * self.soa * 1e9)
+            self.timer.block[trial] = block
+            self.run_trial(trial)
+            if trial in self.pauses and trial < len(self.sequence) - 1:
+                self.save_timing()
+                self.pause()
+                start, first, block = self.clock_ns() + int(self.lead * 1e9), trial + 1, block + 1
+        self.save_timing()
+        return self.planned, self.onsets
+
+    def save_timing(self):
+        if self.timing_file is not None:
+            self.timer.save(self.timing_file)
+
+    def report(self, **kwargs):
+        return timing_report(self.timer, **kwargs)
+
+
+def benchmark_engine(n_trials=1845, soa=0.5, write_latency=0.002, play_latency=0.001, duration=0.075, seed=0):
+    # simulated session on a FakeFreefield clock: fixed-sleep loop of run_experiment vs. the engine
+    from sequences import mmn_sequence
+    sequence = mmn_sequence(n_trials, seed=seed)
+    channels = ['std_chan', 'dev_chan_1', 'dev_chan_2', 'dev_chan_3']
+
+    old = FakeFreefield(write_latency=write_latency, play_latency=play_latency, virtual=True, seed=seed)
+    old.write('playbuflen', int(duration * old.samplerate), ['RX81', 'RX82'])
+    for stim_code in sequence:  # the loop of run_experiment
+        old.write('trigcode', stim_code, ['RX81', 'RX82'])
+        if stim_code == 4:
+            old.write('std_chan', 14, ['RX82'])
+            for code in range(4):
+                old.write(channels[code], 25, ['RX81'])
+            old.play('zBusA')
+            old.wait_to_finish_playing()
+            old.write('std_chan', 25, ['RX82'])
+        else:
+            old.write(channels[stim_code], 1, ['RX81'])
+            for code in [code for code in range(4) if code != stim_code]:
+                old.write(channels[code], 25, ['RX81'])
+            old.play('zBusA')
+            old.wait_to_finish_playing()
+        old.sleep(soa - duration)
+    old_onsets = numpy.array([onset for onset, _ in old.plays])
+    old_drift = old_onsets - (old_onsets[0] + numpy.arange(n_trials) * soa)
+
+    new = FakeFreefield(write_latency=write_latency, play_latency=play_latency, virtual=True, seed=seed)
+    new.write('playbuflen', int(duration * new.samplerate), ['RX81', 'RX82'])
+    engine = TrialEngine(new, sequence, soa, pauses=())
+    engine.run()
+    new_drift = engine.onsets - (engine.onsets[0] + numpy.arange(n_trials) * soa)
+
+    result = {'n_trials': n_trials, 'old_writes': old.n_writes - 1, 'new_writes': new.n_writes - 1,
+              'old_drift_s': float(old_drift[-1]), 'new_drift_s': float(new_drift[-1]),
+              'new_max_error_s': float(numpy.abs(new_drift).max())}
+    print(f"{n_trials} trials: {result['old_writes']} -> {result['new_writes']} register writes, "
+          f"drift at the end {result['old_drift_s']:.2f} s -> {result['new_drift_s'] * 1000:.3f} ms")
+    return result
+
+
+if __name__ == "__main__":
+    benchmark_engine()
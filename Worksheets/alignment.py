@@ -0,0 +1,175 @@
+# Alignment of the planned trial sequence with the recorded markers
+# The experiment sends trigcode 0 - 4 per trial, the amplifier records other codes (S  4, S 16, ...).
+# Recorded markers are placed on the trial grid from their intervals (round(interval / soa) trials,
+# 0 = extra trigger, long gaps start a new block, e.g. the pauses). Each block is then matched against the
+# planned sequence for all offsets and all code mappings at once: per (planned code, recorded code) pair
+# one FFT cross-correlation of indicator arrays gives the matches at every offset. The result lists the
+# code mapping, dropped and extra triggers, wrong codes and the onset delta of every trial in samples.
+import itertools
+import numpy
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from markers import read_markers, marker_types
+
+
+def load_plan(file):
+    # planned codes and onsets (s) from a timing file of the experiment (TrialTimer.save),
+    # or codes only from a text file with one code per line
+    file = Path(file)
+    if file.suffix == '.npz':
+        with numpy.load(file) as saved:
+            return saved['codes'].astype(int), saved['planned'] / 1e9, float(saved['soa'])
+    return numpy.loadtxt(file, dtype=int, ndmin=1), None, None
+
+
+def stimulus_markers(markers):
+    # (samples, codes) of the stimulus markers of a Markers object or a .vmrk file
+    if not hasattr(markers, 'markers'):
+        markers = read_markers(markers)
+    stimulus = markers.markers[markers.markers['type'] == marker_types.index('Stimulus')]
+    return stimulus['sample'].astype(int), stimulus['code'].astype(int)
+
+
+def trial_grid(samples, soa_samples, max_gap=4.5):
+    # trial number of every marker relative to the start of its block, block number, and extra flags
+    steps = numpy.rint(numpy.diff(samples) / soa_samples).astype(int)
+    new_block = numpy.concatenate([[True], numpy.diff(samples) > max_gap * soa_samples])
+    extra = numpy.concatenate([[False], (steps == 0) & ~new_block[1:]])
+    steps = numpy.concatenate([[0], numpy.where(new_block[1:], 0, steps)])
+    block = numpy.cumsum(new_block) - 1
+    position = numpy.cumsum(steps)
+    position -= position[numpy.flatnonzero(new_block)][block]
+    return position, block, extra
+
+
+def _match_counts(planned, positions, codes, planned_values, recorded_values):
+    # (planned values x recorded values x offsets) number of markers whose code pair matches when the
+    # block starts at planned trial `offset` (0 ... n_planned - 1, the end of a block may run past the plan)
+    n_planned, length = len(planned), positions.max() + 1
+    n_fft = 1 << int(numpy.ceil(numpy.log2(n_planned + length)))
+    planned_onehot = (planned == numpy.array(planned_values)[:, None]).astype(float)
+    recorded_onehot = numpy.zeros((len(recorded_values), length))
+    for index, value in enumerate(recorded_values):
+        recorded_onehot[index, positions[codes == value]] = 1
+    spectra = numpy.fft.rfft(planned_onehot, n_fft)[:, None] * numpy.conj(numpy.fft.rfft(recorded_onehot, n_fft))[None]
+    return numpy.rint(numpy.fft.irfft(spectra, n_fft)[..., :n_planned]).astype(int)
+
+
+class Alignment:
+
+    def __init__(self, planned, samples, codes, code_map, trial, extra, delta, offsets):
+        self.planned = planned
+        self.samples = samples
+        self.codes = codes
+        self.code_map = code_map  # recorded code -> planned code
+        self.trial = trial        # planned trial of every recorded marker, -1 for extra triggers
+        self.extra = extra
+        self.delta = delta        # onset - expected onset in samples, nan for extra triggers
+        self.offsets = offsets    # first planned trial of every block
+
+    def __repr__(self):
+        summary = self.summary()
+        return (f"<Alignment | {summary['n_matched']} of {summary['n_recorded']} markers matched, "
+                f"{summary['n_dropped']} dropped, {summary['n_extra']} extra, {summary['n_wrong_code']} wrong codes>")
+
+    @property
+    def matched(self):
+        mapped = numpy.array([self.code_map.get(code, -1) for code in self.codes.tolist()])
+        return ~self.extra & (self.planned[numpy.maximum(self.trial, 0)] == mapped)
+
+    @property
+    def wrong_code(self):
+        return numpy.flatnonzero(~self.extra & ~self.matched)
+
+    @property
+    def dropped(self):
+        # planned trials between the first and the last recorded one without a marker
+        aligned = self.trial[~self.extra]
+        if not len(aligned):
+            return numpy.zeros(0, dtype=int)
+        missing = numpy.ones(len(self.planned), dtype=bool)
+        missing[aligned] = False
+        trials = numpy.arange(len(self.planned))
+        return trials[missing & (trials > aligned.min()) & (trials < aligned.max())]
+
+    def trial_delta(self):
+        # onset delta per planned trial (nan where no marker was recorded)
+        delta = numpy.full(len(self.planned), numpy.nan)
+        delta[self.trial[~self.extra]] = self.delta[~self.extra]
+        return delta
+
+    def summary(self):
+        valid = self.delta[~numpy.isnan(self.delta)]
+        return {'n_planned': len(self.planned), 'n_recorded': len(self.codes), 'n_matched': int(self.matched.sum()),
+                'n_dropped': len(self.dropped), 'n_extra': int(self.extra.sum()),
+                'n_wrong_code': len(self.wrong_code), 'n_blocks': len(self.offsets),
+                'first_trial': int(self.trial[~self.extra].min()) if (~self.extra).any() else -1,
+                'code_map': self.code_map,
+                'delta_samples': {'median': float(numpy.median(valid)), 'max': float(numpy.abs(valid).max())}
+                if len(valid) else {}}
+
+
+def align(planned, samples, codes, sfreq, soa=0.5, planned_onsets=None, code_map=None, max_gap=4.5):
+    # planned: stimulus codes per trial (0 - 4), samples / codes: recorded stimulus markers;
+    # code_map {recorded: planned} is inferred when not given; planned_onsets (s, e.g. from load_plan)
+    # give the expected onset of every trial, otherwise trials are expected every soa s within a block
+    planned, samples, codes = numpy.asarray(planned), numpy.asarray(samples), numpy.asarray(codes)
+    soa_samples = soa * sfreq
+    position, block, extra = trial_grid(samples, soa_samples, max_gap)
+    planned_values = numpy.unique(planned).tolist()
+    recorded_values = numpy.unique(codes).tolist()
+    blocks = [numpy.flatnonzero((block == index) & ~extra) for index in range(block.max() + 1)]
+    counts = [_match_counts(planned, position[markers], codes[markers], planned_values, recorded_values)
+              for markers in blocks]
+
+    if code_map is None:  # best injective mapping, scored over all blocks at their best offsets;
+        # with more recorded than planned codes the rarest recorded ones stay unmapped
+        frequent = numpy.argsort([-(codes == code).sum() for code in recorded_values], kind='stable')
+        frequent = frequent[:len(planned_values)]
+        candidates = numpy.array(list(itertools.permutations(range(len(planned_values)), len(frequent))))
+        scores = sum(count[candidates, frequent].sum(axis=1).max(axis=1) for count in counts)
+        best = candidates[scores.argmax()]
+        code_map = {recorded_values[code]: planned_values[index] for code, index in zip(frequent, best)}
+    mapped = numpy.array([planned_values.index(code_map[code]) if code_map.get(code) in planned_values else -1
+                          for code in recorded_values])
+    known = mapped >= 0
+    offsets = numpy.array([count[mapped[known], numpy.flatnonzero(known)].sum(axis=0).argmax() for count in counts])
+
+    trial = offsets[block] + position
+    outside = trial >= len(planned)  # blocks that run past the end of the plan
+    trial = numpy.where(outside, 0, trial)
+    times = planned_onsets if planned_onsets is not None else numpy.arange(len(planned)) * soa
+    delta = samples - (times[trial] - times[offsets[block]]) * sfreq
+    for index in range(len(offsets)):  # anchor every block at its median offset
+        in_block = (block == index) & ~extra & ~outside
+        if in_block.any():
+            delta[block == index] -= numpy.median(delta[in_block])
+
+    # of several markers on one trial keep the one with the planned code and the smallest delta
+    wrong = numpy.array([code_map.get(code, -1) for code in codes.tolist()]) != planned[trial]
+    order = numpy.lexsort((numpy.abs(delta), wrong, outside, trial))
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = trial[order][1:] != trial[order][:-1]
+    extra = numpy.ones(len(codes), dtype=bool)
+    extra[order[first]] = False
+    extra |= outside
+    return Alignment(planned, samples, codes, code_map, numpy.where(extra, -1, trial), extra,
+                     numpy.where(extra, numpy.nan, delta), offsets)
+
+
+def align_files(plan_file, vmrk_file, sfreq=500., soa=None, code_map=None, max_gap=4.5):
+    # align(...) for a timing file (or code list) of the experiment and the .vmrk file of the recording
+    planned, planned_onsets, saved_soa = load_plan(plan_file)
+    samples, codes = stimulus_markers(vmrk_file)
+    return align(planned, samples, codes, sfreq, soa or saved_soa or 0.5, planned_onsets, code_map, max_gap)
+
+
+def _align_summary(arguments):
+    plan_file, vmrk_file, kwargs = arguments
+    return align_files(plan_file, vmrk_file, **kwargs).summary()
+
+
+def align_sessions(sessions, n_jobs=None, **kwargs):
+    # sessions: [(plan file, vmrk file), ...] -> list of summaries, sessions in a process pool
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return list(pool.map(_align_summary, [(plan, vmrk, kwargs) for plan, vmrk in sessions], chunksize=8))
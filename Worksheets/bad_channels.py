@@ -0,0 +1,118 @@
+# Automated bad channel detection
+# One streaming pass over the recording, all channels at once, chunk by chunk. Per chunk we keep a few
+# numbers per channel (amplitude, correlation with the montage neighbours, high-frequency noise ratio)
+# and track flat-line runs across chunk borders. Thresholds are applied to the stored score table
+# afterwards, so they can be tuned without reading the data again.
+import numpy
+import mne
+from chunks import source_n_times, read_chunk, iter_chunks
+from filtering import fft_filter
+
+default_thresholds = {
+    'deviation': 5.0,     # robust z-score of the channel amplitude
+    'correlation': 0.2,   # median correlation with the average of the normalised neighbours
+    'noise': 5.0,         # robust z-score of the high-frequency noise ratio
+    'flat': 5.0,          # longest flat run in seconds
+}
+
+
+def _robust_z(values):
+    median = numpy.median(values)
+    mad = numpy.median(numpy.abs(values - median)) * 1.4826
+    return (values - median) / (mad if mad > 0 else 1.)
+
+
+def neighbour_matrix(info, ch_names):
+    # row-normalised adjacency: neighbours @ data is the average of each channel's neighbours
+    adjacency, adjacency_names = mne.channels.find_ch_adjacency(info, 'eeg')
+    adjacency = adjacency.toarray().astype(float)
+    order = [adjacency_names.index(name) for name in ch_names]
+    adjacency = adjacency[numpy.ix_(order, order)]
+    numpy.fill_diagonal(adjacency, 0)
+    counts = adjacency.sum(axis=1, keepdims=True)
+    return numpy.divide(adjacency, counts, out=numpy.zeros_like(adjacency), where=counts > 0)
+
+
+def _longest_runs(flat, carry):
+    # flat: (channels x samples) bool; carry: run length continuing from the previous chunk.
+    # returns the longest run inside the chunk and the run still open at its end
+    counts = numpy.cumsum(flat, axis=1)
+    resets = numpy.maximum.accumulate(numpy.where(flat, 0, counts), axis=1)
+    runs = counts - resets
+    before_first_break = numpy.logical_and.accumulate(flat, axis=1)
+    runs = runs + carry[:, None] * before_first_break
+    return runs.max(axis=1, initial=0), runs[:, -1] if runs.shape[1] else carry
+
+
+class ChannelScores:
+
+    def __init__(self, ch_names, sfreq, amplitude, correlation, noise, flat):
+        self.ch_names = list(ch_names)
+        self.amplitude = amplitude      # median over chunks of the band-passed standard deviation
+        self.correlation = correlation  # median over chunks of the correlation with the (normalised) neighbours
+        self.noise = noise              # median over chunks of the amplitude above h_freq / in the band
+        self.flat = flat / sfreq        # longest flat run in seconds
+
+    def table(self):
+        # one row per channel, ready to print or to turn into a DataFrame
+        return numpy.rec.fromarrays(
+            [numpy.array(self.ch_names), self.amplitude, _robust_z(self.amplitude), self.correlation,
+             self.noise, _robust_z(self.noise), self.flat],
+            names=['channel', 'amplitude', 'deviation', 'correlation', 'noise_ratio', 'noise', 'flat'])
+
+    def bads(self, thresholds=None):
+        thresholds = dict(default_thresholds, **(thresholds or {}))
+        table = self.table()
+        bad = ((numpy.abs(table['deviation']) > thresholds['deviation'])
+               | (table['correlation'] < thresholds['correlation'])
+               | (table['noise'] > thresholds['noise'])
+               | (table['flat'] > thresholds['flat']))
+        return [name for name, is_bad in zip(self.ch_names, bad) if is_bad]
+
+    def __repr__(self):
+        lines = [f"{'channel':>8} {'amp (µV)':>9} {'dev z':>6} {'corr':>5} {'noise z':>7} {'flat (s)':>8}"]
+        for row in self.table():
+            lines.append(f"{row['channel']:>8} {row['amplitude'] * 1e6:9.2f} {row['deviation']:6.1f} "
+                         f"{row['correlation']:5.2f} {row['noise']:7.1f} {row['flat']:8.2f}")
+        return '\n'.join(lines)
+
+
+def score_channels(raw, chunk_duration=10., l_freq=1., h_freq=40., flat_threshold=1e-9, exclude=()):
+    # one pass over raw (Raw with preload=False, BrainVisionMemmap, ...); needs a montage for the neighbours
+    info = raw.info
+    sfreq = info['sfreq']
+    ch_names = [name for name, ch_type in zip(info['ch_names'], info.get_channel_types())
+                if ch_type == 'eeg' and name not in exclude]
+    picks = [info['ch_names'].index(name) for name in ch_names]
+    neighbours = neighbour_matrix(info, ch_names)
+
+    amplitude, correlation, noise = [], [], []
+    longest = numpy.zeros(len(picks))
+    open_run = numpy.zeros(len(picks))
+    for start, stop in iter_chunks(source_n_times(raw), int(chunk_duration * sfreq)):
+        # one extra sample in front, so flat runs continue across chunk borders
+        values = read_chunk(raw, max(0, start - 1), stop, picks=picks)
+        chunk_longest, open_run = _longest_runs(numpy.abs(numpy.diff(values, axis=1)) <= flat_threshold, open_run)
+        longest = numpy.maximum(longest, chunk_longest)
+
+        data = values[:, 1:] if start > 0 else values
+        data = data - data.mean(axis=1, keepdims=True)
+        band = fft_filter(data, sfreq, l_freq=l_freq, h_freq=h_freq, transition=l_freq)
+        high = fft_filter(data, sfreq, l_freq=h_freq, transition=5.)
+        amplitude.append(band.std(axis=1))
+        noise.append(high.std(axis=1) / numpy.maximum(band.std(axis=1), 1e-20))
+        # neighbours scaled to unit amplitude, so one broken channel with a huge amplitude does not
+        # decorrelate all channels around it
+        average = neighbours @ (band / numpy.maximum(band.std(axis=1, keepdims=True), 1e-20))
+        norms = numpy.linalg.norm(band, axis=1) * numpy.linalg.norm(average, axis=1)
+        correlation.append(numpy.einsum('ct,ct->c', band, average) / numpy.maximum(norms, 1e-30))
+
+    return ChannelScores(ch_names, sfreq, numpy.median(amplitude, axis=0), numpy.median(correlation, axis=0),
+                         numpy.median(noise, axis=0), longest)
+
+
+def detect_bad_channels(raw, thresholds=None, **score_params):
+    # fills raw.info['bads'] and returns the score table for tuning the thresholds
+    scores = score_channels(raw, **score_params)
+    raw.info['bads'] = sorted(set(raw.info['bads']) | set(scores.bads(thresholds)), key=raw.ch_names.index)
+    return scores
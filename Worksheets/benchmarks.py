@@ -0,0 +1,428 @@
+# End-to-end benchmark suite
+# Runs the worksheet pipeline stage by stage on the bundled recordings (Data/EEG_data) and on synthetic
+# BrainVision recordings scaled along the number of channels, the duration and the number of trials, and
+# records per stage the wall-clock time and the peak memory: BrainVision load, rename (mapping.json) +
+# montage + FCz, filter, interpolation, re-reference, ICA fit and apply, epochs with rejection, joint
+# standard evokeds, the cluster test of worksheet 6 and spectral.fourier_transform.
+# Every recording runs in a fresh worker process (one at a time, so the runs do not compete for the CPU):
+# the times come from a first pass, the peak memory from a second pass under tracemalloc (numpy buffers
+# included, child processes of the cluster test not), next to the peak resident set size of the worker.
+# Results go to a JSON file (default Data/cache/benchmarks/results/<date>.json) with the machine and the
+# package versions; compare() prints the time and memory ratios between two such files.
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy
+import scipy
+import mne
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import pipeline
+from bad_channels import detect_bad_channels
+from cluster import cluster_test
+from evoked import EvokedAccumulator
+from ica_fitting import fit_ica, rng_argument
+from markers import read_markers, default_code_map
+from spectral import fourier_transform
+
+DIR = Path(__file__).resolve().parent.parent
+cache_dir = DIR / 'Data' / 'cache' / 'benchmarks'
+
+# pipeline parameters of the benchmark (pipeline.default_params with rejection and a shorter cluster test)
+benchmark_params = {
+    'filter': dict(pipeline.default_params['filter']),
+    'reference': dict(pipeline.default_params['reference']),
+    'ica': dict(pipeline.default_params['ica'], exclude=[0]),
+    'epochs': dict(pipeline.default_params['epochs'], reject={'eeg': 150e-6}, flat={'eeg': 1e-7}),
+    'cluster': {'deviant': 'dev_freq', 'threshold': {'start': .2, 'step': .2}, 'n_permutations': 100,
+                'n_jobs': None},
+    'fourier': {'duration': 10.},  # the helper is meant for short stretches of data, not whole recordings
+}
+
+# synthetic recordings along each axis: n_channels, duration (min), n_trials (None: trials every 0.5 s
+# over the whole recording)
+default_scales = {
+    'channels': [{'n_channels': n_channels, 'duration': 5.} for n_channels in (32, 64, 128)],
+    'duration': [{'n_channels': 64, 'duration': duration} for duration in (5., 30., 90.)],
+    'trials': [{'n_channels': 64, 'duration': 21., 'n_trials': n_trials} for n_trials in (300, 1200, 2400)],
+}
+
+stage_names = ['load', 'montage', 'filter', 'interpolate', 'reference', 'ica_fit', 'ica_apply', 'epochs',
+               'evokeds', 'cluster', 'fourier']
+
+
+def merged_params(params=None):
+    # benchmark_params with the stage parameters in params replaced, e.g. {'ica': {'max_samples': 30000}}
+    return {stage: dict(values, **(params or {}).get(stage, {})) for stage, values in benchmark_params.items()}
+
+
+def trial_codes(n_trials, seed=0):
+    # event ids as in the oddball experiment: 15 standards, then standards and deviants 2 - 5 alternating
+    codes = numpy.ones(n_trials, dtype=int)
+    codes[16::2] = numpy.random.default_rng(seed).integers(2, 6, len(codes[16::2]))
+    return codes
+
+
+def recorded_codes(event_ids, code_map=default_code_map):
+    # the codes the amplifier writes for these event ids (inverse of markers.default_code_map), so the
+    # epochs go through the same code_map as the real recordings
+    recorded = {event_id: code for code, event_id in code_map.items()}
+    return numpy.array([recorded[event_id] for event_id in event_ids])
+
+
+def write_vmrk(vmrk_file, data_file, samples, codes):
+    # BrainVision marker file: New Segment + one 'S  <code>' stimulus per trial (samples start at 0,
+    # codes as recorded)
+    lines = ['Brain Vision Data Exchange Marker File, Version 1.0', '', '[Common Infos]', 'Codepage=UTF-8',
+             f'DataFile={data_file}', '', '[Marker Infos]', 'Mk1=New Segment,,1,1,0']
+    lines += [f'Mk{index}=Stimulus,S{code:>3},{sample + 1},1,0'
+              for index, (sample, code) in enumerate(zip(samples, codes), start=2)]
+    Path(vmrk_file).write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+
+def write_vhdr(vhdr_file, ch_names, sfreq, resolution=0.1):
+    # header of an INT_16 multiplexed recording in µV
+    stem = Path(vhdr_file).stem
+    lines = ['Brain Vision Data Exchange Header File Version 1.0', '', '[Common Infos]', 'Codepage=UTF-8',
+             f'DataFile={stem}.eeg', f'MarkerFile={stem}.vmrk', 'DataFormat=BINARY',
+             'DataOrientation=MULTIPLEXED', f'NumberOfChannels={len(ch_names)}',
+             f'SamplingInterval={1e6 / sfreq:g}', '', '[Binary Infos]', 'BinaryFormat=INT_16', '',
+             '[Channel Infos]']
+    lines += [f'Ch{index}={name},,{resolution},µV' for index, name in enumerate(ch_names, start=1)]
+    Path(vhdr_file).write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+
+def synthetic_ch_names(n_channels, mapping_file=pipeline.default_params['raw']['mapping'],
+                       montage=pipeline.default_params['raw']['montage'],
+                       ref_channel=pipeline.default_params['raw']['ref_channel']):
+    # the recorded names ('1', '2', ... renamed by mapping.json), beyond the mapping the remaining
+    # positions of the montage
+    with open(mapping_file) as file:
+        mapping = json.load(file)
+    extra = [name for name in mne.channels.make_standard_montage(montage).ch_names
+             if name not in set(mapping.values()) | {ref_channel}]
+    ch_names = (list(mapping) + extra)[:n_channels]
+    if len(ch_names) < n_channels:
+        raise ValueError(f"The montage has positions for {len(ch_names)} channels, not {n_channels}.")
+    return ch_names
+
+
+def write_synthetic(vhdr_file, n_channels=64, duration=5., n_trials=None, sfreq=500., soa=0.5, seed=0,
+                    chunk_duration=60.):
+    # synthetic recording (duration in min) written chunk by chunk: background shared by the channels,
+    # white noise and drift per channel, blinks on the first two channels every ~4 s, an N1 in every trial
+    # and an MMN for deviants; returns the .vhdr path
+    vhdr_file = Path(vhdr_file)
+    vhdr_file.parent.mkdir(parents=True, exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+    n_times = int(duration * 60 * sfreq)
+    max_trials = int((duration * 60 - 2) / soa)
+    n_trials = max_trials if n_trials is None else n_trials
+    if n_trials > max_trials:
+        raise ValueError(f"{duration} min fit {max_trials} trials at an SOA of {soa} s, not {n_trials}.")
+    samples = numpy.rint((numpy.arange(n_trials) * soa + 1.) * sfreq).astype(int)
+    codes = trial_codes(n_trials, seed)
+    blinks = numpy.cumsum(rng.uniform(2., 6., int(duration * 60 / 2) + 1) * sfreq).astype(int)
+    times = numpy.arange(int(0.4 * sfreq)) / sfreq
+    n1 = -1.5 * numpy.exp(-(times - 0.1) ** 2 / (2 * 0.02 ** 2))  # µV
+    mmn = -2. * numpy.exp(-(times - 0.15) ** 2 / (2 * 0.03 ** 2))
+    blink = 150. * numpy.hanning(int(0.3 * sfreq))
+    weights = rng.uniform(0.3, 1., n_channels)[:, None]
+    mixing = rng.uniform(0., 0.5, (n_channels, 4))  # background sources shared by all channels
+    drift = numpy.zeros((n_channels, 1))
+    chunk_size = int(chunk_duration * sfreq)
+    with open(vhdr_file.with_suffix('.eeg'), 'wb') as file:
+        for start in range(0, n_times, chunk_size):
+            stop = min(n_times, start + chunk_size)
+            walk = drift + numpy.cumsum(rng.standard_normal((n_channels, stop - start)), axis=1) * 0.025
+            drift = walk[:, -1:]
+            data = rng.standard_normal((n_channels, stop - start)) * 5. + walk
+            data += mixing @ rng.standard_normal((len(mixing.T), stop - start)) * 10.
+            first, last = numpy.searchsorted(samples, [start - len(times) + 1, stop])  # trials in this chunk
+            for sample, code in zip(samples[first:last], codes[first:last]):
+                low, high = max(sample, start), min(sample + len(times), stop)
+                data[:, low - start:high - start] += weights * (n1 + (mmn if code > 1 else 0))[
+                    low - sample:high - sample]
+            for sample in blinks[(blinks > start - len(blink)) & (blinks < stop)]:
+                low, high = max(sample, start), min(sample + len(blink), stop)
+                data[:2, low - start:high - start] += blink[low - sample:high - sample]
+            numpy.clip(numpy.rint(data / 0.1), -32768, 32767).astype('<i2').T.tofile(file)
+    write_vhdr(vhdr_file, synthetic_ch_names(n_channels), sfreq)
+    write_vmrk(vhdr_file.with_suffix('.vmrk'), vhdr_file.with_suffix('.eeg').name, samples, recorded_codes(codes))
+    return vhdr_file
+
+
+def synthetic_recording(n_channels=64, duration=5., n_trials=None, sfreq=500., seed=0):
+    # cached under Data/cache/benchmarks/recordings, written on first use (v2: recorded stimulus codes)
+    trials = 'all' if n_trials is None else n_trials
+    vhdr_file = cache_dir / 'recordings' / f'synthetic_{n_channels}ch_{duration:g}min_{trials}trials_{seed}_v2.vhdr'
+    if not all(vhdr_file.with_suffix(suffix).exists() for suffix in ('.vhdr', '.eeg', '.vmrk')):
+        write_synthetic(vhdr_file, n_channels, duration, n_trials, sfreq, seed=seed)
+    return vhdr_file
+
+
+def with_markers(vhdr_file, work_dir, soa=0.5, seed=0):
+    # recordings without stimulus markers (blinks) get a copy of the header with trials every soa s
+    vhdr_file = Path(vhdr_file).resolve()  # the copy in work_dir points to the .eeg by its absolute path
+    if len(read_markers(vhdr_file.with_suffix('.vmrk')).events()):
+        return vhdr_file
+    raw = mne.io.read_raw_brainvision(vhdr_file, verbose=False)
+    sfreq, n_times = raw.info['sfreq'], raw.n_times
+    samples = numpy.arange(int(sfreq), n_times - int(sfreq), int(soa * sfreq))
+    copy = Path(work_dir) / vhdr_file.name
+    text = vhdr_file.read_text(encoding='utf-8')
+    copy.write_text(text.replace(f'DataFile={vhdr_file.stem}.eeg', f'DataFile={vhdr_file.with_suffix(".eeg")}'),
+                    encoding='utf-8')
+    write_vmrk(copy.with_suffix('.vmrk'), vhdr_file.with_suffix('.eeg'), samples,
+               recorded_codes(trial_codes(len(samples), seed)))
+    return copy
+
+
+def _stages(subject, params, work_dir):
+    # the benchmark stages as (name, function) in processing order; each function takes the state dict
+    # (vhdr_file, raw, ica, epochs) and updates it
+    raw_params = pipeline.default_params['raw']
+
+    def load(state):
+        state['raw'] = mne.io.read_raw_brainvision(state['vhdr_file'], preload=True, verbose=False)
+
+    def montage(state):
+        with open(raw_params['mapping']) as file:
+            mapping = json.load(file)
+        raw = state['raw']  # synthetic recordings with fewer channels have only part of the mapping
+        raw.rename_channels({name: mapping[name] for name in raw.ch_names if name in mapping})
+        raw.add_reference_channels(raw_params['ref_channel'])
+        raw.set_montage(mne.channels.make_standard_montage(raw_params['montage']))
+
+    def interpolate(state):
+        # the detected bad channels, two fixed ones when none are found so there is always something to
+        # interpolate
+        raw = state['raw']
+        detect_bad_channels(raw, exclude=[raw_params['ref_channel']])  # still flat before the re-reference
+        eeg = [raw.ch_names[pick] for pick in mne.pick_types(raw.info, eeg=True, exclude=[])]
+        bads = raw.info['bads'] or [eeg[len(eeg) // 4], eeg[len(eeg) // 2]]
+        pipeline.interpolate_stage(raw, {'bads': bads}, subject)
+
+    def ica_fit(state):
+        ica_params = params['ica']
+        if ica_params['max_samples'] is None:
+            ica = mne.preprocessing.ICA(n_components=ica_params['n_components'], method=ica_params['method'],
+                                        **{rng_argument: ica_params['random_state']})
+            ica.fit(state['raw'], verbose=False)
+        else:
+            ica, _ = fit_ica(state['raw'], ica_params['n_components'], ica_params['method'],
+                             ica_params['random_state'], max_samples=ica_params['max_samples'], l_freq=None)
+        ica.exclude = list(ica_params['exclude'])
+        state['ica'] = ica
+
+    def cluster(state):
+        # worksheet 6: dev_freq against its joint standard (standard and the other deviants)
+        epochs, deviant = state['epochs'], params['cluster']['deviant']
+        joint = EvokedAccumulator(epochs.info, epochs.times[0], len(epochs.times), epochs.event_id).joint_standard(
+            deviant)
+        X = [epochs[joint].get_data().transpose(0, 2, 1), epochs[deviant].get_data().transpose(0, 2, 1)]
+        adjacency, _ = mne.channels.find_ch_adjacency(epochs.info, 'eeg')
+        run_dir = tempfile.mkdtemp(dir=work_dir)
+        try:
+            cluster_test(X, adjacency, threshold=params['cluster']['threshold'],
+                         n_permutations=params['cluster']['n_permutations'], n_jobs=params['cluster']['n_jobs'],
+                         work_dir=run_dir, verbose=False)
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    def fourier(state):
+        sfreq = state['raw'].info['sfreq']
+        data = state['raw'].get_data(picks='eeg', stop=int(params['fourier']['duration'] * sfreq))
+        fourier_transform(data, sfreq, show=False, return_fourier=True)
+
+    return [
+        ('load', load),
+        ('montage', montage),
+        ('filter', lambda state: pipeline.filter_stage(state['raw'], params['filter'], subject)),
+        ('interpolate', interpolate),
+        ('reference', lambda state: pipeline.reference_stage(state['raw'], params['reference'], subject)),
+        ('ica_fit', ica_fit),
+        ('ica_apply', lambda state: state['ica'].apply(state['raw'], verbose=False)),
+        ('epochs', lambda state: state.update(epochs=pipeline.epochs_stage(state['raw'], params['epochs'], subject))),
+        ('evokeds', lambda state: pipeline.evokeds_stage(state['epochs'], {}, subject)),
+        ('cluster', cluster),
+        ('fourier', fourier),
+    ]
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+
+
+def _run_pass(subject, params, work_dir, stages, memory):
+    # one pass over the stages: {stage: seconds}, or with memory=True {stage: {peak_mb, rss_mb}} where
+    # peak_mb is the largest traced allocation during the stage above what was allocated before it;
+    # returns the final state as well (with 'error' when a stage failed)
+    state, result = {'vhdr_file': subject['vhdr']}, {}
+    for name, function in _stages(subject, params, work_dir):
+        if name not in stages:
+            continue
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            function(state)
+        except Exception as error:  # the later stages need this one, keep what was measured so far
+            state['error'] = f'{name}: {type(error).__name__}: {error}'
+            if memory:
+                tracemalloc.stop()
+            break
+        elapsed = time.perf_counter() - start
+        if memory:
+            result[name] = {'peak_mb': tracemalloc.get_traced_memory()[1] / 2 ** 20, 'rss_mb': _peak_rss_mb()}
+            tracemalloc.stop()
+        else:
+            result[name] = elapsed
+    return result, state
+
+
+def run_recording(vhdr_file, params=None, stages=None, memory=True, work_dir=None):
+    # all stages on one recording; stages: subset of stage_names in processing order (the earlier stages
+    # are needed as inputs, so e.g. ['epochs'] alone does not work)
+    params = merged_params(params)
+    stages = stage_names if stages is None else stages
+    work_dir = Path(work_dir or tempfile.mkdtemp(prefix='benchmark_'))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    subject = pipeline.subject_files(with_markers(vhdr_file, work_dir))
+    header = mne.io.read_raw_brainvision(subject['vhdr'], verbose=False)
+    times, state = _run_pass(subject, params, work_dir, stages, memory=False)
+    result = {'n_channels': len(header.ch_names), 'sfreq': header.info['sfreq'],
+              'duration_s': header.n_times / header.info['sfreq'],
+              'n_trials': len(read_markers(subject['vmrk']).events()),
+              'n_epochs': len(state['epochs']) if 'epochs' in state else None,
+              'stages': {name: {'seconds': seconds} for name, seconds in times.items()}}
+    if 'error' in state:
+        result['error'] = state['error']
+    del state
+    if memory and 'error' not in result:
+        peaks, _ = _run_pass(subject, params, work_dir, stages, memory=True)
+        for name, values in peaks.items():
+            result['stages'][name].update(values)
+    result['total_s'] = sum(values['seconds'] for values in result['stages'].values())
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+
+def _run_recording(arguments):
+    vhdr_file, params, stages, memory = arguments
+    with tempfile.TemporaryDirectory(prefix='benchmark_') as work_dir:
+        return run_recording(vhdr_file, params, stages, memory, work_dir)
+
+
+def bundled_recordings():
+    # name -> .vhdr of the recordings in Data/EEG_data (the .eeg may be missing, e.g. sub25_main1)
+    return {path.stem: path for path in sorted((DIR / 'Data' / 'EEG_data').glob('*.vhdr'))}
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=DIR, capture_output=True, text=True,
+                                timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': numpy.__version__, 'scipy': scipy.__version__,
+            'mne': mne.__version__, 'commit': commit}
+
+
+def run_suite(recordings=None, scales=None, axes=None, params=None, stages=None, memory=True, out_file=None):
+    # recordings: names in Data/EEG_data or .vhdr paths (default all bundled), scales: {axis: [synthetic
+    # recording parameters]} (default default_scales), axes: subset of the scale axes; every run goes to
+    # one row of results['runs'], failures included (error message, e.g. a missing .eeg or a worker that
+    # ran out of memory). Writes the JSON file and returns the results
+    bundled = bundled_recordings()
+    recordings = list(bundled) if recordings is None else recordings
+    scales = default_scales if scales is None else scales
+    axes = list(scales) if axes is None else axes
+    runs = [{'recording': Path(name).stem, 'kind': 'bundled', 'axis': None,
+             'vhdr': bundled.get(name, Path(name))} for name in recordings]
+    for axis in axes:
+        for scale in scales[axis]:
+            scale = dict({'n_trials': None, 'sfreq': 500.}, **scale)
+            name = (f"synthetic_{scale['n_channels']}ch_{scale['duration']:g}min_"
+                    f"{'all' if scale['n_trials'] is None else scale['n_trials']}trials")
+            runs.append({'recording': name, 'kind': 'synthetic', 'axis': axis, 'scale': scale})
+    results = {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'machine': machine_info(),
+               'params': merged_params(params),
+               'stages': stages or stage_names, 'memory': memory, 'runs': []}
+    pool = ProcessPoolExecutor(1, max_tasks_per_child=1)  # a fresh process for every recording
+    try:
+        for run in runs:
+            row = {key: value for key, value in run.items() if key not in ('vhdr', 'scale')}
+            row.update(run.get('scale', {}))
+            try:
+                vhdr_file = run['vhdr'] if run['kind'] == 'bundled' else synthetic_recording(
+                    run['scale']['n_channels'], run['scale']['duration'], run['scale']['n_trials'],
+                    run['scale']['sfreq'])
+                if not vhdr_file.with_suffix('.eeg').exists():
+                    raise FileNotFoundError(f"{vhdr_file.with_suffix('.eeg').name} is missing")
+                row.update(pool.submit(_run_recording, (vhdr_file, params, stages, memory)).result())
+            except BrokenProcessPool:
+                row['error'] = 'the worker process died (out of memory?)'
+                pool.shutdown(wait=False)
+                pool = ProcessPoolExecutor(1, max_tasks_per_child=1)
+            except Exception as error:
+                row['error'] = f'{type(error).__name__}: {error}'
+            results['runs'].append(row)
+            print_run(row)
+    finally:
+        pool.shutdown()
+    out_file = Path(out_file or cache_dir / 'results' / f"{results['created'].replace(':', '-')}.json")
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(out_file, 'w') as file:
+        json.dump(results, file, indent=1)
+    print(f"results written to {out_file}")
+    return results
+
+
+def print_run(row):
+    if 'stages' not in row:
+        print(f"{row['recording']}: {row['error']}")
+        return
+    print(f"{row['recording']}: {row['n_channels']} channels, {row['duration_s'] / 60:.1f} min, "
+          f"{row['n_trials']} trials ({row['n_epochs']} epochs kept), {row['total_s']:.1f} s, "
+          f"peak RSS {row['peak_rss_mb']:.0f} MB")
+    for name, values in row['stages'].items():
+        memory = f", peak {values['peak_mb']:8.1f} MB" if 'peak_mb' in values else ''
+        print(f"    {name:>11}: {values['seconds']:8.3f} s{memory}")
+    if 'error' in row:
+        print(f"    failed in {row['error']}")
+
+
+def compare(old_file, new_file):
+    # new / old time and peak memory per recording and stage of two run_suite files;
+    # returns {recording: {stage: {'seconds': ratio, 'peak_mb': ratio}}}
+    with open(old_file) as file:
+        old = {row['recording']: row for row in json.load(file)['runs'] if 'error' not in row}
+    with open(new_file) as file:
+        new = {row['recording']: row for row in json.load(file)['runs'] if 'error' not in row}
+    ratios = {}
+    for recording in [name for name in new if name in old]:
+        ratios[recording] = {}
+        print(recording)
+        for name, values in new[recording]['stages'].items():
+            before = old[recording]['stages'].get(name)
+            if before is None:
+                continue
+            ratios[recording][name] = {key: values[key] / before[key] for key in ('seconds', 'peak_mb')
+                                       if key in values and key in before and before[key]}
+            text = ', '.join(f'{key} x{ratio:.2f}' for key, ratio in ratios[recording][name].items())
+            print(f"    {name:>11}: {text}")
+    return ratios
+
+
+if __name__ == "__main__":
+    run_suite()
@@ -0,0 +1,160 @@
+# Memory-mapped BrainVision reader
+# mne.io.read_raw_brainvision(..., preload=True) converts the whole recording to float64.
+# Here the .eeg file stays on disk as an int16 (samples x channels) memmap; the resolution
+# from the header is only applied to the slices that are actually requested.
+# Renaming (mapping.json), montage and reference channels only touch the info, never the samples.
+import numpy
+import mne
+from pathlib import Path
+
+binary_formats = {'INT_16': numpy.int16, 'UINT_16': numpy.uint16, 'INT_32': numpy.int32,
+                  'IEEE_FLOAT_32': numpy.float32}
+unit_scales = {'V': 1., 'mV': 1e-3, 'µV': 1e-6, 'uV': 1e-6, 'nV': 1e-9}
+
+
+def read_vhdr(vhdr_file):
+    # parses the header into {section: {key: value}}, comments (;) are skipped
+    vhdr_file = Path(vhdr_file)
+    header, section = {}, None
+    with open(vhdr_file, encoding='utf-8', errors='replace') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith(';'):
+                continue
+            if line.startswith('['):
+                section = line.strip('[]')
+                header[section] = {}
+                if section == 'Comment':  # free text from here on
+                    break
+            elif '=' in line and section is not None:
+                key, value = line.split('=', 1)
+                header[section][key] = value
+    return header
+
+
+def parse_channels(header):
+    # returns channel names and the per-channel factor from integer units to volts
+    channel_infos = header['Channel Infos']
+    n_channels = int(header['Common Infos']['NumberOfChannels'])
+    names, scales = [], numpy.ones(n_channels)
+    for index in range(n_channels):
+        fields = channel_infos[f'Ch{index + 1}'].split(',')
+        fields = [field.replace('\\1', ',') for field in fields]
+        names.append(fields[0])
+        resolution = float(fields[2]) if len(fields) > 2 and fields[2] else 1.
+        unit = fields[3] if len(fields) > 3 and fields[3] else 'µV'
+        if unit not in unit_scales:
+            raise ValueError(f"Unknown unit {unit} for channel {fields[0]}.")
+        scales[index] = resolution * unit_scales[unit]
+    return names, scales
+
+
+class BrainVisionMemmap:
+
+    def __init__(self, vhdr_file):
+        self.vhdr_file = Path(vhdr_file)
+        self.header = read_vhdr(self.vhdr_file)
+        common = self.header['Common Infos']
+        if common.get('DataFormat', 'BINARY') != 'BINARY':
+            raise ValueError("Only BINARY BrainVision files can be memory-mapped.")
+        binary_format = self.header.get('Binary Infos', {}).get('BinaryFormat', 'INT_16')
+        if binary_format not in binary_formats:
+            raise ValueError(f"Unsupported BinaryFormat {binary_format}.")
+        self.eeg_file = self.vhdr_file.parent / common['DataFile']
+        self.vmrk_file = self.vhdr_file.parent / common['MarkerFile'] if 'MarkerFile' in common else None
+        names, self._scales = parse_channels(self.header)
+        sfreq = 1e6 / float(common['SamplingInterval'])
+        dtype = numpy.dtype(binary_formats[binary_format])
+        n_stored = len(names)
+        n_times = self.eeg_file.stat().st_size // (dtype.itemsize * n_stored)
+        orientation = common.get('DataOrientation', 'MULTIPLEXED')
+        if orientation == 'MULTIPLEXED':  # ch1,pt1, ch2,pt1 ... -> view as (channels x samples)
+            self._data = numpy.memmap(self.eeg_file, dtype=dtype, mode='r', shape=(n_times, n_stored)).T
+        elif orientation == 'VECTORIZED':
+            self._data = numpy.memmap(self.eeg_file, dtype=dtype, mode='r', shape=(n_stored, n_times))
+        else:
+            raise ValueError(f"Unsupported DataOrientation {orientation}.")
+        self.n_times = n_times
+        self.first_samp = 0
+        self.info = mne.create_info(names, sfreq, 'eeg', verbose=False)
+        self._n_stored = n_stored
+
+    def __repr__(self):
+        return (f"<BrainVisionMemmap | {self.eeg_file.name}, {len(self.ch_names)} x {self.n_times} "
+                f"({self.n_times / self.info['sfreq']:.1f} s), not loaded>")
+
+    @property
+    def ch_names(self):
+        return self.info['ch_names']
+
+    @property
+    def times(self):
+        return numpy.arange(self.n_times) / self.info['sfreq']
+
+    def _pick_indices(self, picks):
+        if picks is None:
+            return numpy.arange(len(self.ch_names))
+        if isinstance(picks, (str, int, numpy.integer)):
+            picks = [picks]
+        return numpy.array([self.ch_names.index(pick) if isinstance(pick, str) else int(pick)
+                            for pick in picks], dtype=int)
+
+    def get_data(self, picks=None, start=0, stop=None, units=None):
+        # scaled (channels x samples) float64 copy of the requested slice, in volts
+        # (or in `units` given as 'µV' etc.). Reference channels added later are zeros.
+        stop = self.n_times if stop is None else min(stop, self.n_times)
+        start = max(0, start)
+        picks = self._pick_indices(picks)
+        stored = picks < self._n_stored
+        out = numpy.zeros((len(picks), stop - start))
+        out[stored] = self._data[picks[stored], start:stop] * self._scales[picks[stored], None]
+        if units is not None:
+            out /= unit_scales[units]
+        return out
+
+    def get_raw_slice(self, picks=None, start=0, stop=None):
+        # unscaled integers; without picks this is a view on the memmap (no copy)
+        if picks is None and self._scales.shape[0] == self._n_stored:
+            return self._data[:, start:stop]
+        picks = self._pick_indices(picks)
+        if numpy.any(picks >= self._n_stored):
+            raise ValueError("Reference channels have no stored samples.")
+        return self._data[picks, start:stop]
+
+    def rename_channels(self, mapping):
+        mne.rename_channels(self.info, mapping)
+        return self
+
+    def set_montage(self, montage, **kwargs):
+        self.info.set_montage(montage, **kwargs)
+        return self
+
+    def add_reference_channels(self, ref_channels):
+        # like Raw.add_reference_channels: flat channels that read as zeros until re-referencing
+        if isinstance(ref_channels, str):
+            ref_channels = [ref_channels]
+        montage = self.info.get_montage()
+        bads = list(self.info['bads'])
+        self.info = mne.create_info(self.ch_names + list(ref_channels), self.info['sfreq'], 'eeg',
+                                    verbose=False)
+        self._scales = numpy.concatenate([self._scales, numpy.zeros(len(ref_channels))])
+        self.info['bads'] = bads
+        if montage is not None:
+            self.info.set_montage(montage, on_missing='ignore')
+        return self
+
+    def to_raw(self, picks=None, start=0, stop=None):
+        # materialise (part of) the recording as an mne RawArray
+        picks_idx = self._pick_indices(picks)
+        info = mne.pick_info(self.info, picks_idx) if picks is not None else self.info.copy()
+        return mne.io.RawArray(self.get_data(picks_idx, start, stop), info, first_samp=start, verbose=False)
+
+
+def read_raw_memmap(vhdr_file, mapping=None, montage=None):
+    # read_raw_memmap(f"{DIR}/Data/EEG_data/sub25_main1.vhdr", mapping=mapping, montage=montage)
+    raw = BrainVisionMemmap(vhdr_file)
+    if mapping is not None:
+        raw.rename_channels(mapping)
+    if montage is not None:
+        raw.set_montage(montage)
+    return raw
@@ -0,0 +1,24 @@
+# Helpers for reading recordings in blocks
+# A "source" is anything with get_data(picks=..., start=..., stop=...) and n_times
+# (an mne Raw loaded with preload=False, the memory-mapped reader) or a plain (channels x samples) array.
+import numpy
+
+
+def source_n_times(source):
+    if hasattr(source, 'n_times'):
+        return source.n_times
+    return numpy.shape(source)[-1]
+
+
+def read_chunk(source, start, stop, picks=None):
+    if hasattr(source, 'get_data'):
+        return source.get_data(picks=picks, start=start, stop=stop)
+    data = source[..., start:stop] if picks is None else source[picks, start:stop]
+    return numpy.asarray(data)
+
+
+def iter_chunks(n_times, chunk_size, start=0, stop=None):
+    # yields (start, stop) sample indices of consecutive blocks
+    stop = n_times if stop is None else min(stop, n_times)
+    for chunk_start in range(start, stop, chunk_size):
+        yield chunk_start, min(chunk_start + chunk_size, stop)
@@ -0,0 +1,127 @@
+# Parallel, resumable permutation cluster test
+# Runs the same test as mne.stats.spatio_temporal_cluster_test in worksheet 6, but splits the
+# permutations into shards with fixed seeds (shard i always draws the same permutations) that run in a
+# process pool. X and the adjacency are written once as .npy/.npz and memory-mapped by the workers
+# instead of being pickled to every process. Finished shards are kept on disk, so a run with 100
+# permutations can later be extended to 1000 or 10000 without redoing the first 100.
+import hashlib
+import inspect
+import json
+import pickle
+import tempfile
+import time
+import numpy
+import scipy.sparse
+import mne
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# newer mne versions renamed `seed` to `rng`
+seed_argument = 'rng' if 'rng' in inspect.signature(mne.stats.spatio_temporal_cluster_test).parameters else 'seed'
+
+
+def _hash_inputs(X, adjacency, threshold, tail, seed, shard_size):
+    digest = hashlib.sha1()
+    for x in X:
+        x = numpy.ascontiguousarray(x)
+        digest.update(str(x.shape).encode())
+        digest.update(x.tobytes())
+    if adjacency is not None:
+        adjacency = scipy.sparse.csr_matrix(adjacency)
+        digest.update(adjacency.indices.tobytes())
+        digest.update(adjacency.indptr.tobytes())
+    digest.update(json.dumps([threshold, tail, seed, shard_size], sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:16]
+
+
+def shard_seed(seed, shard):
+    # independent, reproducible seed for every shard
+    return int(numpy.random.SeedSequence([seed, shard]).generate_state(1)[0])
+
+
+def _run_shard(run_dir, n_groups, threshold, tail, n_permutations, seed):
+    X = [numpy.load(run_dir / f'X_{group}.npy', mmap_mode='r') for group in range(n_groups)]
+    adjacency_file = run_dir / 'adjacency.npz'
+    adjacency = scipy.sparse.load_npz(adjacency_file) if adjacency_file.exists() else None
+    # mne puts the observed statistic first in h0, the remaining entries are this shard's permutations
+    t_obs, clusters, _, h0 = mne.stats.spatio_temporal_cluster_test(
+        X, threshold=threshold, adjacency=adjacency, n_permutations=n_permutations + 1, tail=tail,
+        n_jobs=1, verbose=False, **{seed_argument: seed})
+    return t_obs, clusters, h0[1:]
+
+
+def _cluster_stats(t_obs, clusters, threshold, tail):
+    if isinstance(threshold, dict):  # TFCE: every point is its own "cluster"
+        stats = t_obs.ravel()
+    else:
+        stats = numpy.array([t_obs[cluster].sum() for cluster in clusters])
+    return numpy.abs(stats) if tail == 0 else stats
+
+
+def _p_values(stats, h0, tail):
+    if tail == -1:
+        return numpy.array([numpy.mean(h0 <= stat) for stat in stats])
+    if tail == 1:
+        return numpy.array([numpy.mean(h0 >= stat) for stat in stats])
+    return numpy.array([numpy.mean(numpy.abs(h0) >= abs(stat)) for stat in stats])
+
+
+def cluster_test(X, adjacency=None, threshold=None, n_permutations=1000, tail=0, seed=0, shard_size=50,
+                 n_jobs=None, work_dir=None, verbose=True):
+    # cluster_test(X, adjacency, threshold=dict(start=.2, step=.2), n_permutations=1000, work_dir=...)
+    # returns t_obs, clusters, cluster_pv, h0 like spatio_temporal_cluster_test
+    if work_dir is None:  # nothing to resume from later, the shards go to a directory removed afterwards
+        with tempfile.TemporaryDirectory(prefix='cluster_') as work_dir:
+            return cluster_test(X, adjacency, threshold, n_permutations, tail, seed, shard_size, n_jobs,
+                                work_dir, verbose)
+    key = _hash_inputs(X, adjacency, threshold, tail, seed, shard_size)
+    run_dir = Path(work_dir) / key
+    run_dir.mkdir(parents=True, exist_ok=True)
+    for group, x in enumerate(X):
+        if not (run_dir / f'X_{group}.npy').exists():
+            numpy.save(run_dir / f'X_{group}.npy', numpy.ascontiguousarray(x))
+    if adjacency is not None and not (run_dir / 'adjacency.npz').exists():
+        scipy.sparse.save_npz(run_dir / 'adjacency.npz', scipy.sparse.csr_matrix(adjacency))
+
+    n_shards = int(numpy.ceil((n_permutations - 1) / shard_size))
+    todo = [shard for shard in range(n_shards) if not (run_dir / f'h0_{shard:05d}.npy').exists()]
+    observed_file = run_dir / 'observed.pkl'
+    if verbose and len(todo) < n_shards:
+        print(f"Resuming from {run_dir}: {n_shards - len(todo)} of {n_shards} shards already done")
+
+    start = time.perf_counter()
+    done = 0
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = {pool.submit(_run_shard, run_dir, len(X), threshold, tail, shard_size,
+                               shard_seed(seed, shard)): shard for shard in todo}
+        for future in as_completed(futures):
+            shard = futures[future]
+            t_obs, clusters, h0 = future.result()
+            numpy.save(run_dir / f'h0_{shard:05d}.npy', h0)
+            if not observed_file.exists():
+                with open(observed_file, 'wb') as file:
+                    pickle.dump((t_obs, clusters), file)
+            done += 1
+            if verbose:
+                elapsed = time.perf_counter() - start
+                rate = done * shard_size / elapsed
+                remaining = (len(todo) - done) * shard_size / rate
+                print(f"shard {done}/{len(todo)}: {rate:.1f} permutations/s, ~{remaining:.0f} s left")
+
+    if not observed_file.exists():  # n_permutations <= 1, no shard has run
+        t_obs, clusters, _ = _run_shard(run_dir, len(X), threshold, tail, 1, seed)
+        with open(observed_file, 'wb') as file:
+            pickle.dump((t_obs, clusters), file)
+    with open(observed_file, 'rb') as file:
+        t_obs, clusters = pickle.load(file)
+
+    stats = _cluster_stats(t_obs, clusters, threshold, tail)
+    permuted = [numpy.load(run_dir / f'h0_{shard:05d}.npy') for shard in range(n_shards)]
+    permuted = numpy.concatenate(permuted)[:n_permutations - 1] if permuted else numpy.zeros(0)
+    if len(stats):
+        observed = stats.min() if tail == -1 else stats.max()
+    else:
+        observed = 0.
+    h0 = numpy.concatenate([[observed], permuted])
+    cluster_pv = _p_values(stats, h0, tail)
+    return t_obs, clusters, cluster_pv, h0
@@ -0,0 +1,243 @@
+# Compact epoch storage
+# An -epo.fif file has to be read completely before epochs['dev_freq'] can be selected. The store is a
+# directory with one data file per condition, split into chunks of a few channels each (channel-major:
+# channels x epochs x times), as float32 or int16 with a per-channel scale, optionally zlib-compressed
+# (bytes shuffled first, which compresses float data much better). Reading a few conditions or
+# channels only reads their chunks; uncompressed chunks are memory-mapped.
+import json
+import time
+import zlib
+import numpy
+import mne
+from pathlib import Path
+
+DIR = Path(__file__).resolve().parent.parent
+
+version = 1
+
+
+def _epochs_data(epochs, indices):
+    # (epochs x channels x times) of some epochs of an mne Epochs (preloaded or not) or StreamedEpochs
+    if isinstance(epochs, mne.BaseEpochs):
+        return epochs.get_data(item=indices, copy=False, verbose=False) if len(indices) else numpy.zeros(
+            (0, len(epochs.ch_names), len(epochs.times)))
+    return epochs.data[indices]
+
+
+def _encode(block, compression, level):
+    if compression is None:
+        return block.tobytes()
+    shuffled = numpy.ascontiguousarray(block).view(numpy.uint8).reshape(-1, block.itemsize).T
+    return zlib.compress(shuffled.tobytes(), level)
+
+
+def write_epoch_store(epochs, path, dtype='float32', compression='zlib', level=1, chunk_channels=8,
+                      overwrite=False):
+    # epochs: mne Epochs or epoching.StreamedEpochs; one condition is in memory at a time
+    path = Path(path)
+    if path.exists() and not overwrite:
+        raise FileExistsError(f"{path} exists, use overwrite=True.")
+    if dtype not in ('float32', 'int16'):
+        raise ValueError(f"dtype must be 'float32' or 'int16', not {dtype}.")
+    if compression not in (None, 'zlib'):
+        raise ValueError(f"compression must be None or 'zlib', not {compression}.")
+    path.mkdir(parents=True, exist_ok=True)
+    for old_file in path.glob('*.dat'):
+        old_file.unlink()
+    info = epochs.info
+    n_times = len(epochs.times)
+    mne.io.write_info(path / 'info.fif', info, overwrite=True, verbose=False)
+    numpy.save(path / 'events.npy', epochs.events)
+
+    conditions = {}
+    for name, event in epochs.event_id.items():
+        indices = numpy.flatnonzero(epochs.events[:, 2] == event)
+        data = numpy.asarray(_epochs_data(epochs, indices)).transpose(1, 0, 2)  # channels x epochs x times
+        scales = numpy.ones(len(data))
+        if dtype == 'int16':
+            scales = numpy.abs(data).max(axis=(1, 2), initial=0) / 32767
+            scales[scales == 0] = 1
+            data = numpy.rint(data / scales[:, None, None]).astype(numpy.int16)
+        else:
+            data = data.astype(numpy.float32)
+        chunks = []
+        with open(path / f'{len(conditions)}.dat', 'wb') as file:
+            for start in range(0, len(data), chunk_channels):
+                encoded = _encode(data[start:start + chunk_channels], compression, level)
+                chunks.append([file.tell(), len(encoded), min(chunk_channels, len(data) - start)])
+                file.write(encoded)
+        conditions[name] = {'file': f'{len(conditions)}.dat', 'event': int(event), 'indices': indices.tolist(),
+                            'chunks': chunks, 'scales': scales.tolist()}
+
+    meta = {'version': version, 'dtype': dtype, 'compression': compression, 'chunk_channels': chunk_channels,
+            'tmin': float(epochs.tmin), 'n_times': n_times, 'ch_names': list(info['ch_names']),
+            'conditions': conditions}
+    with open(path / 'meta.json', 'w') as file:
+        json.dump(meta, file)
+    return path
+
+
+class EpochStore:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / 'meta.json') as file:
+            self.meta = json.load(file)
+        self.ch_names = self.meta['ch_names']
+        self.conditions = list(self.meta['conditions'])
+        self.event_id = {name: condition['event'] for name, condition in self.meta['conditions'].items()}
+        self._info = None
+        self._events = None
+
+    def __repr__(self):
+        counts = ', '.join(f"'{name}': {len(condition['indices'])}"
+                           for name, condition in self.meta['conditions'].items())
+        return (f"<EpochStore | {counts}, {len(self.ch_names)} channels, {self.meta['dtype']}, "
+                f"{self.meta['compression'] or 'uncompressed'}>")
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = mne.io.read_info(self.path / 'info.fif', verbose=False)
+        return self._info
+
+    @property
+    def events(self):
+        if self._events is None:
+            self._events = numpy.load(self.path / 'events.npy')
+        return self._events
+
+    @property
+    def times(self):
+        return self.meta['tmin'] + numpy.arange(self.meta['n_times']) / self.info['sfreq']
+
+    def _picks(self, picks):
+        if picks is None:
+            return numpy.arange(len(self.ch_names))
+        if isinstance(picks, str) and picks not in self.ch_names:  # channel type, e.g. 'eeg'
+            return numpy.flatnonzero(numpy.array(self.info.get_channel_types()) == picks)
+        if isinstance(picks, str):
+            picks = [picks]
+        return numpy.array([self.ch_names.index(pick) if isinstance(pick, str) else pick for pick in picks])
+
+    def _conditions(self, conditions):
+        if conditions is None:
+            return self.conditions
+        return [conditions] if isinstance(conditions, str) else list(conditions)
+
+    def _read_chunk(self, condition, index):
+        offset, n_bytes, n_channels = condition['chunks'][index]
+        dtype = numpy.dtype(self.meta['dtype'])
+        shape = (n_channels, len(condition['indices']), self.meta['n_times'])
+        if self.meta['compression'] is None:
+            return numpy.memmap(self.path / condition['file'], dtype=dtype, mode='r', offset=offset, shape=shape)
+        with open(self.path / condition['file'], 'rb') as file:
+            file.seek(offset)
+            raw = zlib.decompress(file.read(n_bytes))
+        return numpy.frombuffer(raw, numpy.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(shape)
+
+    def _condition_data(self, name, picks):
+        condition = self.meta['conditions'][name]
+        chunk_channels = self.meta['chunk_channels']
+        out = numpy.empty((len(picks), len(condition['indices']), self.meta['n_times']), dtype=numpy.float32)
+        for chunk in numpy.unique(picks // chunk_channels):
+            in_chunk = numpy.flatnonzero(picks // chunk_channels == chunk)
+            block = self._read_chunk(condition, chunk)
+            out[in_chunk] = block[picks[in_chunk] - chunk * chunk_channels]
+        if self.meta['dtype'] == 'int16':
+            out *= numpy.array(condition['scales'], dtype=numpy.float32)[picks][:, None, None]
+        return out
+
+    def selection(self, conditions=None):
+        conditions = self._conditions(conditions)
+        return numpy.sort(numpy.concatenate([self.meta['conditions'][name]['indices'] for name in conditions]
+                                            + [[]]).astype(int))
+
+    def get_data(self, conditions=None, picks=None):
+        # (epochs x channels x times) float32 of the conditions, in the original epoch order;
+        # only the chunks of these conditions and channels are read
+        conditions = self._conditions(conditions)
+        picks = self._picks(picks)
+        parts = [self._condition_data(name, picks) for name in conditions]
+        indices = numpy.concatenate([self.meta['conditions'][name]['indices'] for name in conditions] + [[]])
+        order = numpy.argsort(indices, kind='stable')
+        data = numpy.concatenate(parts, axis=1) if parts else numpy.zeros((len(picks), 0, self.meta['n_times']))
+        return data[:, order].transpose(1, 0, 2)
+
+    def to_epochs(self, conditions=None, picks=None):
+        # mne.EpochsArray of some conditions / channels, e.g. store.to_epochs(['standard', 'dev_loud'], 'eeg')
+        picks = self._picks(picks)
+        selection = self.selection(conditions)
+        events = self.events[selection]
+        event_id = {name: event for name, event in self.event_id.items() if event in events[:, 2]}
+        return mne.EpochsArray(self.get_data(conditions, picks), mne.pick_info(self.info, picks), events=events,
+                               tmin=self.meta['tmin'], event_id=event_id, baseline=None, verbose=False)
+
+    def __getitem__(self, conditions):
+        return self.to_epochs(conditions)
+
+
+def epochs_to_store(fif_file, path=None, **store_params):
+    # MMN_1-epo.fif -> MMN_1-epo.store; the epochs are not preloaded
+    fif_file = Path(fif_file)
+    path = Path(path) if path else fif_file.with_suffix('.store')
+    epochs = mne.read_epochs(fif_file, preload=False, verbose=False)
+    return write_epoch_store(epochs, path, **store_params)
+
+
+def store_to_epochs(path, fif_file=None, conditions=None, picks=None):
+    # back to -epo.fif (all or some conditions / channels)
+    epochs = EpochStore(path).to_epochs(conditions, picks)
+    if fif_file is not None:
+        epochs.save(fif_file, overwrite=True, verbose=False)
+    return epochs
+
+
+def _size(path):
+    path = Path(path)
+    return sum(file.stat().st_size for file in path.iterdir()) if path.is_dir() else path.stat().st_size
+
+
+def benchmark_store(n_epochs=2000, n_channels=64, n_times=251, work_dir=None, seed=0):
+    # write / read of a synthetic recording: -epo.fif against the store in its variants,
+    # reading two conditions (dev_freq + the rest of the joint standard) and 9 channels;
+    # the files go to work_dir (default Data/cache/epoch_store_benchmark)
+    rng = numpy.random.default_rng(seed)
+    info = mne.create_info([f'EEG{index:03d}' for index in range(n_channels)], 500., 'eeg')
+    events = numpy.column_stack([numpy.arange(n_epochs) * 250, numpy.zeros(n_epochs, int),
+                                 rng.choice([1, 1, 1, 2, 3, 4, 5], n_epochs)])
+    event_id = {'standard': 1, 'dev_freq': 2, 'dev_loud': 3, 'dev_dur': 4, 'dev_loc': 5}
+    data = numpy.cumsum(rng.standard_normal((n_epochs, n_channels, n_times)), axis=2) * 1e-7
+    epochs = mne.EpochsArray(data, info, events=events, tmin=-0.1, event_id=event_id, verbose=False)
+    work_dir = Path(work_dir or DIR / 'Data' / 'cache' / 'epoch_store_benchmark')
+    work_dir.mkdir(parents=True, exist_ok=True)
+    megabytes = data.nbytes / 1e6
+    picks = info['ch_names'][:9]
+
+    results = {}
+    start = time.perf_counter()
+    epochs.save(work_dir / 'bench-epo.fif', overwrite=True, verbose=False)
+    write_s = time.perf_counter() - start
+    start = time.perf_counter()
+    mne.read_epochs(work_dir / 'bench-epo.fif', verbose=False)[['standard', 'dev_freq']].get_data(picks=picks)
+    read_s = time.perf_counter() - start
+    results['fif'] = {'write_MBps': megabytes / write_s, 'read_s': read_s,
+                      'size_MB': _size(work_dir / 'bench-epo.fif') / 1e6}
+    for dtype, compression in [('float32', None), ('float32', 'zlib'), ('int16', 'zlib')]:
+        name = f"{dtype}{'-' + compression if compression else ''}"
+        start = time.perf_counter()
+        write_epoch_store(epochs, work_dir / f'bench-{name}.store', dtype, compression, overwrite=True)
+        write_s = time.perf_counter() - start
+        start = time.perf_counter()
+        EpochStore(work_dir / f'bench-{name}.store').get_data(['standard', 'dev_freq'], picks)
+        read_s = time.perf_counter() - start
+        results[name] = {'write_MBps': megabytes / write_s, 'read_s': read_s,
+                         'size_MB': _size(work_dir / f'bench-{name}.store') / 1e6}
+    for name, result in results.items():
+        print(f"{name:>14}: write {result['write_MBps']:7.1f} MB/s, read 2 conditions x 9 channels "
+              f"{result['read_s'] * 1000:7.1f} ms, {result['size_MB']:6.1f} MB on disk")
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_store()
@@ -0,0 +1,138 @@
+# Streaming epoch extraction
+# mne.Epochs needs the raw data in memory and epochs.get_data() copies it again.
+# Here the events are walked in sample order, neighbouring windows are read from disk in one chunk,
+# baseline correction and peak-to-peak / flat rejection happen on the fly, and the kept epochs go
+# straight into a preallocated (n_epochs x channels x times) float32 array (or a .npy memmap).
+import numpy
+import mne
+from chunks import read_chunk
+
+
+class StreamedEpochs:
+
+    def __init__(self, data, events, event_id, info, tmin, drop_log):
+        self.data = data
+        self.events = events
+        self.event_id = event_id
+        self.info = info
+        self.tmin = tmin
+        self.drop_log = drop_log
+
+    def __len__(self):
+        return len(self.events)
+
+    def __repr__(self):
+        counts = ', '.join(f"'{name}': {numpy.sum(self.events[:, 2] == value)}"
+                           for name, value in self.event_id.items())
+        return f"<StreamedEpochs | {len(self)} epochs ({counts}), {self.data.shape[1]} channels>"
+
+    @property
+    def times(self):
+        return self.tmin + numpy.arange(self.data.shape[2]) / self.info['sfreq']
+
+    def selection(self, conditions):
+        if isinstance(conditions, str):
+            conditions = [conditions]
+        ids = [self.event_id[condition] for condition in conditions]
+        return numpy.flatnonzero(numpy.isin(self.events[:, 2], ids))
+
+    def __getitem__(self, conditions):
+        # data of one or more conditions, e.g. epochs['dev_freq'] or epochs[['standard', 'dev_loud']]
+        return self.data[self.selection(conditions)]
+
+    def to_mne(self):
+        return mne.EpochsArray(self.data, self.info, events=self.events, tmin=self.tmin,
+                               event_id=self.event_id, baseline=None, verbose=False)
+
+
+def _threshold_per_channel(info, picks, criteria):
+    # dict(eeg=100e-6) -> one threshold per picked channel (nan, i.e. never hit, for other types)
+    if not criteria:
+        return None
+    types = info.get_channel_types(picks=picks)
+    return numpy.array([criteria.get(channel_type, numpy.nan) for channel_type in types])
+
+
+def extract_epochs(raw, events, tmin, tmax, event_id=None, baseline=(None, 0), reject=None, flat=None,
+                   picks=None, chunk_size=50000, out_file=None, dtype=numpy.float32):
+    # same arguments as mne.Epochs(raw, events, tmin, tmax, event_id, baseline, reject=..., flat=...);
+    # `raw` can be a non-preloaded Raw, a BrainVisionMemmap or a (channels x samples) array
+    # (in that case pass raw=(array, info)).
+    if isinstance(raw, tuple):
+        raw, info = raw
+    else:
+        info = raw.info
+    sfreq = info['sfreq']
+    if picks is None:
+        picks = numpy.arange(len(info['ch_names']))
+    elif isinstance(picks[0], str):
+        picks = mne.pick_channels(info['ch_names'], picks, ordered=True)
+    else:
+        picks = numpy.asarray(picks)
+    first_samp = getattr(raw, 'first_samp', 0)
+    n_times_raw = raw.n_times if hasattr(raw, 'n_times') else raw.shape[-1]
+
+    events = numpy.asarray(events)
+    if event_id is None:
+        event_id = {str(value): int(value) for value in numpy.unique(events[:, 2])}
+    events = events[numpy.isin(events[:, 2], list(event_id.values()))]
+    events = events[numpy.argsort(events[:, 0], kind='stable')]
+
+    start_offset = int(round(tmin * sfreq))
+    n_times = int(round(tmax * sfreq)) - start_offset + 1
+    times = (start_offset + numpy.arange(n_times)) / sfreq
+    starts = events[:, 0] - first_samp + start_offset
+    stops = starts + n_times
+
+    baseline_mask = None
+    if baseline is not None:
+        low = times[0] if baseline[0] is None else baseline[0]
+        high = times[-1] if baseline[1] is None else baseline[1]
+        baseline_mask = (times >= low - 0.5 / sfreq) & (times <= high + 0.5 / sfreq)
+    reject_limits = _threshold_per_channel(info, picks, reject)
+    flat_limits = _threshold_per_channel(info, picks, flat)
+
+    if out_file is not None:
+        out = numpy.lib.format.open_memmap(out_file, mode='w+', dtype=dtype,
+                                           shape=(len(events), len(picks), n_times))
+    else:
+        out = numpy.empty((len(events), len(picks), n_times), dtype=dtype)
+    drop_log = [()] * len(events)
+    kept = numpy.zeros(len(events), dtype=bool)
+    n_kept = 0
+
+    index = 0
+    while index < len(events):
+        if starts[index] < 0 or stops[index] > n_times_raw:
+            drop_log[index] = ('TOO_SHORT',)  # mne's reason for windows past the data
+            index += 1
+            continue
+        # grow the chunk over all following epochs that still fit into chunk_size samples
+        last = index
+        while (last + 1 < len(events) and stops[last + 1] <= n_times_raw
+               and stops[last + 1] - starts[index] <= max(chunk_size, n_times)):
+            last += 1
+        chunk_start = starts[index]
+        chunk = read_chunk(raw, chunk_start, stops[last], picks=picks)
+        for epoch_index in range(index, last + 1):
+            offset = starts[epoch_index] - chunk_start
+            epoch = chunk[:, offset:offset + n_times]
+            if baseline_mask is not None:
+                epoch = epoch - epoch[:, baseline_mask].mean(axis=1, keepdims=True)
+            if reject_limits is not None or flat_limits is not None:
+                peak_to_peak = numpy.ptp(epoch, axis=1)
+                bad = numpy.zeros(len(picks), dtype=bool)
+                if reject_limits is not None:
+                    bad |= peak_to_peak > reject_limits
+                if flat_limits is not None:
+                    bad |= peak_to_peak < flat_limits
+                if bad.any():
+                    drop_log[epoch_index] = tuple(info['ch_names'][pick] for pick in picks[bad])
+                    continue
+            out[n_kept] = epoch
+            kept[epoch_index] = True
+            n_kept += 1
+        index = last + 1
+
+    return StreamedEpochs(out[:n_kept], events[kept], event_id, mne.pick_info(info, picks), times[0],
+                          tuple(drop_log))
@@ -0,0 +1,123 @@
+# Evokeds from sufficient statistics
+# Worksheets 5 and 6 build every joint standard with mne.concatenate_epochs and then average it,
+# which copies and sums the standard epochs once per deviant. Here each epoch is added once to
+# per-condition sums, sums of squares and counts; joint standards, MMN difference waves and their
+# standard errors are then just arithmetic on those statistics. New epochs can be added at any time.
+import numpy
+import mne
+from markers import event_dict
+
+
+class EvokedAccumulator:
+
+    def __init__(self, info, tmin, n_times, event_id=event_dict):
+        self.info = info
+        self.tmin = tmin
+        self.event_id = dict(event_id)
+        n_channels = len(info['ch_names'])
+        self.sums = {name: numpy.zeros((n_channels, n_times)) for name in self.event_id}
+        self.squares = {name: numpy.zeros((n_channels, n_times)) for name in self.event_id}
+        self.counts = {name: 0 for name in self.event_id}
+
+    @classmethod
+    def from_epochs(cls, epochs, event_id=None, batch_size=256):
+        # works with mne.Epochs and with epoching.StreamedEpochs
+        event_id = epochs.event_id if event_id is None else event_id
+        data = epochs.data if hasattr(epochs, 'data') else epochs.get_data()
+        accumulator = cls(epochs.info, epochs.times[0], data.shape[2], event_id)
+        for start in range(0, len(data), batch_size):
+            accumulator.update(data[start:start + batch_size], epochs.events[start:start + batch_size, 2])
+        return accumulator
+
+    def __repr__(self):
+        counts = ', '.join(f"'{name}': {count}" for name, count in self.counts.items())
+        return f"<EvokedAccumulator | {counts}>"
+
+    def update(self, data, labels):
+        # data: (n_epochs x channels x times), labels: event id of each epoch
+        data = numpy.asarray(data)
+        labels = numpy.asarray(labels)
+        for name, value in self.event_id.items():
+            selected = data[labels == value]
+            if len(selected):
+                selected = selected.astype(numpy.float64, copy=False)
+                self.sums[name] += selected.sum(axis=0)
+                self.squares[name] += numpy.einsum('ect,ect->ct', selected, selected)
+                self.counts[name] += len(selected)
+        return self
+
+    def merge(self, other):
+        # combine with an accumulator built on other epochs (e.g. another block or worker)
+        for name in self.event_id:
+            self.sums[name] += other.sums[name]
+            self.squares[name] += other.squares[name]
+            self.counts[name] += other.counts[name]
+        return self
+
+    def _pooled(self, conditions):
+        if isinstance(conditions, str):
+            conditions = [conditions]
+        count = sum(self.counts[name] for name in conditions)
+        if count == 0:
+            raise ValueError(f"No epochs for {conditions}.")
+        total = sum(self.sums[name] for name in conditions)
+        squares = sum(self.squares[name] for name in conditions)
+        return total, squares, count
+
+    def mean(self, conditions):
+        # average over the pooled epochs of one or more conditions (same as concatenate + average)
+        total, _, count = self._pooled(conditions)
+        return total / count
+
+    def sem(self, conditions):
+        total, squares, count = self._pooled(conditions)
+        if count < 2:
+            return numpy.full(total.shape, numpy.nan)
+        variance = (squares - total ** 2 / count) / (count - 1)
+        return numpy.sqrt(numpy.clip(variance, 0, None) / count)
+
+    def evoked(self, conditions, comment=None):
+        _, _, count = self._pooled(conditions)
+        comment = comment if comment is not None else ' + '.join(
+            [conditions] if isinstance(conditions, str) else conditions)
+        return mne.EvokedArray(self.mean(conditions), self.info, tmin=self.tmin, nave=count,
+                               comment=comment, verbose=False)
+
+    def _count(self, conditions):
+        return sum(self.counts.get(name, 0) for name in conditions)
+
+    def joint_standard(self, deviant, standard='standard'):
+        # "standard" plus all deviants except the current one, as in the worksheets
+        deviants = [name for name in self.event_id if name != standard]
+        return [standard] + [name for name in deviants if name != deviant]
+
+    def difference(self, deviant, standard='standard'):
+        # deviant - joint standard with its standard error, like combine_evoked(weights=[-1, 1])
+        joint = self.joint_standard(deviant, standard)
+        n_deviant = self.counts[deviant]
+        n_standard = sum(self.counts[name] for name in joint)
+        data = self.mean(deviant) - self.mean(joint)
+        error = numpy.sqrt(self.sem(deviant) ** 2 + self.sem(joint) ** 2)
+        nave = int(round(1 / (1 / n_deviant + 1 / n_standard)))
+        evoked = mne.EvokedArray(data, self.info, tmin=self.tmin, nave=nave,
+                                 comment=f"{deviant} - std_{deviant}", verbose=False)
+        return evoked, error
+
+    def joint_standard_evokeds(self, standard='standard'):
+        # same dict as the loop in worksheet 5: {'std_dev_freq': ..., 'dev_freq': ..., ...};
+        # deviants without epochs (e.g. all rejected) are left out, as in mmn_waves
+        evokeds = {}
+        for deviant in self.event_id:
+            joint = self.joint_standard(deviant, standard)
+            if deviant == standard or not self.counts[deviant]:
+                continue
+            if self._count(joint):
+                evokeds[f'std_{deviant}'] = self.evoked(joint, comment=f'std_{deviant}')
+            evokeds[deviant] = self.evoked(deviant)
+        return evokeds
+
+    def mmn_waves(self, standard='standard'):
+        # {'mmn_freq': (evoked, standard error), 'mmn_loud': ..., ...}
+        return {f"mmn_{deviant.split('_', 1)[-1]}": self.difference(deviant, standard)
+                for deviant in self.event_id if deviant != standard and self.counts[deviant]
+                and self._count(self.joint_standard(deviant, standard))}
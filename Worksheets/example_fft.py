@@ -3,27 +3,8 @@ import mne
 from pathlib import Path
 from matplotlib import pyplot as plt
 
-def fourier_transform(data, samplerate, show=True, xlim=None, axis=None, return_fourier=False):
-    nyquist = samplerate / 2
-    n_samples = len(data)
-    time = numpy.arange(0, n_samples) / n_samples
-    fourier = numpy.zeros(n_samples, dtype=complex)
-    frequencies = numpy.linspace(0, nyquist, int(n_samples / 2) + 1)
-    for frequency in range(n_samples):
-        sine_wave = numpy.exp(-1j * (2 * numpy.pi * frequency * time))
-        fourier[frequency] = numpy.sum(sine_wave * data)
-    fourier = fourier / n_samples
-    spectrum = numpy.abs(fourier)[:int(n_samples / 2) + 1] ** 2
-    if show:
-        if not axis:
-            fig, axis = plt.subplots(1, 1)
-            axis.plot(frequencies, spectrum)
-            axis.set_ylabel('Power (dB)')
-            axis.set_xlabel('Frequency (Hz)')
-        if xlim:
-            axis.set_xlim(xlim[0], xlim[1])
-    if return_fourier: return fourier, axis
-    else: return axis
+# fourier_transform lives in spectral.py (vectorized, also takes a channels x samples array)
+from spectral import fourier_transform
 
 
 # --- Exercise 1: Making waves --- #
@@ -190,4 +171,10 @@ fig, ax = plt.subplots(1, 1)
 ax.plot(time, reconstructed_data)
 ax.set_ylabel('Amplitude (mV)')
 ax.set_xlabel('Time (s)')
-ax.set_title('Filtered signal')
\ No newline at end of file
+ax.set_title('Filtered signal')
+
+# Extra: the same idea for a whole recording. filtering.py applies a tapered version of this
+# pass-band to all channels at once and streams the data through in overlap-add blocks:
+# from filtering import filter_raw
+# raw = mne.io.read_raw_brainvision(header_file, preload=False)
+# raw_filtered = filter_raw(raw, l_freq=1, h_freq=40, transition=1.0)
@@ -0,0 +1,101 @@
+# Frequency-domain band-pass filtering
+# Steps II and III of example_fft.py turned into a filter for whole recordings:
+# the brick-wall mask gets cosine-tapered edges, every channel is filtered at once
+# and long recordings stream through in overlap-add blocks.
+import numpy
+import mne
+from chunks import source_n_times, read_chunk, iter_chunks
+
+
+def passband(frequencies, l_freq=None, h_freq=None, transition=1.0):
+    # filter gain (0 - 1) at each frequency; the edges are half-cosine ramps
+    # `transition` Hz wide, centred on l_freq / h_freq. None leaves that side open.
+    frequencies = numpy.asarray(frequencies, dtype=float)
+    gain = numpy.ones_like(frequencies)
+    half_width = transition / 2
+    if l_freq is not None:
+        ramp = numpy.clip((frequencies - (l_freq - half_width)) / transition, 0, 1)
+        gain *= 0.5 - 0.5 * numpy.cos(numpy.pi * ramp)
+    if h_freq is not None:
+        ramp = numpy.clip(((h_freq + half_width) - frequencies) / transition, 0, 1)
+        gain *= 0.5 - 0.5 * numpy.cos(numpy.pi * ramp)
+    return gain
+
+
+def fft_filter(data, samplerate, l_freq=None, h_freq=None, transition=1.0):
+    # in-memory version of the worksheet: multiply the spectrum with the tapered
+    # mask and transform back, for all channels in one go
+    data = numpy.asarray(data)
+    n_samples = data.shape[-1]
+    frequencies = numpy.fft.rfftfreq(n_samples, 1 / samplerate)
+    fourier = numpy.fft.rfft(data, axis=-1)
+    fourier *= passband(frequencies, l_freq, h_freq, transition)
+    return numpy.fft.irfft(fourier, n=n_samples, axis=-1)
+
+
+def design_kernel(samplerate, l_freq=None, h_freq=None, transition=1.0, n_taps=None):
+    # linear-phase FIR kernel with the tapered pass-band as frequency response
+    if n_taps is None:
+        n_taps = int(numpy.ceil(3.3 * samplerate / transition))  # Hamming-window rule of thumb
+    n_taps += 1 - n_taps % 2  # odd length -> integer group delay
+    frequencies = numpy.fft.rfftfreq(n_taps, 1 / samplerate)
+    kernel = numpy.fft.irfft(passband(frequencies, l_freq, h_freq, transition), n=n_taps)
+    kernel = numpy.roll(kernel, n_taps // 2) * numpy.hamming(n_taps)
+    return kernel
+
+
+def overlap_add_filter(source, kernel, block_size=None, picks=None, out=None, dtype=numpy.float64):
+    # convolves every channel of `source` with `kernel` block by block and compensates
+    # the kernel delay (zero-phase). Only one block plus the kernel tail is held in memory;
+    # `out` can be a numpy.memmap to keep the result on disk as well.
+    n_times = source_n_times(source)
+    n_taps = len(kernel)
+    delay = (n_taps - 1) // 2
+    if block_size is None:
+        block_size = max(8 * n_taps, 2 ** 14)
+    n_fft = int(2 ** numpy.ceil(numpy.log2(block_size + n_taps - 1)))
+    kernel_fourier = numpy.fft.rfft(kernel, n_fft)
+
+    tail = None
+    for start, stop in iter_chunks(n_times, block_size):
+        block = read_chunk(source, start, stop, picks=picks)
+        if out is None:
+            out = numpy.zeros((block.shape[0], n_times), dtype=dtype)
+        length = stop - start
+        filtered = numpy.fft.irfft(numpy.fft.rfft(block, n_fft, axis=-1) * kernel_fourier, n_fft, axis=-1)
+        filtered = filtered[:, :length + n_taps - 1]
+        if tail is not None:
+            filtered[:, :n_taps - 1] += tail
+        tail = filtered[:, length:].copy()
+        _write_shifted(out, filtered[:, :length], start - delay)
+    _write_shifted(out, tail[:, :delay], n_times - delay)
+    return out
+
+
+def _write_shifted(out, values, position):
+    # write values to out[:, position:...], dropping whatever falls before sample 0
+    skip = max(0, -position)
+    position = max(0, position)
+    values = values[:, skip:]
+    out[:, position:position + values.shape[1]] = values
+
+
+def filter_raw(raw, l_freq=None, h_freq=None, transition=1.0, n_taps=None, block_size=None,
+               out_file=None):
+    # filters a (not preloaded) Raw or memory-mapped recording and returns a RawArray.
+    # With out_file the samples are written to a float64 memmap instead of RAM.
+    n_times = source_n_times(raw)
+    n_channels = len(raw.info['ch_names'])
+    kernel = design_kernel(raw.info['sfreq'], l_freq, h_freq, transition, n_taps)
+    out = None
+    if out_file is not None:
+        out = numpy.lib.format.open_memmap(out_file, mode='w+', dtype=numpy.float64,
+                                           shape=(n_channels, n_times))
+    out = overlap_add_filter(raw, kernel, block_size=block_size, out=out)
+    info = raw.info.copy()
+    with info._unlock():
+        if l_freq is not None:
+            info['highpass'] = l_freq
+        if h_freq is not None:
+            info['lowpass'] = h_freq
+    return mne.io.RawArray(out, info, first_samp=getattr(raw, 'first_samp', 0), copy='auto', verbose=False)
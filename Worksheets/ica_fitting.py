@@ -0,0 +1,153 @@
+# Fast ICA fitting
+# Worksheet 4 fits ICA on the whole continuous recording and refits it for every reference scheme.
+# Here the fit runs on a bounded number of samples (random segments or decimation of the high-passed
+# data), fitted ICAs are cached on disk under a hash of the fitted samples and parameters (the exclude
+# list is stored with them), and reference variants reuse a fit through a transformed mixing matrix.
+import hashlib
+import inspect
+import json
+import numpy
+import mne
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from chunks import source_n_times, read_chunk
+from filtering import fft_filter
+from referencing import reference_matrix
+from psd import welch_psd
+
+# newer mne versions renamed `random_state` to `rng`
+rng_argument = 'rng' if 'rng' in inspect.signature(mne.preprocessing.ICA).parameters else 'random_state'
+
+
+def subsample(raw, max_samples=30000, segment_length=2.0, decim=None, l_freq=1.0, pad=2.0, random_state=97):
+    # returns a RawArray with at most max_samples samples: either every decim-th sample (decim is raised
+    # when that would give more than max_samples) or randomly placed segments of segment_length s. Each
+    # segment is high-passed with some padding around it, so the full recording never has to be filtered
+    # or loaded.
+    sfreq = raw.info['sfreq']
+    n_times = source_n_times(raw)
+    if decim is not None:
+        if max_samples is not None:
+            decim = max(decim, -(-n_times // max_samples))
+        step = decim * (100000 // decim)  # chunks that keep the decimation grid
+        data = numpy.concatenate([_filtered(raw, start, min(start + step, n_times), sfreq, l_freq, pad)[:, ::decim]
+                                  for start in range(0, n_times, step)], axis=1)
+        info = raw.info.copy()
+        with info._unlock():
+            info['sfreq'] = sfreq / decim
+        return mne.io.RawArray(data, info, verbose=False)
+    length = int(segment_length * sfreq)
+    n_segments = min(max(1, max_samples // length), n_times // length)
+    if n_segments == n_times // length:
+        starts = numpy.arange(n_segments) * length
+    else:
+        rng = numpy.random.default_rng(random_state)
+        starts = numpy.sort(rng.choice(n_times // length, n_segments, replace=False)) * length
+    data = numpy.concatenate([_filtered(raw, start, start + length, sfreq, l_freq, pad) for start in starts], axis=1)
+    return mne.io.RawArray(data, raw.info.copy(), verbose=False)
+
+
+def _filtered(raw, start, stop, sfreq, l_freq, pad):
+    if l_freq is None:
+        return read_chunk(raw, start, stop)
+    padding = int(pad * sfreq)
+    padded_start = max(0, start - padding)
+    padded = read_chunk(raw, padded_start, min(source_n_times(raw), stop + padding))
+    filtered = fft_filter(padded - padded.mean(axis=1, keepdims=True), sfreq, l_freq=l_freq, transition=l_freq)
+    return filtered[:, start - padded_start:start - padded_start + stop - start]
+
+
+def fit_ica(raw, n_components=15, method='fastica', random_state=97, max_samples=30000, segment_length=2.0,
+            decim=None, l_freq=1.0, cache_dir=None, picks='eeg'):
+    # returns (ica, cache file); a second call with the same data and parameters just reads the file
+    fit_data = subsample(raw, max_samples, segment_length, decim, l_freq, random_state=random_state)
+    params = dict(n_components=n_components, method=method, random_state=random_state, max_samples=max_samples,
+                  segment_length=segment_length, decim=decim, l_freq=l_freq, picks=picks)
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode())
+    digest.update(json.dumps(fit_data.ch_names).encode())
+    digest.update(fit_data.get_data().tobytes())
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = Path(cache_dir) / f'{digest.hexdigest()[:16]}-ica.fif'
+        if cache_file.exists():
+            return mne.preprocessing.read_ica(cache_file, verbose=False), cache_file
+    ica = mne.preprocessing.ICA(n_components=n_components, method=method, **{rng_argument: random_state})
+    ica.fit(fit_data, picks=picks, verbose=False)
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        ica.save(cache_file, overwrite=True, verbose=False)
+    return ica, cache_file
+
+
+def save_exclude(ica, cache_file, exclude):
+    # store the components picked in plot_sources / plot_components with the cached fit
+    ica.exclude = list(exclude)
+    ica.save(cache_file, overwrite=True, verbose=False)
+    return ica
+
+
+def _fit_file(raw_file, fit_params):
+    raw = mne.io.read_raw(raw_file, preload=False, verbose=False)
+    _, cache_file = fit_ica(raw, **fit_params)
+    return cache_file
+
+
+def fit_ica_parallel(raw_files, random_states=(97,), n_jobs=None, cache_dir='ica_cache', **fit_params):
+    # independent fits (subjects x random states) in a process pool; returns {(file, state): cache file}
+    jobs = [(str(raw_file), random_state) for raw_file in raw_files for random_state in random_states]
+    results = {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = {pool.submit(_fit_file, raw_file, dict(fit_params, random_state=random_state,
+                                                         cache_dir=cache_dir)): (raw_file, random_state)
+                   for raw_file, random_state in jobs}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+class ICAOperator:
+    # the fitted ICA as plain sensor-space matrices: sources = unmixing @ (data - mean),
+    # data = mixing @ sources (+ the part outside the n_components subspace)
+
+    def __init__(self, unmixing, mixing, mean, ch_names, exclude=()):
+        self.unmixing = unmixing
+        self.mixing = mixing
+        self.mean = mean
+        self.ch_names = list(ch_names)
+        self.exclude = list(exclude)
+
+    @classmethod
+    def from_ica(cls, ica):
+        n_components = ica.n_components_
+        pre_whitener = ica.pre_whitener_[:, 0]
+        components = ica.pca_components_[:n_components]
+        unmixing = ica.unmixing_matrix_ @ components / pre_whitener[None, :]
+        mixing = pre_whitener[:, None] * (components.T @ ica.mixing_matrix_)
+        return cls(unmixing, mixing, pre_whitener * ica.pca_mean_, ica.ch_names, ica.exclude)
+
+    def rereferenced(self, ref_channels='average'):
+        # same components for data in another reference, R @ data: the mixing matrix becomes
+        # R @ mixing and the unmixing unmixing @ pinv(R). This is exact when the ICA was fitted on
+        # average-referenced data (the channel mean the new reference discards carries no source).
+        matrix = reference_matrix(self.ch_names, ref_channels)
+        return ICAOperator(self.unmixing @ numpy.linalg.pinv(matrix), matrix @ self.mixing, matrix @ self.mean,
+                           self.ch_names, self.exclude)
+
+    def sources(self, data):
+        return self.unmixing @ (data - self.mean[:, None])
+
+    def apply(self, data, exclude=None):
+        # removes the excluded components from (channels x samples) data, e.g. one chunk at a time
+        exclude = self.exclude if exclude is None else list(exclude)
+        if not exclude:
+            return data.copy()
+        return data - self.mixing[:, exclude] @ (self.unmixing[exclude] @ (data - self.mean[:, None]))
+
+
+def component_psd(source, ica, fmin=0., fmax=numpy.inf, n_fft=1024, chunk_duration=60.):
+    # Welch PSD of the ICA components (e.g. for picking components in worksheet 4), computed chunk by chunk
+    # from the sensor data instead of ica.get_sources(raw)
+    operator = ICAOperator.from_ica(ica)
+    picks = [source.info['ch_names'].index(name) for name in operator.ch_names]
+    names = [f'ICA{index:03d}' for index in range(len(operator.unmixing))]
+    return welch_psd(source, fmin, fmax, n_fft, picks, chunk_duration, transform=operator.sources, names=names)
@@ -0,0 +1,153 @@
+# Stateful IIR filter bank
+# High-pass, low-pass, band-pass (Butterworth) and notch stages as one cascade of second-order sections.
+# Called with consecutive chunks (channels x samples) the bank carries the per-channel state, so chunk
+# k followed by chunk k + 1 gives the same samples as filtering both at once; all channels go through
+# one sosfilt call per chunk. zero_phase runs the same coefficients forwards and backwards over a whole
+# source chunk by chunk (same result as scipy.signal.sosfiltfilt, but memory bounded by the chunk size
+# plus the output, which can be a memmap).
+import numpy
+import scipy.signal
+import mne
+from chunks import source_n_times, read_chunk, iter_chunks
+
+stage_kinds = ('highpass', 'lowpass', 'bandpass', 'notch')
+
+
+def design_stage(kind, sfreq, frequency, order=4, quality=30.):
+    # second-order sections of one stage; frequency: cut-off (Hz), [low, high] for a band-pass,
+    # centre for a notch (width frequency / quality)
+    if kind == 'notch':
+        return scipy.signal.tf2sos(*scipy.signal.iirnotch(frequency, quality, fs=sfreq))
+    if kind not in stage_kinds:
+        raise ValueError(f"kind must be one of {stage_kinds}, not {kind}.")
+    return scipy.signal.butter(order, frequency, kind, fs=sfreq, output='sos')
+
+
+class FilterBank:
+
+    def __init__(self, sfreq, stages=(), initial='steady'):
+        # stages: (kind, frequency) or (kind, frequency, order / quality) tuples, applied in this order;
+        # initial='steady' starts in the steady state of the first sample (no step response), 'zero' at rest
+        if initial not in ('steady', 'zero'):
+            raise ValueError(f"initial must be 'steady' or 'zero', not {initial}.")
+        self.sfreq = sfreq
+        self.initial = initial
+        self.stages = []
+        self.sos = numpy.zeros((0, 6))
+        self.zi = None
+        for stage in stages:
+            self.add(*stage)
+
+    @classmethod
+    def from_params(cls, sfreq, l_freq=None, h_freq=None, notch=None, order=4, quality=30., initial='steady'):
+        # band-pass (or high- / low-pass when one edge is None) and notches at `notch` (Hz, e.g. [50, 100])
+        stages = []
+        if l_freq and h_freq:
+            stages.append(('bandpass', [l_freq, h_freq], order))
+        elif l_freq or h_freq:
+            stages.append(('highpass' if l_freq else 'lowpass', l_freq or h_freq, order))
+        stages += [('notch', float(frequency), quality) for frequency in numpy.atleast_1d(notch or [])]
+        return cls(sfreq, stages, initial)
+
+    def __repr__(self):
+        stages = ', '.join(f'{kind} {frequency}' for kind, frequency in self.stages) or 'no stages'
+        return f"<FilterBank | {stages}, {len(self.sos)} sections at {self.sfreq:g} Hz>"
+
+    def add(self, kind, frequency, parameter=None):
+        options = {} if parameter is None else {'quality' if kind == 'notch' else 'order': parameter}
+        self.sos = numpy.concatenate([self.sos, design_stage(kind, self.sfreq, frequency, **options)])
+        self.stages.append((kind, frequency))
+        self.reset()
+        return self
+
+    def reset(self):
+        # forget the state, the next chunk starts a new signal
+        self.zi = None
+
+    def _initial_state(self, first):
+        # (sections x channels x 2) state for a signal starting with the values `first` (channels x 1)
+        zi = scipy.signal.sosfilt_zi(self.sos)[:, None, :]
+        return zi * first[None] if self.initial == 'steady' else numpy.zeros((len(self.sos), len(first), 2))
+
+    def __call__(self, chunk):
+        # causal filtering of the next (channels x samples) chunk
+        chunk = numpy.asarray(chunk, dtype=float)
+        if not len(self.sos):
+            return chunk
+        if self.zi is None:
+            self.zi = self._initial_state(chunk[:, :1])
+        filtered, self.zi = scipy.signal.sosfilt(self.sos, chunk, axis=-1, zi=self.zi)
+        return filtered
+
+    def frequency_response(self, n_points=2048, zero_phase=False):
+        # frequencies and gain; zero_phase gives the gain of the forward-backward filter (squared)
+        frequencies, response = scipy.signal.sosfreqz(self.sos, n_points, fs=self.sfreq)
+        gain = numpy.abs(response)
+        return frequencies, gain ** 2 if zero_phase else gain
+
+    def filter_source(self, source, out=None, chunk_duration=60., picks=None):
+        # causal pass over a whole source (Raw, BrainVisionMemmap, array) chunk by chunk, from a fresh state
+        n_times = source_n_times(source)
+        self.reset()
+        for start, stop in iter_chunks(n_times, max(1, int(chunk_duration * self.sfreq))):
+            filtered = self(read_chunk(source, start, stop, picks))
+            if out is None:
+                out = numpy.zeros((len(filtered), n_times))
+            out[:, start:stop] = filtered
+        return out
+
+    def padlen(self):
+        # edge padding of scipy.signal.sosfiltfilt
+        return 3 * (2 * len(self.sos) + 1 - min((self.sos[:, 2] == 0).sum(), (self.sos[:, 5] == 0).sum()))
+
+    def zero_phase(self, source, out=None, chunk_duration=60., picks=None):
+        # forward-backward filtering of a whole source, chunk by chunk: the forward pass writes to out,
+        # the backward pass runs over out in reverse; the edges are padded with the odd extension and the
+        # passes start in the steady state, as in sosfiltfilt
+        n_times, padlen = source_n_times(source), self.padlen()
+        if not len(self.sos):  # no stages: a copy of the source, as __call__ returns the chunks unchanged
+            return self.filter_source(source, out, chunk_duration, picks)
+        if n_times <= padlen:
+            raise ValueError(f"The signal needs more than {padlen} samples.")
+        zi = scipy.signal.sosfilt_zi(self.sos)[:, None, :]
+        first = read_chunk(source, 0, padlen + 1, picks)
+        last = read_chunk(source, n_times - padlen - 1, n_times, picks)
+        left = 2 * first[:, :1] - first[:, padlen:0:-1]
+        right = 2 * last[:, -1:] - last[:, -2::-1]
+        if out is None:
+            out = numpy.zeros((len(first), n_times))
+        chunks = list(iter_chunks(n_times, max(1, int(chunk_duration * self.sfreq))))
+
+        _, state = scipy.signal.sosfilt(self.sos, left, axis=-1, zi=zi * left[:, :1])
+        for start, stop in chunks:
+            out[:, start:stop], state = scipy.signal.sosfilt(self.sos, read_chunk(source, start, stop, picks),
+                                                             axis=-1, zi=state)
+        tail, _ = scipy.signal.sosfilt(self.sos, right, axis=-1, zi=state)
+
+        _, state = scipy.signal.sosfilt(self.sos, tail[:, ::-1], axis=-1, zi=zi * tail[:, -1:])
+        for start, stop in reversed(chunks):
+            filtered, state = scipy.signal.sosfilt(self.sos, out[:, start:stop][:, ::-1], axis=-1, zi=state)
+            out[:, start:stop] = filtered[:, ::-1]
+        return out
+
+
+def filter_raw_iir(raw, l_freq=None, h_freq=None, notch=None, order=4, zero_phase=True, chunk_duration=60.,
+                   out_file=None):
+    # IIR counterpart of filtering.filter_raw for a (not preloaded) Raw or memory-mapped recording;
+    # with out_file the samples go to a float64 memmap instead of RAM
+    bank = FilterBank.from_params(raw.info['sfreq'], l_freq, h_freq, notch, order)
+    out = None
+    if out_file is not None:
+        out = numpy.lib.format.open_memmap(out_file, mode='w+', dtype=numpy.float64,
+                                           shape=(len(raw.info['ch_names']), source_n_times(raw)))
+    if zero_phase:
+        out = bank.zero_phase(raw, out, chunk_duration)
+    else:
+        out = bank.filter_source(raw, out, chunk_duration)
+    info = raw.info.copy()
+    with info._unlock():
+        if l_freq is not None:
+            info['highpass'] = l_freq
+        if h_freq is not None:
+            info['lowpass'] = h_freq
+    return mne.io.RawArray(out, info, first_samp=getattr(raw, 'first_samp', 0), copy='auto', verbose=False)
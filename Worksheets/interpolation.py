@@ -0,0 +1,133 @@
+# Cached bad channel interpolation
+# raw.interpolate_bads() recomputes the spherical-spline matrix every time, although for one montage the
+# matrix only depends on the electrode positions and on which channels are bad. Here the repair is one
+# (channels x channels) matrix, cached on disk per montage positions + sorted bad list, and applied
+# as a single multiply per chunk of data. mode='neighbours' is the cheaper neighbour average from the
+# "Extra" exercise in worksheet 2, as a sparse matrix built from find_ch_adjacency.
+import hashlib
+import numpy
+import scipy.sparse
+import mne
+from pathlib import Path
+from numpy.polynomial.legendre import legval
+from chunks import source_n_times, read_chunk
+
+DIR = Path(__file__).resolve().parent.parent
+
+
+def _spline_g(cosang, stiffness=4, n_terms=50):
+    factors = [(2 * n + 1) / (n ** stiffness * (n + 1) ** stiffness * 4 * numpy.pi) for n in range(1, n_terms + 1)]
+    return legval(cosang, [0] + factors)
+
+
+def spline_matrix(pos_from, pos_to, alpha=1e-5):
+    # spherical splines (Perrin et al., 1989), same as mne: maps good channels to the bad positions
+    pos_from = pos_from / numpy.linalg.norm(pos_from, axis=1, keepdims=True)
+    pos_to = pos_to / numpy.linalg.norm(pos_to, axis=1, keepdims=True)
+    n_from = len(pos_from)
+    g_from = _spline_g(pos_from @ pos_from.T)
+    g_from.flat[::n_from + 1] += alpha
+    g_to_from = _spline_g(pos_to @ pos_from.T)
+    system = numpy.block([[g_from, numpy.ones((n_from, 1))], [numpy.ones((1, n_from)), numpy.zeros((1, 1))]])
+    inverse = numpy.linalg.pinv(system)
+    return numpy.hstack([g_to_from, numpy.ones((len(pos_to), 1))]) @ inverse[:, :-1]
+
+
+def _eeg_picks(info):
+    return [index for index, ch_type in enumerate(info.get_channel_types()) if ch_type == 'eeg']
+
+
+def _cache_key(info, bads, mode, origin):
+    picks = _eeg_picks(info)
+    positions = numpy.array([info['chs'][index]['loc'][:3] for index in picks])
+    digest = hashlib.sha1(numpy.round(positions, 6).tobytes())
+    digest.update(numpy.round(numpy.asarray(origin, dtype=float), 6).tobytes())
+    digest.update(repr([info['ch_names'][index] for index in picks]).encode())
+    digest.update(repr((sorted(bads), mode)).encode())
+    return digest.hexdigest()[:16]
+
+
+def interpolation_operator(info, bads=None, mode='spline', origin='auto', cache_dir=None):
+    # (channels x channels) matrix M with repaired = M @ data: identity rows for good channels,
+    # interpolation weights over the good EEG channels for the bad ones
+    bads = sorted(info['bads'] if bads is None else bads)
+    if origin == 'auto':
+        origin = mne.bem.fit_sphere_to_headshape(info, units='m', verbose=False)[1]
+    cache_dir = Path(cache_dir or DIR / 'Data' / 'cache' / 'interpolation')
+    cache_file = cache_dir / f'{_cache_key(info, bads, mode, origin)}.npz'
+    if cache_file.exists():
+        return scipy.sparse.load_npz(cache_file).tocsr() if mode == 'neighbours' else numpy.load(cache_file)['matrix']
+
+    n_channels = len(info['ch_names'])
+    picks = _eeg_picks(info)
+    bad_idx = [index for index in picks if info['ch_names'][index] in bads]
+    good_idx = [index for index in picks if info['ch_names'][index] not in bads]
+    if mode == 'spline':
+        positions = numpy.array([info['chs'][index]['loc'][:3] for index in range(n_channels)]) - origin
+        matrix = numpy.eye(n_channels)
+        if bad_idx:
+            matrix[bad_idx] = 0
+            matrix[numpy.ix_(bad_idx, good_idx)] = spline_matrix(positions[good_idx], positions[bad_idx])
+    elif mode == 'neighbours':
+        adjacency, names = mne.channels.find_ch_adjacency(info, 'eeg')
+        adjacency = adjacency.tocsr()
+        rows, cols, values = [], [], []
+        for index in range(n_channels):
+            if index not in bad_idx:
+                rows += [index]
+                cols += [index]
+                values += [1.]
+                continue
+            row = names.index(info['ch_names'][index])
+            columns = adjacency.indices[adjacency.indptr[row]:adjacency.indptr[row + 1]]
+            neighbours = [info['ch_names'].index(names[column]) for column in columns]
+            neighbours = [neighbour for neighbour in neighbours if neighbour in good_idx and neighbour != index]
+            if not neighbours:
+                raise ValueError(f"{info['ch_names'][index]} has no good neighbours to average.")
+            rows += [index] * len(neighbours)
+            cols += neighbours
+            values += [1 / len(neighbours)] * len(neighbours)
+        matrix = scipy.sparse.csr_matrix((values, (rows, cols)), shape=(n_channels, n_channels))
+    else:
+        raise ValueError(f"Unknown mode {mode}, use 'spline' or 'neighbours'.")
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    if mode == 'neighbours':
+        scipy.sparse.save_npz(cache_file, matrix)
+    else:
+        numpy.savez(cache_file, matrix=matrix)
+    return matrix
+
+
+class InterpolatedView:
+    # Raw-like view (get_data / info / n_times) of a source with its bad channels repaired chunk by chunk
+
+    def __init__(self, source, bads=None, mode='spline', origin='auto', cache_dir=None):
+        self.source = source
+        self.matrix = interpolation_operator(source.info, bads, mode, origin, cache_dir)
+        self.info = source.info.copy()
+        self.info['bads'] = []
+        self.n_times = source_n_times(source)
+        self.first_samp = getattr(source, 'first_samp', 0)
+
+    def __repr__(self):
+        return f"<InterpolatedView | {len(self.info['ch_names'])} x {self.n_times}>"
+
+    def get_data(self, picks=None, start=0, stop=None):
+        repaired = self.matrix @ read_chunk(self.source, start, self.n_times if stop is None else stop)
+        if picks is None:
+            return repaired
+        if isinstance(picks, str):
+            picks = [picks]
+        return repaired[[self.info['ch_names'].index(pick) if isinstance(pick, str) else pick for pick in picks]]
+
+    def to_raw(self, start=0, stop=None):
+        return mne.io.RawArray(self.get_data(start=start, stop=stop), self.info, first_samp=start, verbose=False)
+
+
+def interpolate_raw(raw, bads=None, mode='spline', cache_dir=None):
+    # in-place replacement for raw.interpolate_bads(reset_bads=True) on a preloaded raw
+    matrix = interpolation_operator(raw.info, bads, mode, cache_dir=cache_dir)
+    raw._data[:] = matrix @ raw._data
+    raw.info['bads'] = []
+    return raw
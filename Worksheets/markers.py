@@ -0,0 +1,149 @@
+# Fast .vmrk marker loader
+# Parses BrainVision markers straight into a numpy structured array (sample, code, type),
+# without going through annotations and mne.events_from_annotations (no loaded raw needed).
+# The parse result is cached next to the .vmrk file and reused as long as the file's mtime is unchanged.
+import re
+import numpy
+from pathlib import Path
+
+marker_dtype = numpy.dtype([('sample', 'i4'), ('code', 'i2'), ('type', 'u1')])
+marker_types = ['Stimulus', 'Response', 'New Segment', 'Comment', 'SyncStatus', 'Other']
+marker_pattern = re.compile(r'^Mk\d+=([^,\r\n]*),([^,\r\n]*),(\d+)', re.MULTILINE)
+code_pattern = re.compile(r'(\d+)\s*$')
+
+# event_dict from worksheet 5
+event_dict = {
+    "standard": 1,
+    "dev_freq": 2,
+    "dev_loud": 3,
+    "dev_dur": 4,
+    "dev_loc": 5
+}
+
+# recorded stimulus codes of the oddball experiment -> event_dict ids: the amplifier receives trigger bit k
+# of the sound card as bit 2k + 2 (trigger 1 -> 4, 2 -> 16, 3 -> 20, 4 -> 64, 5 -> 68)
+default_code_map = {4: 1, 16: 2, 20: 3, 64: 4, 68: 5}
+
+_memory_cache = {}
+
+
+def parse_vmrk(vmrk_file):
+    with open(vmrk_file, encoding='utf-8', errors='replace') as file:
+        text = file.read()
+    entries = marker_pattern.findall(text)
+    markers = numpy.zeros(len(entries), dtype=marker_dtype)
+    for index, (marker_type, description, position) in enumerate(entries):
+        match = code_pattern.search(description)
+        markers[index] = (int(position) - 1,  # positions in the file start at 1, mne uses 0
+                          int(match.group(1)) if match else -1,
+                          marker_types.index(marker_type) if marker_type in marker_types else len(marker_types) - 1)
+    return markers
+
+
+def cache_file(vmrk_file):
+    return Path(str(vmrk_file) + '.npz')
+
+
+def read_markers(vmrk_file, use_cache=True, code_map=default_code_map, event_dict=event_dict):
+    # read_markers(f"{DIR}/Data/EEG_data/sub25_main1.vmrk")
+    vmrk_file = Path(vmrk_file)
+    mtime = vmrk_file.stat().st_mtime_ns
+    key = (str(vmrk_file.resolve()), mtime)
+    if use_cache and key in _memory_cache:
+        return Markers(_memory_cache[key], code_map=code_map, event_dict=event_dict)
+    markers = None
+    cached = cache_file(vmrk_file)
+    if use_cache and cached.exists():
+        with numpy.load(cached) as stored:
+            if int(stored['mtime']) == mtime:
+                markers = stored['markers']
+    if markers is None:
+        markers = parse_vmrk(vmrk_file)
+        if use_cache:
+            try:
+                numpy.savez(cached, markers=markers, mtime=numpy.int64(mtime))
+            except OSError:  # e.g. read-only data folder, keep the in-memory cache only
+                pass
+    _memory_cache[key] = markers
+    return Markers(markers, code_map=code_map, event_dict=event_dict)
+
+
+class Markers:
+    # code_map translates recorded codes to event ids (default_code_map for the oddball recordings);
+    # with code_map=None the recorded codes are used as event ids directly
+
+    def __init__(self, markers, code_map=default_code_map, event_dict=event_dict):
+        self.markers = markers
+        self.code_map = code_map
+        self.event_dict = dict(event_dict) if event_dict is not None else {}
+        stimulus = markers[markers['type'] == marker_types.index('Stimulus')]
+        order = numpy.argsort(stimulus['code'], kind='stable')
+        codes, starts = numpy.unique(stimulus['code'][order], return_index=True)
+        groups = numpy.split(stimulus['sample'][order], starts[1:])
+        self._index = dict(zip(codes.tolist(), groups))  # code -> sorted samples
+
+    def __len__(self):
+        return len(self.markers)
+
+    def __repr__(self):
+        counts = ', '.join(f"{code}: {len(samples)}" for code, samples in self._index.items())
+        return f"<Markers | {len(self)} markers, stimulus codes {{{counts}}}>"
+
+    @property
+    def codes(self):
+        return list(self._index)
+
+    def samples(self, condition):
+        # all onsets of a condition, given as recorded code or as event_dict name
+        if isinstance(condition, str):
+            self._check_codes()
+            event_id = self.event_dict[condition]
+            recorded = [code for code in self._index if self._event_id(code) == event_id]
+            if not recorded:
+                return numpy.zeros(0, dtype=marker_dtype['sample'])
+            if len(recorded) == 1:
+                return self._index[recorded[0]]
+            return numpy.sort(numpy.concatenate([self._index[code] for code in recorded]))
+        return self._index.get(condition, numpy.zeros(0, dtype=marker_dtype['sample']))
+
+    def _event_id(self, code):
+        if self.code_map is None:
+            return code
+        return self.code_map.get(code)
+
+    def _check_codes(self):
+        # a code_map that does not fit the recording would drop trials without complaint
+        ids = set(self.event_dict.values())
+        if self.code_map is None:
+            unknown = [code for code in self._index if code not in ids] if ids else []
+        else:
+            unknown = [code for code in self._index if code not in self.code_map]
+        if unknown:
+            mapping = f'code_map {self.code_map}' if self.code_map is not None else 'code_map=None'
+            raise ValueError(f"The recorded stimulus codes {unknown} have no event id with {mapping}; pass the "
+                             f"code_map of this recording (code_map=None if the recorded codes are the event "
+                             f"ids, codes mapped to None are dropped).")
+
+    def events(self, marker_type='Stimulus'):
+        # (n_events x 3) array [sample, 0, event id] in the format of mne.events_from_annotations;
+        # markers whose code code_map maps to None are dropped
+        if marker_type == 'Stimulus':
+            self._check_codes()
+        selected = self.markers[self.markers['type'] == marker_types.index(marker_type)]
+        if self.code_map is None:
+            ids = selected['code'].astype(int)
+        else:
+            lookup = numpy.full(max(max(self.code_map), selected['code'].max(initial=0)) + 1, -1)
+            lookup[list(self.code_map)] = [-1 if value is None else value for value in self.code_map.values()]
+            ids = lookup[numpy.clip(selected['code'], 0, None)]
+            ids[selected['code'] < 0] = -1
+        keep = ids >= 0
+        events = numpy.zeros((keep.sum(), 3), dtype=int)
+        events[:, 0] = selected['sample'][keep]
+        events[:, 2] = ids[keep]
+        return events
+
+    def event_id(self):
+        # event_dict restricted to the ids that occur in the recording
+        present = set(numpy.unique(self.events()[:, 2]).tolist())
+        return {name: value for name, value in self.event_dict.items() if value in present}
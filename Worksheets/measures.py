@@ -0,0 +1,92 @@
+# MMN measures for many subjects, contrasts and channels at once
+# Worksheet 6 measures one difference wave at one channel: crop, argmin, +-20 ms window, mean. Here the
+# same measures (and a few more) come from a stacked (subjects x contrasts x channels x times) array in
+# one vectorized pass, ROIs are added as extra channels, and the result is one tidy row per
+# subject / contrast / channel (numpy record array, pandas.DataFrame(table) or save_table for csv).
+import numpy
+from pathlib import Path
+
+# ROI of worksheet 5
+default_rois = {'frontocentral': ['FCz', 'Fz', 'F1', 'F2', 'FC1', 'FC2', 'C1', 'C2', 'Cz']}
+measure_names = ['peak', 'latency', 'mean', 'window_mean', 'area_latency']
+
+
+def stack_evokeds(evokeds, contrasts=None, picks='eeg'):
+    # evokeds: one dict {contrast: Evoked} per subject (e.g. EvokedAccumulator.mmn_waves() with the
+    # standard errors dropped, or the evokeds of pipeline.run_subject); returns (data, times, ch_names)
+    contrasts = list(contrasts or evokeds[0])
+    first = evokeds[0][contrasts[0]].copy().pick(picks)
+    data = numpy.stack([[subject[contrast].copy().pick(picks).data for contrast in contrasts]
+                        for subject in evokeds])
+    return data, first.times, first.ch_names
+
+
+def add_rois(data, ch_names, rois=None):
+    # appends the channel mean of every ROI as one more channel; ROI channels that are missing are skipped
+    rois = default_rois if rois is None else rois
+    names = list(ch_names)
+    means = []
+    for name, channels in rois.items():
+        picks = [names.index(channel) for channel in channels if channel in names]
+        if picks:
+            means.append(data[..., picks, :].mean(axis=-2))
+            names.append(name)
+    if not means:
+        return data, names
+    return numpy.concatenate([data, numpy.stack(means, axis=-2)], axis=-2), names
+
+
+def measure(data, times, tmin=0.100, tmax=0.250, half_width=0.020, polarity='negative', fraction=0.5):
+    # data (... x times), e.g. (subjects x contrasts x channels x times); returns {measure: (...) array}:
+    # peak         extreme value in [tmin, tmax] (minimum for polarity='negative')
+    # latency      its time
+    # mean         mean in peak latency +- half_width (clipped to [tmin, tmax]), as in worksheet 6
+    # window_mean  mean in [tmin, tmax]
+    # area_latency time at which `fraction` of the area of the negative (positive) part in [tmin, tmax]
+    #              is reached (fractional area latency)
+    window = (times >= tmin - 1e-9) & (times <= tmax + 1e-9)
+    values, window_times = data[..., window], times[window]
+    signed = -values if polarity == 'negative' else values
+    index = signed.argmax(axis=-1)[..., None]
+    peak = numpy.take_along_axis(values, index, axis=-1)[..., 0]
+    latency = window_times[index[..., 0]]
+
+    sums = numpy.concatenate([numpy.zeros(values.shape[:-1] + (1,)), numpy.cumsum(values, axis=-1)], axis=-1)
+    start = numpy.searchsorted(window_times, latency - half_width - 1e-9, side='left')[..., None]
+    stop = numpy.searchsorted(window_times, latency + half_width + 1e-9, side='right')[..., None]
+    mean = ((numpy.take_along_axis(sums, stop, axis=-1) - numpy.take_along_axis(sums, start, axis=-1))
+            / (stop - start))[..., 0]
+
+    area = numpy.cumsum(numpy.clip(signed, 0, None), axis=-1)
+    reached = area >= fraction * area[..., -1:]
+    area_index = numpy.where(area[..., -1] > 0, reached.argmax(axis=-1), -1)
+    area_latency = numpy.where(area_index >= 0, window_times[area_index], numpy.nan)
+    return {'peak': peak, 'latency': latency, 'mean': mean, 'window_mean': values.mean(axis=-1),
+            'area_latency': area_latency}
+
+
+def measure_table(data, times, ch_names, subjects=None, contrasts=None, rois=None, **measure_params):
+    # (subjects x contrasts x channels x times) -> record array, one row per subject, contrast and channel
+    # (ROIs included); amplitudes in the unit of data (V), latencies in s
+    n_subjects, n_contrasts = data.shape[:2]
+    subjects = list(subjects) if subjects is not None else [f'sub{index + 1:02d}' for index in range(n_subjects)]
+    contrasts = list(contrasts) if contrasts is not None else [f'contrast{index + 1}' for index in range(n_contrasts)]
+    data, names = add_rois(data, ch_names, rois)
+    results = measure(data, times, **measure_params)
+    grid = numpy.meshgrid(numpy.arange(n_subjects), numpy.arange(n_contrasts), numpy.arange(len(names)),
+                          indexing='ij')
+    columns = [numpy.array(subjects)[grid[0].ravel()], numpy.array(contrasts)[grid[1].ravel()],
+               numpy.array(names)[grid[2].ravel()]]
+    columns += [results[name].ravel() for name in measure_names]
+    return numpy.rec.fromarrays(columns, names=['subject', 'contrast', 'channel'] + measure_names)
+
+
+def save_table(table, file):
+    # csv with a header line, readable with pandas.read_csv or numpy.genfromtxt(..., names=True)
+    file = Path(file)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    with open(file, 'w') as out:
+        out.write(','.join(table.dtype.names) + '\n')
+        for row in table.tolist():
+            out.write(','.join(f'{value:.6g}' if isinstance(value, float) else str(value) for value in row) + '\n')
+    return file
@@ -0,0 +1,207 @@
+# Multi-subject preprocessing pipeline
+# The worksheet steps as stages: read BrainVision -> rename (mapping.json) -> montage + FCz -> filter ->
+# interpolate -> re-reference -> ICA -> epochs -> evokeds. Every stage output is saved under a hash of
+# the raw files, of all parameters up to that stage and of the stage code, so changing e.g. t_min only
+# recomputes epochs and evokeds. Subjects run in parallel in a process pool.
+import hashlib
+import inspect
+import json
+import os
+import mne
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from markers import read_markers, event_dict, default_code_map
+from evoked import EvokedAccumulator
+from ica_fitting import fit_ica, rng_argument
+from interpolation import interpolate_raw
+
+DIR = Path(__file__).resolve().parent.parent
+
+default_params = {
+    'raw': {'mapping': str(DIR / 'Data' / 'settings' / 'mapping.json'),
+            'montage': 'brainproducts-RNP-BA-128', 'ref_channel': 'FCz'},
+    'filter': {'l_freq': 1., 'h_freq': 40.},
+    'interpolate': {'bads': []},  # list for all subjects or {subject: [...]}
+    'reference': {'ref_channels': 'average'},
+    'ica': {'n_components': 15, 'method': 'fastica', 'random_state': 97, 'exclude': [],
+            'max_samples': None},  # e.g. 30000: fit on random segments instead of the whole recording
+    'epochs': {'t_min': -0.1, 't_max': 0.4, 'baseline': [None, 0], 'reject': None, 'flat': None,
+               'code_map': default_code_map, 'event_dict': event_dict},  # code_map None: codes are ids
+    'evokeds': {},
+}
+
+
+def prepare_raw(vhdr_file, params, subject):
+    raw = mne.io.read_raw_brainvision(vhdr_file, preload=True, verbose=False)
+    with open(params['mapping']) as file:
+        raw.rename_channels(json.load(file))
+    raw.add_reference_channels(params['ref_channel'])
+    raw.set_montage(mne.channels.make_standard_montage(params['montage']))
+    return raw
+
+
+def filter_stage(raw, params, subject):
+    return raw.filter(params['l_freq'], params['h_freq'], verbose=False)
+
+
+def interpolate_stage(raw, params, subject):
+    raw.info['bads'] = list(params['bads'])
+    if raw.info['bads']:  # cached spline matrix, same result as raw.interpolate_bads(reset_bads=True)
+        interpolate_raw(raw)
+    return raw
+
+
+def reference_stage(raw, params, subject):
+    return raw.set_eeg_reference(ref_channels=params['ref_channels'], verbose=False)
+
+
+def ica_stage(raw, params, subject):
+    if params['max_samples'] is None:
+        ica = mne.preprocessing.ICA(n_components=params['n_components'], method=params['method'],
+                                    **{rng_argument: params['random_state']})
+        ica.fit(raw, verbose=False)
+    else:  # the data is already filtered at this point
+        ica, _ = fit_ica(raw, params['n_components'], params['method'], params['random_state'],
+                         max_samples=params['max_samples'], l_freq=None)
+    ica.exclude = list(params['exclude'])
+    return ica.apply(raw, verbose=False)
+
+
+def epochs_stage(raw, params, subject):
+    code_map = params['code_map']
+    if code_map is not None:  # json turns the keys into strings
+        code_map = {int(code): event for code, event in code_map.items()}
+    markers = read_markers(subject['vmrk'], code_map=code_map, event_dict=params['event_dict'])
+    events = markers.events()
+    if not len(events):
+        raise ValueError(f"{subject['name']} has no stimulus markers in {subject['vmrk']}, there is nothing to epoch.")
+    return mne.Epochs(raw, events, tmin=params['t_min'], tmax=params['t_max'],
+                      event_id=markers.event_id(), baseline=tuple(params['baseline']),
+                      reject=params['reject'], flat=params['flat'], preload=True, verbose=False)
+
+
+def evokeds_stage(epochs, params, subject):
+    if 'standard' not in epochs.event_id:
+        raise ValueError(f"{subject['name']} has no 'standard' epochs (conditions: {list(epochs.event_id)}), "
+                         f"the joint standards need them.")
+    accumulator = EvokedAccumulator.from_epochs(epochs)
+    evokeds = accumulator.joint_standard_evokeds()
+    for name, (mmn, _) in accumulator.mmn_waves().items():
+        mmn.comment = name
+        evokeds[name] = mmn
+    return list(evokeds.values())
+
+
+# (name, function, file suffix) in processing order
+stages = [
+    ('raw', prepare_raw, '-raw.fif'),
+    ('filter', filter_stage, '-raw.fif'),
+    ('interpolate', interpolate_stage, '-raw.fif'),
+    ('reference', reference_stage, '-raw.fif'),
+    ('ica', ica_stage, '-raw.fif'),
+    ('epochs', epochs_stage, '-epo.fif'),
+    ('evokeds', evokeds_stage, '-ave.fif'),
+]
+
+
+def hash_file(path, block_size=2 ** 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def subject_files(vhdr_file):
+    vhdr_file = Path(vhdr_file)
+    return {'name': vhdr_file.stem, 'vhdr': vhdr_file, 'eeg': vhdr_file.with_suffix('.eeg'),
+            'vmrk': vhdr_file.with_suffix('.vmrk')}
+
+
+def stage_params(params, stage, subject):
+    merged = dict(default_params[stage], **params.get(stage, {}))
+    if stage == 'interpolate' and isinstance(merged['bads'], dict):
+        merged['bads'] = merged['bads'].get(subject['name'], [])
+    return merged
+
+
+def stage_keys(subject, params):
+    # key of each stage = hash(key of previous stage, stage name, its parameters, its code)
+    digest = hashlib.sha1()
+    for name in ['vhdr', 'eeg', 'vmrk']:
+        digest.update(hash_file(subject[name]).encode())
+    key = digest.hexdigest()
+    keys = []
+    for name, function, _ in stages:
+        content = json.dumps(stage_params(params, name, subject), sort_keys=True, default=str)
+        if name == 'raw':  # the channel mapping is an input file as well
+            content += hash_file(stage_params(params, name, subject)['mapping'])
+        key = hashlib.sha1((key + name + content + inspect.getsource(function)).encode()).hexdigest()
+        keys.append(key[:16])
+    return keys
+
+
+def _load(path, suffix):
+    if suffix == '-epo.fif':
+        return mne.read_epochs(path, verbose=False)
+    if suffix == '-ave.fif':
+        return mne.read_evokeds(path, verbose=False)
+    return mne.io.read_raw_fif(path, preload=True, verbose=False)
+
+
+def _save(obj, path, suffix):
+    if suffix == '-ave.fif':
+        mne.write_evokeds(path, obj, overwrite=True, verbose=False)
+    else:
+        obj.save(path, overwrite=True, verbose=False)
+
+
+def run_subject(vhdr_file, params=None, cache_dir=None):
+    # returns {stage: cached file}; stages whose file already exists are not recomputed
+    params = params or {}
+    subject = subject_files(vhdr_file)
+    cache_dir = Path(cache_dir or DIR / 'Data' / 'cache') / subject['name']
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    keys = stage_keys(subject, params)
+    paths = {name: cache_dir / f'{name}_{key}{suffix}' for (name, _, suffix), key in zip(stages, keys)}
+
+    missing = [index for index, (name, _, _) in enumerate(stages) if not paths[name].exists()]
+    if not missing:
+        return paths
+    first = missing[0]
+    if first == 0:
+        data = subject['vhdr']
+    else:
+        previous, _, previous_suffix = stages[first - 1]
+        data = _load(paths[previous], previous_suffix)
+    for name, function, suffix in stages[first:]:
+        if paths[name].exists():
+            data = _load(paths[name], suffix)
+            continue
+        data = function(data, stage_params(params, name, subject), subject)
+        _save(data, paths[name], suffix)
+    return paths
+
+
+def run_study(data_dir=None, params=None, cache_dir=None, n_jobs=None):
+    # results, errors = run_study(f"{DIR}/Data/EEG_data", params={'epochs': {'t_min': -0.2}}, n_jobs=4)
+    # results: {subject: {stage: cached file}}; a subject that fails (e.g. no stimulus markers) does not stop
+    # the others, its error message goes to errors: {subject: message}
+    data_dir = Path(data_dir or DIR / 'Data' / 'EEG_data')
+    vhdr_files = sorted(path for path in data_dir.glob('*.vhdr') if path.with_suffix('.eeg').exists())
+    if not vhdr_files:
+        raise FileNotFoundError(f"No recordings (.vhdr with its .eeg file) found in {data_dir}.")
+    results, errors = {}, {}
+    with ProcessPoolExecutor(max_workers=n_jobs or min(len(vhdr_files), os.cpu_count())) as pool:
+        futures = {pool.submit(run_subject, vhdr_file, params, cache_dir): vhdr_file.stem
+                   for vhdr_file in vhdr_files}
+        for future in as_completed(futures):
+            subject = futures[future]
+            try:
+                results[subject] = future.result()
+            except Exception as error:
+                errors[subject] = f'{type(error).__name__}: {error}'
+                print(f"{subject} failed: {errors[subject]}")
+            else:
+                print(f"{subject} done")
+    return results, errors
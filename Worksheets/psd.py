@@ -0,0 +1,162 @@
+# Streaming Welch PSD and band powers
+# Welch estimate (Hann windows, 50 % overlap, mean removed per window, as scipy.signal.welch and
+# raw.compute_psd(method='welch', n_overlap=n_fft // 2, window='hann')) over all channels, read chunk by
+# chunk with the windowed spectra summed on the fly. Results for a recording file are cached, so band
+# powers (alpha, ...) for any bands come from the cached spectra without reading the raw file again.
+import hashlib
+import json
+import numpy
+import scipy.signal
+import mne
+from pathlib import Path
+from chunks import source_n_times, read_chunk
+
+DIR = Path(__file__).resolve().parent.parent
+
+default_bands = {'delta': (1., 4.), 'theta': (4., 8.), 'alpha': (8., 12.), 'beta': (12., 30.), 'gamma': (30., 45.)}
+
+
+def welch_spectra(source, n_fft, picks=None, chunk_duration=60., transform=None):
+    # yields the Fourier transforms (channels x windows x frequencies) of the Hann-windowed segments,
+    # one chunk of the source at a time; transform (e.g. ICAOperator.sources) maps each chunk first
+    sfreq = source.info['sfreq']
+    n_times = source_n_times(source)
+    window = scipy.signal.get_window('hann', n_fft)
+    step = n_fft // 2
+    chunk_size = max(n_fft, int(chunk_duration * sfreq) // step * step)
+    for start in range(0, n_times - n_fft + 1, chunk_size):
+        stop = min(n_times, start + chunk_size + n_fft - step)
+        chunk = read_chunk(source, start, stop, picks=picks)
+        if transform is not None:
+            chunk = transform(chunk)
+        starts = numpy.arange(0, chunk.shape[1] - n_fft + 1, step)
+        starts = starts[starts < chunk_size]
+        segments = numpy.stack([chunk[:, offset:offset + n_fft] for offset in starts], axis=1)
+        segments = segments - segments.mean(axis=2, keepdims=True)
+        yield numpy.fft.rfft(segments * window, axis=2)
+
+
+def welch_scale(power, n_windows, sfreq, n_fft, keep):
+    # turns summed |spectra| ** 2 into a one-sided density (unit ** 2 / Hz), in place
+    window = scipy.signal.get_window('hann', n_fft)
+    power *= 2 / (sfreq * (window ** 2).sum() * max(n_windows, 1))
+    if keep[0]:
+        power[..., 0] /= 2  # DC and Nyquist are not doubled
+    if n_fft % 2 == 0 and keep[-1]:
+        power[..., -1] /= 2
+    return power
+
+
+class PSD:
+    # channels x frequencies Welch PSD with the band power extraction
+
+    def __init__(self, psd, frequencies, ch_names, n_windows=0):
+        self.psd = psd
+        self.frequencies = frequencies
+        self.ch_names = list(ch_names)
+        self.n_windows = n_windows
+
+    def __repr__(self):
+        return (f"<PSD | {len(self.ch_names)} channels, {self.frequencies[0]:.1f} - {self.frequencies[-1]:.1f} Hz, "
+                f"{self.n_windows} windows>")
+
+    def save(self, file):
+        numpy.savez(file, psd=self.psd, frequencies=self.frequencies, ch_names=numpy.array(self.ch_names),
+                    n_windows=self.n_windows)
+
+    @classmethod
+    def load(cls, file):
+        with numpy.load(file) as saved:
+            return cls(saved['psd'], saved['frequencies'], saved['ch_names'].tolist(), int(saved['n_windows']))
+
+    def band_power(self, bands=None, relative=False):
+        # (channels x bands) power (integral of the density over each band, unit ** 2),
+        # relative=True divides by the power over all bands; returns (matrix, band names)
+        bands = default_bands if bands is None else bands
+        resolution = self.frequencies[1] - self.frequencies[0] if len(self.frequencies) > 1 else 1.
+        masks = numpy.array([(self.frequencies >= low) & (self.frequencies < high) for low, high in bands.values()])
+        power = self.psd @ masks.T.astype(float) * resolution
+        if relative:
+            power /= power.sum(axis=1, keepdims=True)
+        return power, list(bands)
+
+    def plot_bands(self, info, bands=None, relative=False, axes=None, show=True):
+        # one topomap per band, info with the montage (e.g. raw.info)
+        import matplotlib.pyplot as plt
+        power, names = self.band_power(bands, relative)
+        info = mne.pick_info(info, [info['ch_names'].index(name) for name in self.ch_names])
+        if axes is None:
+            _, axes = plt.subplots(1, len(names), figsize=(3 * len(names), 3))
+        for ax, name, values in zip(numpy.atleast_1d(axes), names, power.T):
+            mne.viz.plot_topomap(values if relative else 10 * numpy.log10(values), info, axes=ax, show=False)
+            ax.set_title(name)
+        if show:
+            plt.show()
+        return axes
+
+
+def welch_psd(source, fmin=0., fmax=numpy.inf, n_fft=1024, picks='eeg', chunk_duration=60., transform=None,
+              names=None):
+    # PSD of a Raw (preload=False is fine), BrainVisionMemmap or view in bounded memory;
+    # names: channel names of the transformed data (e.g. ICA components)
+    sfreq = source.info['sfreq']
+    if source_n_times(source) < n_fft:
+        raise ValueError(f"The source has {source_n_times(source)} samples, fewer than n_fft={n_fft}; "
+                         f"use a smaller n_fft.")
+    if isinstance(picks, str) and picks not in source.info['ch_names']:
+        picks = [index for index, ch_type in enumerate(source.info.get_channel_types()) if ch_type == picks]
+    frequencies = numpy.fft.rfftfreq(n_fft, 1 / sfreq)
+    keep = (frequencies >= fmin) & (frequencies <= fmax)
+    power, n_windows = 0., 0
+    for spectra in welch_spectra(source, n_fft, picks, chunk_duration, transform):
+        power = power + (numpy.abs(spectra[..., keep]) ** 2).sum(axis=1)
+        n_windows += spectra.shape[1]
+    if names is None:
+        names = [source.info['ch_names'][pick] if isinstance(pick, (int, numpy.integer)) else pick for pick in picks]
+    return PSD(welch_scale(power, n_windows, sfreq, n_fft, keep), frequencies[keep], names, n_windows)
+
+
+def _data_state(source, n_blocks=16, block_size=256):
+    # what was done to the data since it was read: filter edges, reference, projectors and bads from the
+    # info, and a fingerprint of a few evenly spaced blocks of samples (filtering, re-referencing or any
+    # other in-place change of a preloaded copy changes them)
+    info = source.info
+    state = {key: info.get(key) for key in ('highpass', 'lowpass', 'custom_ref_applied', 'bads')}
+    state['projs'] = [(proj['desc'], proj['active']) for proj in info.get('projs', [])]
+    n_times = source_n_times(source)
+    digest = hashlib.sha1()
+    for start in numpy.linspace(0, max(0, n_times - block_size), n_blocks).astype(int):
+        digest.update(numpy.ascontiguousarray(read_chunk(source, start, min(n_times, start + block_size))).tobytes())
+    state['samples'] = digest.hexdigest()
+    return state
+
+
+def _cache_key(source, params):
+    # identifies a recording by its files (name, size, mtime) and the state of the data (_data_state),
+    # otherwise there is no cache
+    filenames = [Path(name) for name in (getattr(source, 'filenames', None) or []) if name]
+    if not filenames and getattr(source, 'vhdr_file', None) is not None:
+        filenames = [Path(source.vhdr_file), Path(source.eeg_file)]
+    if not filenames:
+        return None
+    digest = hashlib.sha1(json.dumps([params, _data_state(source)], sort_keys=True, default=str).encode())
+    for name in filenames:
+        stat = name.stat()
+        digest.update(f'{name.resolve()}{stat.st_size}{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()[:16]
+
+
+def cached_psd(source, fmin=0., fmax=numpy.inf, n_fft=1024, picks='eeg', chunk_duration=60., cache_dir=None):
+    # welch_psd, read from Data/cache/psd when the same file was analysed with the same parameters
+    params = {'fmin': fmin, 'fmax': fmax, 'n_fft': n_fft, 'picks': picks, 'sfreq': source.info['sfreq'],
+              'ch_names': source.info['ch_names']}
+    key = _cache_key(source, params)
+    cache_file = Path(cache_dir or DIR / 'Data' / 'cache' / 'psd') / f'{key}.npz'
+    if key is not None and cache_file.exists():
+        return PSD.load(cache_file)
+    result = welch_psd(source, fmin, fmax, n_fft, picks, chunk_duration)
+    if key is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        result.save(cache_file)
+    return result
+
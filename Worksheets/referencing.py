@@ -0,0 +1,111 @@
+# Re-referencing as linear projections
+# Every reference scheme is a (channels x channels) matrix R, the referenced data is R @ data.
+# Worksheet 2 makes a full copy of the raw for every reference; here all schemes share one source.
+import numpy
+import mne
+from chunks import source_n_times, read_chunk
+from psd import welch_spectra, welch_scale
+
+
+def reference_matrix(ch_names, ref_channels='average', exclude=()):
+    # ref_channels: 'average' or a list of channel names (e.g. ['TP9', 'TP10'] for the mastoids);
+    # channels in `exclude` (bads) do not contribute to the reference and, as in set_eeg_reference,
+    # are left as they are
+    n_channels = len(ch_names)
+    if isinstance(ref_channels, str) and ref_channels == 'average':
+        ref_channels = [name for name in ch_names if name not in exclude]
+    elif isinstance(ref_channels, str):
+        ref_channels = [ref_channels]
+    missing = [name for name in ref_channels if name not in ch_names]
+    if missing:
+        raise ValueError(f"Reference channels {missing} are not in the data.")
+    weights = numpy.zeros(n_channels)
+    weights[[ch_names.index(name) for name in ref_channels]] = 1 / len(ref_channels)
+    matrix = numpy.eye(n_channels) - numpy.outer(numpy.ones(n_channels), weights)
+    for name in exclude:
+        if name in ch_names:
+            matrix[ch_names.index(name)] = numpy.eye(n_channels)[ch_names.index(name)]
+    return matrix
+
+
+# the four schemes from worksheet 2
+default_schemes = {
+    'avg': 'average',
+    'mastoids': ['TP9', 'TP10'],
+    'frontal': ['F3', 'Fz', 'F4'],
+    'FCz': ['FCz'],
+}
+
+
+class ReferenceSet:
+    # several reference schemes over one shared source (Raw with preload=False, BrainVisionMemmap,
+    # RawArray, ...) without copying it: each scheme is a matrix and referenced data is only computed
+    # for the chunk that is asked for, either for one scheme or for all of them in one batched multiply
+
+    def __init__(self, source, schemes=default_schemes, exclude=None):
+        self.source = source
+        self.info = source.info
+        exclude = self.info['bads'] if exclude is None else exclude
+        self.picks = [index for index, ch_type in enumerate(self.info.get_channel_types()) if ch_type == 'eeg']
+        self.ch_names = [self.info['ch_names'][index] for index in self.picks]
+        self.names = list(schemes)
+        self.matrices = numpy.stack([reference_matrix(self.ch_names, schemes[name], exclude) for name in self.names])
+
+    @property
+    def n_times(self):
+        return source_n_times(self.source)
+
+    def get_data(self, scheme, start=0, stop=None):
+        chunk = read_chunk(self.source, start, self.n_times if stop is None else stop, picks=self.picks)
+        return self.matrices[self.names.index(scheme)] @ chunk
+
+    def get_all(self, start=0, stop=None):
+        # (schemes x channels x samples) for one chunk, one einsum for all schemes
+        chunk = read_chunk(self.source, start, self.n_times if stop is None else stop, picks=self.picks)
+        return numpy.einsum('sij,jt->sit', self.matrices, chunk)
+
+    def view(self, scheme):
+        return ReferencedView(self, scheme)
+
+    def psd(self, fmin=0., fmax=numpy.inf, n_fft=1024, chunk_duration=60.):
+        # Welch PSD (Hann windows, 50 % overlap) of every scheme in one pass over the source:
+        # the windows are transformed once and the reference matrices are applied to the spectra
+        sfreq = self.info['sfreq']
+        frequencies = numpy.fft.rfftfreq(n_fft, 1 / sfreq)
+        keep = (frequencies >= fmin) & (frequencies <= fmax)
+        power = numpy.zeros((len(self.names), len(self.ch_names), keep.sum()))
+        n_windows = 0
+        for spectra in welch_spectra(self.source, n_fft, self.picks, chunk_duration):
+            referenced = numpy.einsum('sij,jwf->siwf', self.matrices, spectra[..., keep])
+            power += (numpy.abs(referenced) ** 2).sum(axis=2)
+            n_windows += spectra.shape[1]
+        welch_scale(power, n_windows, sfreq, n_fft, keep)
+        return dict(zip(self.names, power)), frequencies[keep]
+
+
+class ReferencedView:
+    # one scheme of a ReferenceSet with the Raw-like get_data / info / n_times interface,
+    # so the chunked tools (filter_raw, extract_epochs, ...) accept it as a source
+
+    def __init__(self, reference_set, scheme):
+        self.reference_set = reference_set
+        self.scheme = scheme
+        self.info = mne.pick_info(reference_set.info, reference_set.picks)
+        self.n_times = reference_set.n_times
+        self.first_samp = getattr(reference_set.source, 'first_samp', 0)
+
+    def __repr__(self):
+        return f"<ReferencedView | {self.scheme}, {len(self.info['ch_names'])} x {self.n_times}>"
+
+    def get_data(self, picks=None, start=0, stop=None):
+        data = self.reference_set.get_data(self.scheme, start, stop)
+        if picks is None:
+            return data
+        if isinstance(picks, str):
+            picks = [picks]
+        picks = [self.info['ch_names'].index(pick) if isinstance(pick, str) else pick for pick in picks]
+        return data[picks]
+
+    def to_raw(self, start=0, stop=None):
+        # RawArray of (a part of) the referenced data for plotting, e.g. view.to_raw(0, 5000).plot()
+        return mne.io.RawArray(self.get_data(start=start, stop=stop), self.info, first_samp=start, verbose=False)
@@ -0,0 +1,228 @@
+# Replay of recordings as an amplifier stream
+# A BrainVision triplet (or any source: Raw, BrainVisionMemmap, array) is emitted in fixed-size chunks
+# together with the stimulus markers that fall into each chunk, at a multiple of real time (speed=1.,
+# 10., or None for as fast as the consumer takes them), through a generator or an asyncio stream.
+# Per chunk the replay records how late it was emitted against the schedule (lag: the consumer cannot
+# keep up when it grows), how long the consumer held on to it, and for the asyncio stream how long
+# the producer waited on the full queue. stats.summary() turns that into throughput figures.
+import asyncio
+import collections
+import json
+import time
+import numpy
+from pathlib import Path
+from brainvision import read_raw_memmap
+from alignment import stimulus_markers
+from chunks import source_n_times, read_chunk, iter_chunks
+
+DIR = Path(__file__).resolve().parent.parent
+
+Chunk = collections.namedtuple('Chunk', ['start', 'data', 'markers'])  # markers: [(sample, code), ...]
+
+
+class ReplayStats:
+    # per-chunk timings in s (preallocated, nan for chunks not emitted yet)
+
+    def __init__(self, n_chunks, n_channels, sfreq, chunk_size, speed):
+        self.n_channels = n_channels
+        self.sfreq = sfreq
+        self.chunk_size = chunk_size
+        self.speed = speed
+        self.lag = numpy.full(n_chunks, numpy.nan)       # emitted - scheduled
+        self.consumer = numpy.full(n_chunks, numpy.nan)  # until the consumer asked for the next chunk
+        self.blocked = numpy.zeros(n_chunks)             # producer waiting on a full queue (asyncio)
+        self.queued = numpy.zeros(n_chunks, dtype=int)   # queue length after the put (asyncio)
+        self.n_chunks = self.n_samples = 0
+        self.started = self.finished = None
+
+    def __repr__(self):
+        return f"<ReplayStats | {self.n_chunks} chunks, {self.n_samples} samples>"
+
+    def summary(self):
+        # throughput and back-pressure; consumer_load is the share of the time budget per chunk (chunk
+        # duration / speed, real time when unthrottled) the consumer used, keeps_up: load < 1 and no lag
+        # built up by the end
+        done = slice(0, self.n_chunks)
+        elapsed = (self.finished or time.perf_counter()) - self.started if self.started else 0.
+        duration = self.n_samples / self.sfreq
+        consumer, lag = self.consumer[done], self.lag[done]
+        budget = self.chunk_size / self.sfreq / (self.speed or 1.)  # real time when unthrottled
+        consumer_total = numpy.nansum(consumer)
+        load = consumer_total / (self.n_chunks * budget) if self.n_chunks else 0.
+        end_lag = numpy.nanmean(lag[-max(1, len(lag) // 10):]) if self.speed and self.n_chunks else 0.
+        return {'n_chunks': self.n_chunks, 'n_channels': self.n_channels, 'sfreq': self.sfreq,
+                'chunk_size': self.chunk_size, 'speed': self.speed, 'elapsed_s': elapsed, 'duration_s': duration,
+                'realtime_factor': duration / elapsed if elapsed else numpy.nan,
+                'samples_per_s': self.n_samples * self.n_channels / elapsed if elapsed else numpy.nan,
+                'consumer_realtime_factor': duration / consumer_total if consumer_total else numpy.inf,
+                'consumer_ms': {'mean': float(numpy.nanmean(consumer) * 1000), 'p99': float(
+                    numpy.nanpercentile(consumer, 99) * 1000), 'max': float(numpy.nanmax(consumer) * 1000)}
+                if self.n_chunks else {},
+                'consumer_load': float(load),
+                'lag_ms': {'mean': float(numpy.nanmean(lag) * 1000), 'max': float(numpy.nanmax(lag) * 1000),
+                           'end': float(end_lag * 1000)} if self.speed and self.n_chunks else {},
+                'blocked_s': float(self.blocked[done].sum()), 'max_queued': int(self.queued[done].max(initial=0)),
+                'keeps_up': bool(load < 1 and end_lag < 2 * budget)}
+
+
+class Replay:
+
+    def __init__(self, source, samples=(), codes=(), chunk_size=None, speed=1., picks=None, sfreq=None,
+                 start=0, stop=None):
+        # source: Raw (preload=False), BrainVisionMemmap or (channels x samples) array (then sfreq is needed);
+        # samples / codes: stimulus markers; chunk_size defaults to 20 ms; speed: multiple of real time,
+        # None unthrottled
+        self.source = source
+        self.sfreq = sfreq or source.info['sfreq']
+        self.chunk_size = chunk_size or max(1, int(round(0.02 * self.sfreq)))
+        self.speed = speed
+        self.picks = picks
+        self.start, self.stop = start, min(stop or source_n_times(source), source_n_times(source))
+        order = numpy.argsort(samples, kind='stable')
+        self.samples = numpy.asarray(samples, dtype=int)[order]
+        self.codes = numpy.asarray(codes, dtype=int)[order]
+        self.n_channels = len(read_chunk(source, self.start, self.start + 1, picks))
+        self.stats = None
+
+    @classmethod
+    def from_file(cls, vhdr_file, mapping=None, **replay_params):
+        # BrainVision triplet in Data/EEG_data (e.g. 'sub25_main1') or a path to a .vhdr file;
+        # mapping: dict or json file for renaming the channels (e.g. Data/settings/mapping.json)
+        vhdr_file = Path(vhdr_file)
+        if not vhdr_file.suffix:
+            vhdr_file = DIR / 'Data' / 'EEG_data' / f'{vhdr_file}.vhdr'
+        if isinstance(mapping, (str, Path)):
+            with open(mapping) as file:
+                mapping = json.load(file)
+        raw = read_raw_memmap(vhdr_file, mapping=mapping)
+        samples, codes = stimulus_markers(raw.vmrk_file) if raw.vmrk_file is not None and raw.vmrk_file.exists() \
+            else ((), ())
+        return cls(raw, samples, codes, **replay_params)
+
+    def __repr__(self):
+        speed = f'{self.speed:g}x' if self.speed else 'unthrottled'
+        return (f"<Replay | {self.n_channels} channels at {self.sfreq:g} Hz, "
+                f"{(self.stop - self.start) / self.sfreq:.1f} s in chunks of {self.chunk_size}, {speed}>")
+
+    def _chunks(self):
+        self.stats = ReplayStats(-(-(self.stop - self.start) // self.chunk_size), self.n_channels, self.sfreq,
+                                 self.chunk_size, self.speed)
+        return iter_chunks(self.stop, self.chunk_size, self.start)
+
+    def _scheduled(self, stop):
+        # wall-clock time at which the chunk ending at `stop` is complete
+        return self.stats.started + (stop - self.start) / self.sfreq / self.speed
+
+    def _read(self, start, stop):
+        low, high = numpy.searchsorted(self.samples, [start, stop])
+        return Chunk(start, read_chunk(self.source, start, stop, self.picks),
+                     list(zip(self.samples[low:high].tolist(), self.codes[low:high].tolist())))
+
+    def __iter__(self):
+        chunks = self._chunks()
+        stats = self.stats
+        for index, (start, stop) in enumerate(chunks):
+            if index == 0:
+                stats.started = time.perf_counter()
+            if self.speed:
+                delay = self._scheduled(stop) - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            chunk = self._read(start, stop)
+            emitted = time.perf_counter()
+            if self.speed:
+                stats.lag[index] = emitted - self._scheduled(stop)
+            stats.n_chunks, stats.n_samples = index + 1, stats.n_samples + stop - start
+            yield chunk
+            stats.consumer[index] = time.perf_counter() - emitted
+        stats.finished = time.perf_counter()
+
+    async def _produce(self, queue):
+        chunks = self._chunks()
+        stats = self.stats
+        for index, (start, stop) in enumerate(chunks):
+            if index == 0:
+                stats.started = time.perf_counter()
+            if self.speed:
+                delay = self._scheduled(stop) - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            chunk = self._read(start, stop)
+            if self.speed:
+                stats.lag[index] = time.perf_counter() - self._scheduled(stop)
+            waiting = time.perf_counter()
+            await queue.put((index, chunk))
+            stats.blocked[index] = time.perf_counter() - waiting
+            stats.queued[index] = queue.qsize()
+            stats.n_chunks, stats.n_samples = index + 1, stats.n_samples + stop - start
+        await queue.put(None)
+
+    async def stream(self, max_queued=8):
+        # async generator of chunks: `async for chunk in replay.stream(): ...`; a consumer that falls behind
+        # fills the queue (max_queued chunks), then the producer waits, which shows up as blocked_s
+        queue = asyncio.Queue(max_queued)
+        producer = asyncio.ensure_future(self._produce(queue))
+        try:
+            while (item := await queue.get()) is not None:
+                index, chunk = item
+                received = time.perf_counter()
+                yield chunk
+                self.stats.consumer[index] = time.perf_counter() - received
+        finally:
+            producer.cancel()
+            if self.stats is not None:
+                self.stats.finished = time.perf_counter()
+
+    def __aiter__(self):
+        return self.stream()
+
+
+def print_summary(summary):
+    speed = f"{summary['speed']:g}x" if summary['speed'] else 'unthrottled'
+    print(f"{summary['n_channels']} channels at {summary['sfreq']:g} Hz, {speed}: {summary['duration_s']:.1f} s "
+          f"in {summary['elapsed_s']:.2f} s ({summary['realtime_factor']:.1f}x real time, "
+          f"{summary['samples_per_s'] / 1e6:.2f} M samples/s)")
+    if summary['consumer_ms']:
+        consumer = summary['consumer_ms']
+        print(f"    consumer per chunk: mean {consumer['mean']:.3f} ms, p99 {consumer['p99']:.3f} ms, "
+              f"max {consumer['max']:.3f} ms, load {summary['consumer_load']:.2f}, "
+              f"alone {summary['consumer_realtime_factor']:.1f}x real time")
+    if summary['lag_ms']:
+        print(f"    lag: mean {summary['lag_ms']['mean']:.2f} ms, max {summary['lag_ms']['max']:.2f} ms, "
+              f"at the end {summary['lag_ms']['end']:.2f} ms")
+    if summary['max_queued']:
+        print(f"    queue: up to {summary['max_queued']} chunks, producer blocked {summary['blocked_s']:.3f} s")
+    print(f"    keeps up: {summary['keeps_up']}")
+
+
+def benchmark_replay(consumer=None, n_channels=(32, 64, 128), sfreqs=(500., 1000., 2000.), duration=120.,
+                     chunk_duration=0.02, seed=0):
+    # unthrottled replay of simulated sessions (online.simulate_session) through consumer(info) -> callable
+    # taking a Chunk, by default an online.MMNMonitor; returns one summary per channel count and rate
+    import online
+    if consumer is None:
+        def consumer(info):
+            monitor = online.MMNMonitor(info, on_pause=lambda report: None)
+            return lambda chunk: monitor.push(chunk.data, chunk.markers)
+    results = []
+    for sfreq in sfreqs:
+        for channels in n_channels:
+            ch_names = online.default_rois['frontocentral'] + [f'EEG{index:03d}' for index in range(channels - 9)]
+            data, samples, codes, info = online.simulate_session(int(duration / 0.5) - 2, sfreq, ch_names,
+                                                                 pauses=(), seed=seed)
+            process = consumer(info)
+            replay = Replay(data, samples, codes, int(round(chunk_duration * sfreq)), speed=None, sfreq=sfreq)
+            for chunk in replay:
+                process(chunk)
+            results.append(replay.stats.summary())
+            print_summary(results[-1])
+    return results
+
+
+if __name__ == "__main__":
+    for name in ['blinks']:
+        replay = Replay.from_file(name, speed=None)
+        for _ in replay:
+            pass
+        print_summary(replay.stats.summary())
+    benchmark_replay()
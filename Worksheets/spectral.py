@@ -0,0 +1,86 @@
+# Spectral engine
+# Vectorized replacement for the fourier_transform helper from example_fft.py.
+# Works on a single signal (n_samples,) or on a whole recording (n_channels, n_samples) at once.
+import time
+import numpy
+from matplotlib import pyplot as plt
+
+
+def compute_spectrum(data, samplerate):
+    # returns the same frequencies / spectrum / fourier as the loop in example_fft.py,
+    # but computed with one real FFT over the last axis of the (channels x samples) array
+    data = numpy.asarray(data)
+    n_samples = data.shape[-1]
+    nyquist = samplerate / 2
+    frequencies = numpy.linspace(0, nyquist, int(n_samples / 2) + 1)
+    half = numpy.fft.rfft(data, axis=-1) / n_samples
+    spectrum = numpy.abs(half) ** 2
+    return frequencies, spectrum, half
+
+
+def full_fourier(half, n_samples):
+    # rebuild the two-sided transform from the real FFT (negative frequencies are the complex conjugates)
+    fourier = numpy.empty(half.shape[:-1] + (n_samples,), dtype=complex)
+    fourier[..., :half.shape[-1]] = half
+    n_negative = n_samples - half.shape[-1]
+    if n_negative:
+        fourier[..., half.shape[-1]:] = numpy.conj(half[..., 1:n_negative + 1][..., ::-1])
+    return fourier
+
+
+def fourier_transform(data, samplerate, show=True, xlim=None, axis=None, return_fourier=False):
+    # drop-in for example_fft.fourier_transform, data can be 1-D or (channels x samples)
+    # with show=False nothing is plotted and matplotlib is never touched
+    data = numpy.asarray(data)
+    frequencies, spectrum, half = compute_spectrum(data, samplerate)
+    if show:
+        if not axis:
+            fig, axis = plt.subplots(1, 1)
+            axis.plot(frequencies, spectrum.T)
+            axis.set_ylabel('Power (dB)')
+            axis.set_xlabel('Frequency (Hz)')
+        if xlim:
+            axis.set_xlim(xlim[0], xlim[1])
+    if return_fourier: return full_fourier(half, data.shape[-1]), axis
+    else: return axis
+
+
+def fourier_transform_loop(data, samplerate):
+    # the original O(N²) implementation from example_fft.py, kept as a reference for the benchmark
+    nyquist = samplerate / 2
+    n_samples = len(data)
+    time_points = numpy.arange(0, n_samples) / n_samples
+    fourier = numpy.zeros(n_samples, dtype=complex)
+    frequencies = numpy.linspace(0, nyquist, int(n_samples / 2) + 1)
+    for frequency in range(n_samples):
+        sine_wave = numpy.exp(-1j * (2 * numpy.pi * frequency * time_points))
+        fourier[frequency] = numpy.sum(sine_wave * data)
+    fourier = fourier / n_samples
+    spectrum = numpy.abs(fourier)[:int(n_samples / 2) + 1] ** 2
+    return frequencies, spectrum, fourier
+
+
+def benchmark_fourier_transform(n_channels=64, n_samples=1000, samplerate=500, repeats=3, seed=0):
+    # time the loop (one channel after the other) against the batched real FFT on the same data
+    data = numpy.random.default_rng(seed).standard_normal((n_channels, n_samples))
+    loop_times, fft_times = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        loop_fourier = numpy.array([fourier_transform_loop(channel, samplerate)[2] for channel in data])
+        loop_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        _, _, half = compute_spectrum(data, samplerate)
+        fft_fourier = full_fourier(half, n_samples)
+        fft_times.append(time.perf_counter() - start)
+    max_error = numpy.max(numpy.abs(loop_fourier - fft_fourier))
+    result = {'n_channels': n_channels, 'n_samples': n_samples,
+              'loop_s': min(loop_times), 'fft_s': min(fft_times),
+              'speedup': min(loop_times) / min(fft_times), 'max_error': float(max_error)}
+    print(f"{n_channels} channels x {n_samples} samples: loop {result['loop_s']:.3f} s, "
+          f"fft {result['fft_s'] * 1000:.3f} ms ({result['speedup']:.0f}x faster, max error {max_error:.2e})")
+    return result
+
+
+if __name__ == "__main__":
+    for n_samples in [1000, 5000]:
+        benchmark_fourier_transform(n_samples=n_samples, repeats=1)
@@ -0,0 +1,231 @@
+# Time-frequency power and inter-trial phase coherence per condition
+# A whole wavelet family (Morlet, or DPSS multitaper) is convolved with many epochs x channels at once:
+# one FFT per signal, one product with all kernel spectra, one inverse FFT, in float32. The kernels are
+# pre-shifted so the 'same'-mode output starts at sample 0 (as mne.time_frequency.tfr_array_morlet),
+# and their spectra are cached per sampling rate, frequency grid and FFT length. Epochs stream through
+# condition by condition in batches that fit max_memory; only the sums needed for the averages are kept:
+# total and induced power (total minus the power of the evoked response) and the ITC.
+import time
+import numpy
+import scipy.fft
+import scipy.signal
+import mne
+from pathlib import Path
+from markers import event_dict
+
+_kernel_cache = {}
+
+
+def wavelet_family(sfreq, frequencies, n_cycles=7., method='morlet', time_bandwidth=4., zero_mean=True):
+    # (tapers x frequencies) list of complex kernels and (tapers x frequencies) power weights,
+    # the same kernels as mne.time_frequency.morlet / the multitaper TFR of mne
+    frequencies = numpy.atleast_1d(numpy.asarray(frequencies, dtype=float))
+    n_cycles = numpy.broadcast_to(numpy.asarray(n_cycles, dtype=float), frequencies.shape)
+    if numpy.any(frequencies <= 0):
+        raise ValueError("all frequencies must be greater than 0.")
+    if method == 'morlet':
+        kernels = []
+        for frequency, cycles in zip(frequencies, n_cycles):
+            sigma = cycles / (2 * numpy.pi * frequency)
+            t = numpy.arange(0, 5 * sigma, 1 / sfreq)
+            t = numpy.concatenate([-t[:0:-1], t])
+            oscillation = numpy.exp(2j * numpy.pi * frequency * t)
+            if zero_mean:
+                oscillation -= numpy.exp(-2 * (numpy.pi * frequency * sigma) ** 2)
+            kernel = oscillation * numpy.exp(-t ** 2 / (2 * sigma ** 2))
+            kernels.append(kernel / (numpy.sqrt(0.5) * numpy.linalg.norm(kernel)))
+        return [kernels], numpy.ones((1, len(frequencies)))
+    if method == 'multitaper':
+        if time_bandwidth < 2:
+            raise ValueError("time_bandwidth should be >= 2.0 for good tapers.")
+        n_tapers = int(numpy.floor(time_bandwidth - 1))
+        kernels = [[] for _ in range(n_tapers)]
+        concentrations = numpy.zeros((n_tapers, len(frequencies)))
+        for index, (frequency, cycles) in enumerate(zip(frequencies, n_cycles)):
+            duration = cycles / frequency
+            t = numpy.arange(0, duration, 1 / sfreq)
+            oscillation = numpy.exp(2j * numpy.pi * frequency * (t - duration / 2))
+            tapers, ratios = scipy.signal.windows.dpss(len(t), time_bandwidth / 2, n_tapers, sym=False,
+                                                       return_ratios=True)
+            for taper in range(n_tapers):
+                kernel = oscillation * tapers[taper]
+                if zero_mean:
+                    kernel -= kernel.mean()
+                kernels[taper].append(kernel / (numpy.sqrt(0.5) * numpy.linalg.norm(kernel)))
+            concentrations[:, index] = ratios
+        return kernels, 2 * concentrations / concentrations.sum(axis=0)
+    raise ValueError(f"method must be 'morlet' or 'multitaper', not {method}.")
+
+
+def kernel_spectra(sfreq, frequencies, n_times, n_cycles=7., method='morlet', time_bandwidth=4., zero_mean=True):
+    # (tapers x frequencies x n_fft) complex64 spectra of the centred kernels, power weights and n_fft
+    key = (method, float(sfreq), tuple(numpy.atleast_1d(frequencies).tolist()),
+           tuple(numpy.atleast_1d(n_cycles).tolist()), float(time_bandwidth), zero_mean, n_times)
+    if key not in _kernel_cache:
+        kernels, weights = wavelet_family(sfreq, frequencies, n_cycles, method, time_bandwidth, zero_mean)
+        longest = max(len(kernel) for taper in kernels for kernel in taper)
+        if longest > n_times:
+            raise ValueError(f"the longest wavelet ({longest} samples) is longer than the epochs ({n_times} "
+                             f"samples), use longer epochs or fewer cycles at the low frequencies.")
+        n_fft = scipy.fft.next_fast_len(n_times + longest - 1)
+        spectra = numpy.zeros((len(kernels), len(kernels[0]), n_fft), dtype=numpy.complex64)
+        for taper, taper_kernels in enumerate(kernels):
+            for index, kernel in enumerate(taper_kernels):
+                # roll the kernel centre to sample 0, the convolution then needs no cropping at the start
+                padded = numpy.zeros(n_fft, dtype=complex)
+                padded[:len(kernel)] = kernel
+                spectra[taper, index] = scipy.fft.fft(numpy.roll(padded, -((len(kernel) - 1) // 2)))
+        _kernel_cache[key] = (spectra, weights, n_fft)
+    return _kernel_cache[key]
+
+
+def iter_tfr(batches, spectra, n_times, decim=1):
+    # complex64 coefficients (epochs x channels x tapers x frequencies x times[::decim]) of every
+    # batch (epochs x channels x times), one batch at a time
+    n_fft = spectra.shape[-1]
+    for batch in batches:
+        fourier = scipy.fft.fft(numpy.asarray(batch, dtype=numpy.float32), n_fft, axis=-1)
+        coefficients = scipy.fft.ifft(fourier[:, :, None, None, :] * spectra, axis=-1)
+        yield coefficients[..., :n_times:decim]
+
+
+def _picks(info, picks):
+    if picks is None:
+        return numpy.arange(len(info['ch_names']))
+    if isinstance(picks, str) and picks not in info['ch_names']:  # channel type, e.g. 'eeg'
+        return numpy.flatnonzero(numpy.array(info.get_channel_types()) == picks)
+    if isinstance(picks, str):
+        picks = [picks]
+    return numpy.array([info['ch_names'].index(pick) if isinstance(pick, str) else pick for pick in picks])
+
+
+def _condition_batches(epochs, name, picks, batch_size):
+    # float32 (epochs x channels x times) batches of one condition of an mne Epochs (preloaded or not),
+    # epoching.StreamedEpochs or epoch_store.EpochStore
+    if hasattr(epochs, 'meta'):  # EpochStore reads the picked channels of one condition
+        data = epochs.get_data(name, picks)
+        for start in range(0, len(data), batch_size):
+            yield data[start:start + batch_size]
+        return
+    indices = numpy.flatnonzero(epochs.events[:, 2] == epochs.event_id[name])
+    for start in range(0, len(indices), batch_size):
+        batch = indices[start:start + batch_size]
+        if isinstance(epochs, mne.BaseEpochs):
+            yield epochs.get_data(picks=picks, item=batch, verbose=False).astype(numpy.float32)
+        else:
+            yield epochs.data[batch][:, picks].astype(numpy.float32)
+
+
+class ConditionTFR:
+    # averages of one condition: (channels x frequencies x times) power, induced power and ITC
+
+    def __init__(self, condition, power, induced, itc, frequencies, times, ch_names, n_epochs, method='morlet'):
+        self.condition = condition
+        self.power = power
+        self.induced = induced
+        self.itc = itc
+        self.frequencies = frequencies
+        self.times = times
+        self.ch_names = list(ch_names)
+        self.n_epochs = n_epochs
+        self.method = method
+
+    def __repr__(self):
+        return (f"<ConditionTFR | '{self.condition}', {self.n_epochs} epochs, {len(self.ch_names)} channels, "
+                f"{self.frequencies[0]:.1f} - {self.frequencies[-1]:.1f} Hz, {len(self.times)} times>")
+
+    def save(self, file):
+        numpy.savez(file, condition=self.condition, power=self.power, induced=self.induced, itc=self.itc,
+                    frequencies=self.frequencies, times=self.times, ch_names=numpy.array(self.ch_names),
+                    n_epochs=self.n_epochs, method=self.method)
+
+    @classmethod
+    def load(cls, file):
+        with numpy.load(file) as saved:
+            return cls(str(saved['condition']), saved['power'], saved['induced'], saved['itc'],
+                       saved['frequencies'], saved['times'], saved['ch_names'].tolist(), int(saved['n_epochs']),
+                       str(saved['method']))
+
+    def to_mne(self, info, kind='power'):
+        # mne AverageTFR of 'power', 'induced' or 'itc' (for plot_topo, apply_baseline, ...)
+        info = mne.pick_info(info, [info['ch_names'].index(name) for name in self.ch_names])
+        return mne.time_frequency.AverageTFRArray(info, getattr(self, kind).astype(float), self.times,
+                                                  self.frequencies, nave=self.n_epochs,
+                                                  comment=f'{self.condition} {kind}', method=self.method)
+
+
+def condition_tfr(epochs, frequencies, n_cycles=7., method='morlet', conditions=None, picks='eeg', decim=1,
+                  time_bandwidth=4., zero_mean=True, max_memory=256e6):
+    # {condition: ConditionTFR} for the conditions of event_dict found in the epochs; the single-trial
+    # coefficients of one batch (at most max_memory bytes) are the largest array ever held
+    event_id = epochs.event_id
+    conditions = [name for name in event_dict if name in event_id] if conditions is None else (
+        [conditions] if isinstance(conditions, str) else list(conditions))
+    info, sfreq = epochs.info, epochs.info['sfreq']
+    picks = _picks(info, picks)
+    ch_names = [info['ch_names'][pick] for pick in picks]
+    times = numpy.asarray(epochs.times)
+    frequencies = numpy.atleast_1d(numpy.asarray(frequencies, dtype=float))
+    spectra, weights, n_fft = kernel_spectra(sfreq, frequencies, len(times), n_cycles, method, time_bandwidth,
+                                             zero_mean)
+    weights = weights[None, :, :, None]
+    batch_size = max(1, int(max_memory // (len(picks) * spectra[..., 0].size * n_fft * 8)))
+
+    results = {}
+    for name in conditions:
+        shape = (len(picks),) + spectra.shape[:2] + (len(times[::decim]),)
+        power, coefficients, phases, n_epochs = numpy.zeros(shape), numpy.zeros(shape, complex), \
+            numpy.zeros(shape, complex), 0
+        for batch in iter_tfr(_condition_batches(epochs, name, picks, batch_size), spectra, len(times), decim):
+            magnitude = numpy.abs(batch)
+            power += (magnitude ** 2).sum(axis=0)
+            coefficients += batch.sum(axis=0)
+            phases += numpy.divide(batch, magnitude, out=numpy.zeros_like(batch), where=magnitude > 0).sum(axis=0)
+            n_epochs += len(batch)
+        count = max(n_epochs, 1)
+        evoked_power = numpy.abs(coefficients / count) ** 2
+        results[name] = ConditionTFR(
+            name, (weights * power / count).sum(axis=1).astype(numpy.float32),
+            (weights * (power / count - evoked_power)).sum(axis=1).astype(numpy.float32),
+            (numpy.abs(phases) / count).mean(axis=1).astype(numpy.float32),
+            frequencies, times[::decim], ch_names, n_epochs, method)
+    return results
+
+
+def save_condition_tfrs(tfrs, directory):
+    # one <condition>-tfr.npz per condition
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, result in tfrs.items():
+        result.save(directory / f'{name}-tfr.npz')
+    return directory
+
+
+def benchmark_tfr(n_epochs=400, n_channels=32, n_times=501, sfreq=500., frequencies=None, seed=0):
+    # condition_tfr against mne.time_frequency.tfr_array_morlet(output='avg_power_itc') on the same epochs
+    frequencies = numpy.arange(6., 41., 2.) if frequencies is None else frequencies
+    n_cycles = frequencies / 2
+    rng = numpy.random.default_rng(seed)
+    data = numpy.cumsum(rng.standard_normal((n_epochs, n_channels, n_times)), axis=2) * 1e-7
+    info = mne.create_info([f'EEG{index:03d}' for index in range(n_channels)], sfreq, 'eeg')
+    events = numpy.column_stack([numpy.arange(n_epochs) * 250, numpy.zeros(n_epochs, int), numpy.ones(n_epochs, int)])
+    epochs = mne.EpochsArray(data, info, events=events, tmin=-0.1, event_id={'standard': 1}, verbose=False)
+
+    start = time.perf_counter()
+    reference = mne.time_frequency.tfr_array_morlet(data, sfreq, frequencies, n_cycles, output='avg_power_itc',
+                                                    verbose=False)
+    mne_s = time.perf_counter() - start
+    _kernel_cache.clear()
+    start = time.perf_counter()
+    result = condition_tfr(epochs, frequencies, n_cycles)['standard']
+    batched_s = time.perf_counter() - start
+    power_error = numpy.max(numpy.abs(result.power - reference.real) / reference.real.max())
+    itc_error = numpy.max(numpy.abs(result.itc - reference.imag))
+    print(f"{n_epochs} epochs x {n_channels} channels x {len(frequencies)} frequencies: mne {mne_s:.2f} s, "
+          f"batched {batched_s:.2f} s ({mne_s / batched_s:.1f}x faster), relative power error {power_error:.1e}, "
+          f"itc error {itc_error:.1e}")
+    return {'mne_s': mne_s, 'batched_s': batched_s, 'power_error': float(power_error), 'itc_error': float(itc_error)}
+
+
+if __name__ == "__main__":
+    benchmark_tfr()
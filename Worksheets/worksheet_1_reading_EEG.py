@@ -12,6 +12,8 @@ header_file_path = f"{DIR}/..."
 
 # Read in the raw Brainvision file using the "io" class
 raw = ...
+# (for large recordings: brainvision.read_raw_memmap(header_file_path) keeps the samples on disk
+# and only converts the slices you ask for with get_data)
 
 # Print the raw object. How many channels are there? How many seconds is the recording?
 
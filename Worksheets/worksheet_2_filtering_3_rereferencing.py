@@ -40,6 +40,8 @@ raw.plot_sensors(show_names=True, kind="...") # todo
 
 # Make a copy of your raw data and filter it
 raw_filtered = raw.copy().filter(...) # todo
+# (for data that arrives in pieces: iir.FilterBank.from_params(raw.info['sfreq'], 1., 40., notch=50.) filters
+# chunk after chunk with the same result as all at once; .zero_phase(raw) is the forward-backward version)
 
 # Create a copy of your raw data and mark the bad channels in it
 raw_bads = raw_filtered.copy()
@@ -54,6 +56,8 @@ raw_interpolated.plot()
 # Extra: choose one of the channels that you marked "bad". Using the electrode map, pick the electrodes that are
 # the "bad" channel's neighbours. Create a new channel (array) with the average of these electrodes
 # What's the difference between this average and the interpolated version above?
+# (interpolation.InterpolatedView(raw_bads, mode='neighbours') does this for all bad channels at once,
+# mode='spline' gives the same result as interpolate_bads; both matrices are cached on disk)
 
 # Rerefence for
 # - Global average
@@ -65,15 +69,21 @@ raw_ref_avg = raw_interpolated.copy().set_eeg_reference(ref_channels="...")
 raw_ref_mastoids = ...
 raw_ref_frontal = ...
 raw_ref_FCz = ...
+# (referencing.ReferenceSet(raw_interpolated) holds all four schemes without copying the data:
+# refs.view('mastoids').to_raw(0, 5000).plot() to look at one, refs.psd(fmax=40) for the PSDs of all of them)
 
 # Plot your raw signal after rereferencing for these different configurations
 # What are the differences that you can see?
 
 # Plot the power spectral density (PSD) and select the frequencies in the alpha range (8-12Hz)
 # At which electrodes do you pick up most of the alpha activity?
+# (psd.cached_psd(raw) computes the PSD chunk by chunk and caches it per recording, .band_power() gives the
+# channel x band matrix for delta ... gamma and .plot_bands(raw.info) the topographies)
 
 # Save your final version of the raw data, so that you don't have to repeat these steps again
 raw_ref_avg.save(...)
 
 # Search for a python package that has an automated approach to bad channel detection and interpolation
 # Try to use it!
+# (bad_channels.detect_bad_channels(raw) is our built-in version: it fills raw.info["bads"] and returns
+# a per-channel score table, print it to tune the thresholds)
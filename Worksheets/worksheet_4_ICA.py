@@ -47,6 +47,7 @@ ica.plot_overlay(raw, exclude=ica.exclude, picks="eeg")
 
 # Plot the properties of the component(s) that correspond to blinks. Repeat for eye movements!
 ica.plot_properties(raw, picks=..., show=True) #todo
+# (ica_fitting.component_psd(raw, ica) gives the spectra of all components without get_sources)
 
 # Get the explained variance of each component. What does this mean?
 explained_var_ratio = ica.get_explained_variance_ratio(raw)
@@ -56,6 +57,8 @@ raw_clean = ica.apply(raw.copy())
 
 # Try rerunning the ICA process for data that is referenced at different electrodes
 # What differences can you see in the components? And in the sources?
+# (Shortcut: ica_fitting.ICAOperator.from_ica(ica).rereferenced(['TP9', 'TP10']) gives the components of an
+# average-reference fit for another reference without refitting; ica_fitting.fit_ica fits on a subsample and caches)
 
 # Save your updated raw file after you are done with the ICA preprocessing
 raw_clean.save(f'{DIR}/Data/EEG_data/MMN_1_ica-raw.fif')
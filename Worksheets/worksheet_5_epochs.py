@@ -9,9 +9,12 @@ raw = ...
 
 # Load events and the event_id dictionary with the unique event values
 events, event_id = mne.events_from_annotations(raw)
+# (markers.read_markers(vmrk_file, code_map=...).events() gives the same array straight from the .vmrk file)
 
 # Visualise all events and their types
 mne.viz.plot_events(events, sfreq=raw.info["sfreq"], first_samp=raw.first_samp, event_id=event_id)
+# (alignment.align_files(timing_file, vmrk_file) checks every marker against the planned trial sequence:
+# the code mapping, dropped and extra triggers and the onset deltas)
 
 # Create epochs based on the events list and define the time points of interest before and after the event
 t_min = ...
@@ -80,6 +83,8 @@ evokeds[1].plot_joint()
 # Plot the global field power (GFP), as well as pick one channel for best representation of your experiment
 # What's the difference between the plots?
 mne.viz.plot_compare_evokeds(evokeds)
+# (beyond the averages: tfr.condition_tfr(epochs, numpy.arange(6., 31.), n_cycles=numpy.arange(6., 31.) / 4)
+# gives power, induced power and inter-trial phase coherence per condition, .to_mne(epochs.info) for plotting)
 
 # Get peak amplitude and the time points of the peaks for each condition
 
@@ -88,6 +93,8 @@ mne.write_evokeds(f"{DIR}/Data/EEG_data/MMN_1-ave.fif", evokeds, overwrite=True)
 
 # Now try to create the evokeds for our paradigm.
 # Standard - all other conditions than deviant.
+# (evoked.EvokedAccumulator.from_epochs(epochs).joint_standard_evokeds() gives the same dict
+# in one pass over the epochs, without concatenating them for every deviant)
 
 evokeds = {}
 deviants = [cond for cond in event_dict if cond != "standard"]
@@ -7,6 +7,9 @@ import numpy
 # Load epochs from the previously saved file
 DIR = os.getcwd()
 epochs = mne.read_epochs(f"{DIR}/Data/EEG_data/MMN_1-epo.fif")
+# (for large files: epoch_store.epochs_to_store(f"{DIR}/Data/EEG_data/MMN_1-epo.fif") once, then
+# epoch_store.EpochStore(f"{DIR}/Data/EEG_data/MMN_1-epo.store")[['standard', 'dev_freq']] reads only
+# these conditions)
 
 # Let's repeat creating the evokeds from the epochs (Worksheet 5)
 
@@ -78,6 +81,10 @@ X = [std_dev_freq_epochs.get_data().transpose(0, 2, 1),
 # you would at least do 1000.
 t_obs, clusters, cluster_pv, h0 = mne.stats.spatio_temporal_cluster_test(
     X, threshold=dict(start=.2, step=.2), adjacency=adjacency, n_permutations=100)
+# For 1000+ permutations use cluster.cluster_test with the same arguments: it spreads the permutations over
+# all CPU cores and keeps finished ones in work_dir, so the run can be extended later
+# t_obs, clusters, cluster_pv, h0 = cluster.cluster_test(
+#     X, adjacency, threshold=dict(start=.2, step=.2), n_permutations=1000, work_dir=f"{DIR}/Data/cluster_runs")
 
 # We can see the number of significant points in the data by summing all the values in the test statistic which
 # have a value smaller .05
@@ -140,3 +147,9 @@ window_mask = (times >= window_start) & (times <= window_end)
 window_mean = data[window_mask].mean()
 
 print(f"Mean amplitude in 40 ms window around MMN peak: {window_mean/1e-6:.3f} µV at {min_time*1000:.1f} ms")
+
+# The same for all channels, contrasts and subjects at once (plus the ROI of worksheet 5 and the fractional
+# area latency), as one table for the statistics:
+# data, times, ch_names = measures.stack_evokeds([{'mmn_freq': mmn_freq}])  # one dict per subject
+# table = measures.measure_table(data, times, ch_names, contrasts=['mmn_freq'])
+# measures.save_table(table, f"{DIR}/Data/mmn_measures.csv")